@@ -0,0 +1,39 @@
+"""Exporting DataFrames to R with data_py"""
+import pytest
+
+import pygg
+from conftest import SIZES, DTYPES, make_frame, remove
+
+TRANSFERS = ['csv', 'binary', 'shm', 'feather']
+
+
+@pytest.mark.parametrize("transfer", TRANSFERS)
+@pytest.mark.parametrize("dtypes", sorted(DTYPES))
+@pytest.mark.parametrize("n", SIZES)
+def bench_data_py(benchmark, n, dtypes, transfer):
+    if transfer == 'feather':
+        pytest.importorskip("pyarrow")
+    df = make_frame(n)[DTYPES[dtypes]]
+
+    def export():
+        remove(pygg.data_py(df, transfer=transfer, cache=None))
+    benchmark(export)
+
+
+@pytest.mark.parametrize("n", SIZES)
+def bench_fingerprint(benchmark, n):
+    benchmark(pygg.DataCache.fingerprint, make_frame(n))
+
+
+@pytest.mark.parametrize("n", SIZES)
+def bench_aggregate_df(benchmark, n):
+    df = make_frame(n)
+    p = pygg.ggplot('data', pygg.aes(x='x')) + pygg.geom_histogram(bins=50)
+    benchmark(pygg.aggregate_df, p, df)
+
+
+@pytest.mark.parametrize("n", SIZES)
+def bench_downsample(benchmark, n):
+    df = make_frame(n)
+    p = pygg.ggplot('data', pygg.aes(x='x', y='y')) + pygg.geom_point()
+    benchmark(pygg.downsample, p, df, 3000, 2400)
@@ -0,0 +1,15 @@
+"""Time to import pygg in a fresh interpreter"""
+import subprocess
+import sys
+
+
+def bench_import(benchmark):
+    benchmark.pedantic(subprocess.check_call, args=([sys.executable, "-c", "import pygg"],),
+                       rounds=10)
+
+
+def bench_import_and_build(benchmark):
+    code = ("import pygg; "
+            "(pygg.ggplot('data', pygg.aes(x='x', y='y')) + pygg.geom_point()).r")
+    benchmark.pedantic(subprocess.check_call, args=([sys.executable, "-c", code],),
+                       rounds=10)
@@ -0,0 +1,60 @@
+"""R startup and end-to-end ggsave"""
+import os
+import tempfile
+
+import pytest
+
+import pygg
+from conftest import SIZES, make_frame, requires_r
+
+pytestmark = requires_r
+
+PLOTS = {
+    'scatter': lambda: pygg.ggplot('data', pygg.aes(x='x', y='y')) + pygg.geom_point(),
+    'histogram': lambda: pygg.ggplot('data', pygg.aes(x='x')) + pygg.geom_histogram(bins=50),
+    'facets': lambda: (pygg.ggplot('data', pygg.aes(x='x', y='y')) + pygg.geom_point() +
+                       pygg.facet_wrap('~group')),
+}
+
+
+def bench_execute_r(benchmark):
+    benchmark.pedantic(pygg.execute_r, args=("invisible(NULL)", True), rounds=5)
+
+
+def bench_worker(benchmark):
+    with pygg.RWorkerPool(size=1) as pool:
+        pool.execute("invisible(NULL)", True)   # start the worker
+        benchmark(pool.execute, "invisible(NULL)", True)
+
+
+@pytest.mark.parametrize("n", SIZES)
+@pytest.mark.parametrize("plot", sorted(PLOTS))
+def bench_ggsave(benchmark, plot, n):
+    df = make_frame(n)
+    p = PLOTS[plot]()
+    fname = tempfile.NamedTemporaryFile(suffix=".png").name
+    try:
+        benchmark.pedantic(pygg.ggsave, args=(fname, p, df),
+                           kwargs=dict(quiet=True, width=4, height=3, dpi=72,
+                                       transfer='binary', render_cache=None),
+                           rounds=3)
+    finally:
+        if os.path.exists(fname):
+            os.remove(fname)
+
+
+@pytest.mark.parametrize("n", SIZES)
+def bench_ggsave_worker(benchmark, n):
+    df = make_frame(n)
+    p = PLOTS['scatter']()
+    fname = tempfile.NamedTemporaryFile(suffix=".png").name
+    with pygg.RWorkerPool(size=1) as pool:
+        try:
+            benchmark.pedantic(pygg.ggsave, args=(fname, p, df),
+                               kwargs=dict(quiet=True, width=4, height=3, dpi=72,
+                                           transfer='binary', render_cache=None,
+                                           backend=pool),
+                               rounds=3)
+        finally:
+            if os.path.exists(fname):
+                os.remove(fname)
@@ -0,0 +1,38 @@
+"""Building plots and generating their R code"""
+import numpy
+import pytest
+
+import pygg
+
+
+def build(nlayers):
+    p = pygg.ggplot('data', pygg.aes(x='x', y='y')) + pygg.geom_point()
+    for i in range(nlayers):
+        p += pygg.annotate(pygg.esc("text"), x=i, y=i, label=pygg.esc("layer %d" % i))
+    return p
+
+
+@pytest.mark.parametrize("nlayers", [10, 1000, 10000])
+def bench_compose(benchmark, nlayers):
+    benchmark(build, nlayers)
+
+
+@pytest.mark.parametrize("nlayers", [10, 1000, 10000])
+def bench_r(benchmark, nlayers):
+    p = build(nlayers)
+
+    def generate():
+        pygg.pygg._invalidate_r()   # measure generation, not the cache
+        return p.r
+    benchmark(generate)
+
+
+@pytest.mark.parametrize("n", [10 ** 3, 10 ** 5, 10 ** 6])
+def bench_r_vector(benchmark, n):
+    values = numpy.random.RandomState(0).randn(n)
+    stmt = pygg.annotate(pygg.esc("point"), x=values, y=values.tolist())
+
+    def generate():
+        pygg.pygg._invalidate_r()
+        return stmt.r
+    benchmark(generate)
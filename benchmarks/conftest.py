@@ -0,0 +1,63 @@
+"""Shared data and switches for the pygg benchmarks
+
+Needs pytest-benchmark.  Run from the repository root with
+
+    python -m pytest benchmarks
+
+Results are saved under .benchmarks/ and can be compared with an earlier
+run with --benchmark-compare.  Set PYGG_BENCH_LARGE=1 to include the 1M and
+10M row datasets.
+"""
+import functools
+import os
+import shutil
+
+import numpy
+import pandas
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+import pygg
+
+
+SIZES = [10 ** 3, 10 ** 5]
+if os.environ.get("PYGG_BENCH_LARGE"):
+    SIZES += [10 ** 6, 10 ** 7]
+
+# column subsets used to time data export
+DTYPES = {
+    'numeric': ['x', 'y', 'i'],
+    'mixed': ['x', 'y', 'i', 'flag', 'group', 'label', 'time'],
+}
+
+requires_r = pytest.mark.skipif(shutil.which(pygg.pygg.R_COMMAND) is None,
+                                reason="R is not installed")
+
+
+def pytest_configure(config):
+    # keep every run for regression comparison
+    if hasattr(config.option, "benchmark_autosave"):
+        config.option.benchmark_autosave = True
+
+
+@functools.lru_cache(maxsize=None)
+def make_frame(n):
+    """Synthetic dataset of n rows with numeric, boolean, categorical,
+    string and datetime columns"""
+    rng = numpy.random.RandomState(0)
+    return pandas.DataFrame({
+        'x': rng.randn(n),
+        'y': rng.randn(n),
+        'i': rng.randint(0, 1000, n),
+        'flag': rng.rand(n) < 0.5,
+        'group': pandas.Categorical(rng.choice(list("abcdefgh"), n)),
+        'label': rng.choice(["alpha", "beta", "gamma", "delta"], n),
+        'time': pandas.date_range("2020-01-01", periods=n, freq="s"),
+    })
+
+
+def remove(ggdata):
+    """Delete the file data_py wrote for ggdata"""
+    if ggdata.fname and os.path.exists(ggdata.fname):
+        os.remove(ggdata.fname)
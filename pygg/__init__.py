@@ -1 +1,10 @@
-from .pygg import *
+from . import pygg as _pygg
+from .pygg import __all__
+
+# forward to pygg.pygg, whose ggplot2 bindings are created on first use
+def __getattr__(name):
+    return getattr(_pygg, name)
+
+
+def __dir__():
+    return _pygg.__dir__()
@@ -5,17 +5,55 @@ run the following for help
 """
 import os
 import re
+import atexit
+import collections
+import collections.abc
+import hashlib
+import shutil
 import subprocess
 import csv
 import tempfile
+import threading
+import time
+import uuid
+import queue
+import functools
+import concurrent.futures
+import importlib
+import sys
+import types
+import weakref
+
+from . import ggplot2_functions
+
+class _LazyModule(object):
+    """Stand-in for a module that is imported on first attribute access
+
+    pandas and numpy take most of pygg's import time but are only needed once
+    python data is converted (and asyncio only by ggsave_async), so they are
+    bound to instances of this class.
+    The first access replaces the global with the real module.
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._name] = module
+        return getattr(module, attr)
+
 
-import pandas
+numpy = _LazyModule("numpy")
+pandas = _LazyModule("pandas")
+asyncio = _LazyModule("asyncio")
 
 quote1re = re.compile('"')
 quote2re = re.compile("'")
 
 R_IMAGE_SIZE = 7            # in inches
 IPYTHON_IMAGE_SIZE = 800    # in pixels
+R_COMMAND = "R"             # R executable used by the subprocess and worker backends
 
 def esc(mystr):
     """Escape string so that it remains a string when converted to R"""
@@ -45,7 +83,14 @@ def _to_r(o, as_data=False, level=0):
         return o.r
     elif isinstance(o, bool):
         return "TRUE" if o else "FALSE"
-    elif isinstance(o, (list, tuple)):
+    elif isinstance(o, float):
+        return _r_floats([o])
+    elif isinstance(o, (list, tuple)) or _is_array(o):
+        vector = _r_vector(o, as_data)
+        if vector is not None:
+            return vector
+        if not isinstance(o, (list, tuple)):
+            o = o.tolist()
         inner = ",".join([_to_r(x, True, level+1) for x in o])
         return "c({})".format(inner) if as_data else inner
     elif isinstance(o, dict):
@@ -55,12 +100,233 @@ def _to_r(o, as_data=False, level=0):
     return str(o)
 
 
-class GGStatement(object):
+R_VECTOR_FILE_THRESHOLD = None   # numeric vectors at least this long are written to a
+                                 # file and loaded with readBin.  None keeps them inline
+
+_NONFINITE_RE = re.compile(r"-?inf|nan")
+_NONFINITE_R = {'nan': 'NA', 'inf': 'Inf', '-inf': '-Inf'}
+
+
+def _is_array(o):
+    """Is o a numpy array or pandas Series?  Doesn't import either"""
+    numpy_ = sys.modules.get('numpy')
+    pandas_ = sys.modules.get('pandas')
+    return (numpy_ is not None and isinstance(o, numpy_.ndarray)) or \
+        (pandas_ is not None and isinstance(o, pandas_.Series))
+
+
+def _r_floats(values):
+    """Comma separated R literals for a list of python floats"""
+    text = ",".join(map(str, values))
+    if 'n' in text:
+        text = _NONFINITE_RE.sub(lambda m: _NONFINITE_R[m.group(0)], text)
+    return text
+
+
+def _r_vector(o, as_data):
+    """R code for a list, tuple, numpy array or pandas Series holding only
+    booleans or only numbers, formatted in one pass instead of per element
+
+    @return None if o holds anything else
+    """
+    if _is_array(o):
+        o = o.to_numpy() if not isinstance(o, sys.modules['numpy'].ndarray) else o
+        kind = o.dtype.kind
+        if kind not in 'biuf':
+            return None
+        values = o.ravel().tolist()
+    else:
+        types_ = set(map(type, o))
+        if types_ == {int}:
+            kind = 'i'
+        elif types_ == {bool}:
+            kind = 'b'
+        elif float in types_ and types_ <= {int, float}:
+            kind = 'f'
+        else:
+            return None
+        values = o
+
+    if as_data and R_VECTOR_FILE_THRESHOLD is not None and kind != 'b' and \
+            len(values) >= R_VECTOR_FILE_THRESHOLD:
+        return _r_vector_file(values, kind)
+    if kind == 'b':
+        inner = ",".join(["TRUE" if v else "FALSE" for v in values])
+    elif kind == 'f':
+        inner = _r_floats(values)
+    else:
+        inner = ",".join(map(str, values))
+    return "c({})".format(inner) if as_data else inner
+
+
+def _r_vector_file(values, kind):
+    """readBin() expression loading the numbers in values from a file named
+    after their contents, so identical vectors share a file"""
+    arr = numpy.asarray(values, dtype='<f8' if kind == 'f' else None)
+    if kind != 'f' and len(arr) and (arr.min() < -2 ** 31 + 1 or arr.max() > 2 ** 31 - 1):
+        arr = arr.astype('<f8')
+    if arr.dtype.kind == 'f':
+        arr, rtype = arr.astype('<f8'), '"double", %dL, size=8'
+    else:
+        arr, rtype = arr.astype('<i4'), '"integer", %dL, size=4'
+    data = arr.tobytes()
+    workspace = get_workspace()
+    directory = os.path.join(workspace.directory, "vectors")
+    fname = os.path.join(directory, hashlib.sha1(data).hexdigest() + ".bin")
+    # pinned, because the R code of cached statements keeps referring to it
+    workspace.add(fname, pin=fname not in workspace)
+    if not os.path.exists(fname):
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        tmp = "%s.%s.tmp" % (fname, uuid.uuid4().hex)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, fname)
+    return 'readBin(%s, %s, endian="little")' % (esc(fname), rtype % len(arr))
+
+
+# Cached R code (see GGStatement.r) depends on the statement, on the
+# statements nested in its arguments, and on module settings.  A statement
+# that changes drops its own code and that of every statement it was used in
+# (its _parents, recorded while their code is generated).  Code generated
+# under other settings is regenerated
+_r_generation = 0
+_r_building = threading.local()   # stack of statements generating their code
+
+
+def _r_settings():
+    """Module settings that cached R code was generated under"""
+    return (R_VECTOR_FILE_THRESHOLD, _r_generation)
+
+
+def _invalidate_r():
+    """Drop the cached R code of every statement"""
+    global _r_generation
+    _r_generation += 1
+
+
+class _CachedR(object):
+    """R code caching shared by GGStatement and GGStatements"""
+    __slots__ = ()
+
+    def _cached_r(self):
+        """Cached code, or None.  Also records the statement whose code is
+        being generated as a parent of this one"""
+        stack = getattr(_r_building, 'stack', None)
+        if stack:
+            if self._parents is None:
+                object.__setattr__(self, '_parents', weakref.WeakSet())
+            self._parents.add(stack[-1])
+        cached = self._r
+        if cached is not None and cached[0] == _r_settings():
+            return cached[1]
+        return None
+
+    def _build_r(self, build):
+        settings = _r_settings()
+        stack = getattr(_r_building, 'stack', None)
+        if stack is None:
+            stack = _r_building.stack = []
+        stack.append(self)
+        try:
+            r = build()
+        finally:
+            stack.pop()
+        object.__setattr__(self, '_r', (settings, r))
+        return r
+
+    def _invalidate(self):
+        object.__setattr__(self, '_r', None)
+        parents = self._parents
+        if parents:
+            object.__setattr__(self, '_parents', None)
+            for parent in list(parents):
+                parent._invalidate()
+
+
+class _StatementKwargs(dict):
+    """Keyword arguments of a GGStatement.  Invalidates the statement's
+    cached R code when changed in place"""
+    __slots__ = ('_owner',)
+
+    def __init__(self, owner, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._owner = weakref.ref(owner)
+
+    def _changed(self):
+        owner = self._owner()
+        if owner is not None:
+            owner._invalidate()
+
+    def __setitem__(self, key, value):
+        self._changed()
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._changed()
+        dict.__delitem__(self, key)
+
+    def __ior__(self, other):
+        self._changed()
+        dict.update(self, other)
+        return self
+
+    def clear(self):
+        self._changed()
+        dict.clear(self)
+
+    def pop(self, *args):
+        self._changed()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._changed()
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        self._changed()
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        self._changed()
+        dict.update(self, *args, **kwargs)
+
+
+class GGStatement(_CachedR):
+    # R code is cached in _r as (settings, code).  name, args and kwargs
+    # determine the code, so assigning them invalidates it.  Lists and dicts
+    # nested in args are not watched; replace them rather than changing them
+    __slots__ = ('name', 'args', 'kwargs', 'data', '_r', '_parents', '__weakref__')
+    _R_ATTRS = frozenset(['name', 'args', 'kwargs'])
+
     def __init__(self, _name, *args, **kwargs):
-        self.name = _name
-        self.args = args
-        self.data = None
-        self.kwargs = kwargs
+        set_attr = object.__setattr__
+        set_attr(self, 'name', _name)
+        set_attr(self, 'args', args)
+        set_attr(self, 'data', None)
+        set_attr(self, 'kwargs', _StatementKwargs(self, kwargs))
+        set_attr(self, '_r', None)
+        set_attr(self, '_parents', None)
+
+    def __setattr__(self, attr, value):
+        if attr == 'kwargs':
+            value = _StatementKwargs(self, value)
+        object.__setattr__(self, attr, value)
+        if attr in self._R_ATTRS:
+            self._invalidate()
+
+    # cached code and parents belong to this process, so they aren't
+    # pickled or copied
+    def __getstate__(self):
+        return dict(name=self.name, args=self.args, kwargs=dict(self.kwargs),
+                    data=self.data)
+
+    def __setstate__(self, state):
+        for attr, value in state.items():
+            object.__setattr__(self, attr, value)
+        object.__setattr__(self, 'kwargs', _StatementKwargs(self, state['kwargs']))
+        object.__setattr__(self, '_r', None)
+        object.__setattr__(self, '_parents', None)
 
     def to_stmts(self):
         return GGStatements([self])
@@ -68,11 +334,17 @@ class GGStatement(object):
     def __add__(self, o):
         if not o:
             return self.to_stmts()
-        return self.to_stmts() + o.to_stmts()
+        return GGStatements([self] + GGStatements._items(o))
 
     @property
     def r(self):
         """Convert this GGStatement into its R equivalent expression"""
+        cached = self._cached_r()
+        if cached is not None:
+            return cached
+        return self._build_r(self._generate_r)
+
+    def _generate_r(self):
         r_args = [_to_r(self.args), _to_r(self.kwargs)]
         # remove empty strings from the call args
         r_args = ",".join([x for x in r_args if x != ""])
@@ -86,12 +358,54 @@ class GGStatement(object):
         return ggsave(name, self.to_stmts(), *args, **kwargs)
 
 
-class GGStatements(object):
+class GGStatements(_CachedR):
+    """An immutable sequence of statements joined with +
+
+    `p + stmt` doesn't copy p.  Objects built from each other share one
+    append-only buffer and each sees its first `_len` entries, so growing a
+    plot with `p += ...` in a loop takes linear time.  Only adding to an
+    object that was already extended (e.g. `p + a` followed by `p + b`)
+    copies its statements, into a new buffer.
+
+    `stmts` is therefore a tuple.  Build plots with +, or assign a new
+    sequence to `stmts`, instead of changing it in place.
+    """
+
+    __slots__ = ('_buf', '_len', '_lock', '_r', '_parents', '__weakref__')
 
     def __init__(self, stmts=None):
         self.stmts = stmts
-        if not self.stmts:
-            self.stmts = []
+
+    @property
+    def stmts(self):
+        return tuple(self._buf[:self._len])
+
+    @stmts.setter
+    def stmts(self, stmts):
+        if hasattr(self, '_len'):
+            self._invalidate()
+        else:
+            self._parents = None
+        self._buf = list(stmts) if stmts else []
+        self._len = len(self._buf)
+        self._lock = threading.Lock()
+        self._r = None
+
+    def __reduce__(self):
+        # rebuilt with a buffer and lock of its own
+        return (GGStatements, (self.stmts,))
+
+    @staticmethod
+    def _items(o):
+        """List of the statements o contributes to a sum"""
+        if isinstance(o, GGStatement):
+            return [o]
+        try:
+            return list(o.to_stmts().stmts)
+        except:
+            if isinstance(o, list):
+                return list(o)
+            return [o]
 
     def to_stmts(self):
         return self
@@ -99,15 +413,16 @@ class GGStatements(object):
     def __add__(self, o):
         if not o:
             return self
-        stmts = list(self.stmts)
-        try:
-            stmts.extend(o.to_stmts().stmts)
-        except:
-            if isinstance(o, list):
-                stmts.extend(o)
-            else:
-                stmts.append(o)
-        return GGStatements(stmts)
+        items = GGStatements._items(o)
+        with self._lock:
+            if len(self._buf) == self._len:
+                # nothing was added to self yet: extend the shared buffer
+                self._buf.extend(items)
+                stmts = GGStatements.__new__(GGStatements)
+                stmts._buf, stmts._len, stmts._lock = self._buf, len(self._buf), self._lock
+                stmts._r = stmts._parents = None
+                return stmts
+        return GGStatements(list(self.stmts) + items)
 
     @property
     def data(self):
@@ -118,7 +433,10 @@ class GGStatements(object):
 
     @property
     def r(self):
-        return " + ".join(_to_r(x) for x in self.stmts)
+        cached = self._cached_r()
+        if cached is not None:
+            return cached
+        return self._build_r(lambda: " + ".join(_to_r(x) for x in self.stmts))
 
     def __str__(self):
         return self.r
@@ -134,9 +452,15 @@ class GGStatements(object):
 ###################################################
 
 class GGData(object):
-  def __init__(self, r_commands, fname=None):
+  def __init__(self, r_commands, fname=None, db=None, sql=None, driver=None,
+               query_cache=None):
       self.r_commands = r_commands
       self.fname = fname
+      # set by data_sql so the query can be rewritten (see aggregate_sql)
+      self.db = db
+      self.sql = sql
+      self.driver = driver
+      self.query_cache = query_cache
 
 
   def __str__(self):
@@ -145,32 +469,109 @@ class GGData(object):
 
 def is_pandas_df(o):
     """Is object o a pandas dataframe?"""
-    return isinstance(o, pandas.DataFrame)
-
-
-def data_sql(db, sql):
-    """Load file using RPostgreSQL
-
-    Place to edit if want to add more database backend support
-
+    # no DataFrame can exist before pandas is imported, so don't import it here
+    return 'pandas' in sys.modules and isinstance(o, sys.modules['pandas'].DataFrame)
+
+
+# DBI driver name -> (R package, expression connecting to the database %s)
+SQL_DRIVERS = {
+    'PostgreSQL': ('RPostgreSQL', 'DBI::dbConnect(RPostgreSQL::PostgreSQL(), dbname=%s)'),
+    'SQLite': ('RSQLite', 'DBI::dbConnect(RSQLite::SQLite(), dbname=%s)'),
+    'MariaDB': ('RMariaDB', 'DBI::dbConnect(RMariaDB::MariaDB(), dbname=%s)'),
+}
+DEFAULT_SQL_DRIVER = 'PostgreSQL'
+
+# Defines .pygg_query(key, connect, query) and .pygg_disconnect() once per R
+# session.  Unless options(pygg.persistent=TRUE) is set (RWorker does), the
+# connection is closed right after the query.  Otherwise up to
+# getOption("pygg.pool.size") connections are kept, keyed by driver and
+# database, and closed after getOption("pygg.idle.timeout") idle seconds.
+_SQL_POOL_R = """if (!exists(".pygg_query", envir=globalenv())) local({
+  pool = new.env()
+  disconnect = function(key) {
+    try(DBI::dbDisconnect(pool[[key]]$con), silent=TRUE)
+    rm(list=key, envir=pool)
+  }
+  assign(".pygg_disconnect", function() {
+    for (key in ls(pool, all.names=TRUE)) disconnect(key)
+  }, envir=globalenv())
+  assign(".pygg_query", function(key, connect, query) {
+    if (!isTRUE(getOption("pygg.persistent"))) {
+      con = connect()
+      on.exit(DBI::dbDisconnect(con))
+      return(DBI::dbGetQuery(con, query))
+    }
+    now = Sys.time()
+    for (k in ls(pool, all.names=TRUE)) {
+      idle = as.numeric(difftime(now, pool[[k]]$used, units="secs"))
+      if (idle > getOption("pygg.idle.timeout", 300)) disconnect(k)
+    }
+    if (exists(key, envir=pool, inherits=FALSE) &&
+        !isTRUE(tryCatch(DBI::dbIsValid(pool[[key]]$con), error=function(e) FALSE)))
+      disconnect(key)
+    if (exists(key, envir=pool, inherits=FALSE)) {
+      entry = pool[[key]]
+    } else {
+      keys = ls(pool, all.names=TRUE)
+      if (length(keys) >= getOption("pygg.pool.size", 4)) {
+        used = sapply(keys, function(k) as.numeric(pool[[k]]$used))
+        disconnect(keys[which.min(used)])
+      }
+      entry = list(con=connect())
+    }
+    entry$used = now
+    assign(key, entry, envir=pool)
+    DBI::dbGetQuery(entry$con, query)
+  }, envir=globalenv())
+})"""
+
+
+def data_sql(db, sql, driver=None, cache=None):
+    """Load the result of an SQL query through DBI
+
+    The connection is closed after the query, unless the program runs in an
+    R session that serves several renders (an RWorker), where connections
+    are pooled per driver and database (see RWorkerPool).  Call
+    .pygg_disconnect() in R code to close them explicitly.
+
+    @param db database name, or file name for SQLite
+    @param sql query whose result becomes the `data` variable
+    @param driver key of SQL_DRIVERS.  Defaults to DEFAULT_SQL_DRIVER
+    @param cache QueryCache that lets repeated renders reuse the result.
+        Defaults to the cache set with set_query_cache()
+    @raises ValueError if the driver is unknown
     """
     if not db:
         if sql:
             print("ERR: -db option must be set if using -sql")
         return ""
 
+    driver = driver or DEFAULT_SQL_DRIVER
+    if driver not in SQL_DRIVERS:
+        raise ValueError("unknown SQL driver {!r}, expected one of {}".format(
+            driver, ", ".join(sorted(SQL_DRIVERS))))
+    package, connect = SQL_DRIVERS[driver]
+    if cache is None:
+        cache = _default_query_cache
+
     cmd = """
-    library(RPostgreSQL)
-    drv = dbDriver('PostgreSQL')
-    con = dbConnect(drv, dbname='%(db_name)s')
-    q = "%(query)s"
-    data = dbGetQuery(con, q)
+    library(DBI)
+    library(%(package)s)
+    %(pool)s
+    data = %(load)s
     """
 
+    load = ".pygg_query(%s, function() %s, %s)" % (
+        esc("%s:%s" % (driver, db)), connect % esc(db), esc(sql))
+    if cache is not None:
+        cache.evict()
+        load = cache.load(cache.path(db, sql, driver), load)
+
     return GGData(cmd % {
-        'db_name': db,
-        'query': sql
-    })
+        'package': package,
+        'pool': _SQL_POOL_R,
+        'load': load
+    }, db=db, sql=sql, driver=driver, query_cache=cache)
 
 
 def data_py(o, *args, **kwargs):
@@ -186,29 +587,1704 @@ def data_py(o, *args, **kwargs):
 
           { 'x': [0,1,2...], 'y': [...], ... }
 
+      iterator or generator of row dictionaries or DataFrame chunks, such as
+      pandas.read_csv(..., chunksize=N).  Written in batches of `batch_rows`
+      rows by the csv, binary and shm transfers, so the data never needs to fit in
+      memory at once.  Columns are taken from the first batch
+
+          (dict(x=i, y=i * i) for i in range(10 ** 8))
+
     @param o python object to convert
     @param args argument list to pass to read.csv
-    @param kwargs keyword args to pass to read.csv
+    @param kwargs keyword args to pass to read.csv.  The special keyword
+        `transfer` picks the format used to ship o to R (see TRANSFER_FORMATS);
+        it defaults to DEFAULT_TRANSFER.  The special keyword `cache` is a
+        DataCache that lets identical data reuse an already written file; it
+        defaults to the cache set with set_data_cache().  The special keyword
+        `batch_rows` sets the batch size for iterators
     @return a tuple of the file containing the data and an
-        expression to define data.frame object and set it to variable "data"
+        expression to define data.frame object and set it to variable "data".
+        The file belongs to the current TempWorkspace, which deletes it once
+        it is older than the workspace's max_age
 
     data = read.csv(tmpfile, *args, **kwargs)
 
     """
+    transfer = get_transfer(kwargs.pop('transfer', None))
+    cache = kwargs.pop('cache', None)
+    if cache is None:
+        cache = _default_data_cache
     if isinstance(o, str):
         fname = o
+        kwargs["sep"] = esc(',')
+        load_stmt = GGStatement("read.csv", esc(fname), *args, **kwargs).r
+        return GGData("data = {}".format(load_stmt), fname=fname)
+
+    batch_rows = kwargs.pop('batch_rows', STREAM_BATCH_ROWS)
+    if is_stream(o):
+        chunks = _iter_chunks(o, batch_rows)
+        if hasattr(transfer, 'dump_chunks'):
+            fname = get_workspace().new_file(transfer.suffix,
+                                             getattr(transfer, 'directory', None))
+            load_stmt = transfer.dump_chunks(chunks, fname, *args, **kwargs)
+            return GGData("data = {}".format(load_stmt), fname=fname)
+        # formats that need the whole frame at once
+        o = pandas.concat(list(chunks), ignore_index=True)
+
+    if not is_pandas_df(o):
+        # convert incoming data layout to pandas' DataFrame
+        o = pandas.DataFrame(o)
+
+    if getattr(transfer, 'inline', False):
+        load_stmt = transfer.dump(o, None, *args, **kwargs)
+        return GGData("data = {}".format(load_stmt))
+
+    key = None
+    if cache is not None:
+        key = cache.key(o, transfer, args, kwargs)
+        ggdata = cache.get(key)
+        if ggdata is not None:
+            return ggdata
+    if key is not None:
+        fname = cache.new_fname(transfer.suffix, getattr(transfer, 'directory', None))
     else:
-        if not is_pandas_df(o):
-            # convert incoming data layout to pandas' DataFrame
-            o = pandas.DataFrame(o)
-        fname = tempfile.NamedTemporaryFile().name
-        o.to_csv(fname, sep=',', encoding='utf-8', index=False)
-    kwargs["sep"] = esc(',')
-    read_csv_stmt = GGStatement("read.csv", esc(fname), *args, **kwargs).r
-    return GGData("data = {}".format(read_csv_stmt), fname=fname)
+        fname = get_workspace().new_file(transfer.suffix,
+                                         getattr(transfer, 'directory', None))
+
+    load_stmt = transfer.dump(o, fname, *args, **kwargs)
+    ggdata = GGData("data = {}".format(load_stmt), fname=fname)
+    if key is not None:
+        cache.put(key, ggdata)
+    return ggdata
+
+
+STREAM_BATCH_ROWS = 100000   # rows per batch when data_py streams an iterator
+
+
+def is_stream(o):
+    """Is o an iterator that data_py should consume in batches?"""
+    return isinstance(o, collections.abc.Iterator) and not is_pandas_df(o)
+
+
+def _iter_chunks(o, batch_rows):
+    """DataFrames of at most batch_rows rows built from an iterator of row
+    dictionaries, passing DataFrame items through as they are"""
+    batch = []
+    for item in o:
+        if is_pandas_df(item):
+            if batch:
+                yield pandas.DataFrame(batch)
+                batch = []
+            yield item
+        else:
+            batch.append(item)
+            if len(batch) >= batch_rows:
+                yield pandas.DataFrame(batch)
+                batch = []
+    if batch:
+        yield pandas.DataFrame(batch)
+
+
+###################################################
+#
+#  Temporary files.  Every file pygg writes for R to read lives in a
+#  workspace that deletes it after rendering, or later when it grows too old
+#  or too large
+#
+###################################################
+
+_default_workspace = None
+_default_workspace_lock = threading.Lock()
+
+
+def get_workspace():
+    """The workspace that owns temporary files, created on first use and
+    cleaned up when python exits"""
+    global _default_workspace
+    with _default_workspace_lock:
+        if _default_workspace is None:
+            _default_workspace = TempWorkspace()
+            atexit.register(_default_workspace.cleanup)
+        return _default_workspace
+
+
+def set_workspace(workspace):
+    """Create temporary files in workspace from now on
+
+    Files in the previous workspace are left alone; call its cleanup() to
+    delete them.
 
+    @param workspace a TempWorkspace, or None to start a new default one
+    @return the previous workspace
+    """
+    global _default_workspace
+    with _default_workspace_lock:
+        prev, _default_workspace = _default_workspace, workspace
+    # cached R code may refer to files in the previous workspace
+    _invalidate_r()
+    return prev
+
+
+class TempWorkspace(object):
+    """Directory of temporary files with size and age bounds
+
+    data_py, ggsave, ggsave_many, gg_ipython and RWorker create their files
+    with new_file() and release() them once R has read them.  Files that are
+    never released (e.g., those of a GGData made by calling data_py directly)
+    are deleted by gc(), which runs on every new_file(): first the files older
+    than max_age, then the oldest ones until the rest fit in max_bytes.
+    Pinned files are skipped, which is how DataCache keeps the files it
+    hands out.
+
+    Used as a context manager, the workspace becomes the default for the
+    block and deletes everything it owns on exit:
+
+      with TempWorkspace(max_bytes=256 * 1024 ** 2):
+          ggsave("a.pdf", p, data=df)
+
+    @param directory where files are created.  Defaults to a new temp
+        directory, which cleanup() removes
+    @param max_bytes total size of unpinned files to keep on disk
+    @param max_age seconds after which unpinned files are deleted
+    """
+
+    def __init__(self, directory=None, max_bytes=1024 ** 3, max_age=3600):
+        self._owns_directory = directory is None
+        self.directory = directory or tempfile.mkdtemp(prefix="pygg-")
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._files = collections.OrderedDict()   # path -> creation time
+        self._pins = collections.Counter()
+        self._lock = threading.Lock()
+        self._prev = None
+
+    def new_file(self, suffix='', directory=None, pin=False):
+        """Name of a new file owned by this workspace.  The file itself is
+        not created
+
+        @param directory create the file there instead, e.g. /dev/shm
+        @param pin if True, gc() won't delete the file until it is unpinned
+        """
+        self.gc()
+        if directory is None:
+            directory = self.directory
+            os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "pygg-" + uuid.uuid4().hex + suffix)
+        self.add(path, pin)
+        return path
+
+    def add(self, path, pin=False):
+        """Take ownership of path"""
+        with self._lock:
+            self._files.setdefault(path, time.time())
+            if pin:
+                self._pins[path] += 1
+
+    def pin(self, path):
+        with self._lock:
+            if path in self._files:
+                self._pins[path] += 1
+
+    def unpin(self, path):
+        with self._lock:
+            if self._pins[path] <= 1:
+                del self._pins[path]
+            else:
+                self._pins[path] -= 1
+
+    def release(self, path):
+        """Delete path now unless it is pinned.  Paths this workspace doesn't
+        own, such as a user's CSV file, are left alone"""
+        with self._lock:
+            if path not in self._files or self._pins[path]:
+                return
+            self._delete(path)
+
+    def remove(self, path):
+        """Delete path whether or not it is pinned"""
+        with self._lock:
+            self._pins.pop(path, None)
+            self._delete(path)
+
+    def _delete(self, path):
+        self._files.pop(path, None)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def gc(self):
+        """Delete unpinned files that are too old, then the oldest unpinned
+        files until the rest fit in max_bytes
+
+        @return number of files deleted
+        """
+        now = time.time()
+        with self._lock:
+            candidates = [(path, created) for path, created in self._files.items()
+                          if not self._pins[path]]
+            deleted = 0
+            sizes = []
+            for path, created in candidates:
+                if self.max_age is not None and now - created > self.max_age:
+                    self._delete(path)
+                    deleted += 1
+                elif os.path.exists(path):
+                    sizes.append((path, os.path.getsize(path)))
+            if self.max_bytes is not None:
+                nbytes = sum(size for _, size in sizes)
+                for path, size in sizes:
+                    if nbytes <= self.max_bytes:
+                        break
+                    self._delete(path)
+                    nbytes -= size
+                    deleted += 1
+            return deleted
+
+    def cleanup(self):
+        """Delete every file this workspace owns, pinned or not"""
+        with self._lock:
+            for path in list(self._files):
+                self._delete(path)
+            self._pins.clear()
+            if self._owns_directory:
+                shutil.rmtree(self.directory, ignore_errors=True)
+
+    @property
+    def nbytes(self):
+        """Total size of the files currently on disk"""
+        with self._lock:
+            return sum(os.path.getsize(path) for path in self._files
+                       if os.path.isfile(path))
 
+    def __len__(self):
+        return len(self._files)
 
+    def __contains__(self, path):
+        return path in self._files
+
+    def __enter__(self):
+        self._prev = set_workspace(self)
+        return self
+
+    def __exit__(self, *exc):
+        set_workspace(self._prev)
+        self._prev = None
+        self.cleanup()
+
+
+###################################################
+#
+#  Cache of serialized datasets, so plotting the same data
+#  repeatedly only writes it to disk once
+#
+###################################################
+
+_default_data_cache = None
+
+
+def set_data_cache(cache):
+    """Use cache for every data_py call that doesn't name its own
+
+    @param cache a DataCache, or None to disable caching
+    @return the previous default cache
+    """
+    global _default_data_cache
+    prev, _default_data_cache = _default_data_cache, cache
+    return prev
+
+
+class DataCache(object):
+    """Size bounded LRU cache of datasets written by data_py
+
+    Entries are keyed by a hash of the DataFrame's contents, column names and
+    dtypes together with the transfer format and loader arguments, so an
+    unchanged dataset is serialized once no matter how many plots use it.
+    Evicted entries have their files deleted.
+
+      cache = DataCache(max_bytes=2 * 1024 ** 3)
+      ggsave("a.pdf", p1, data=df, data_cache=cache)
+      ggsave("b.pdf", p2, data=df, data_cache=cache)  # reuses the file
+
+    @param max_bytes total size of cached files to keep on disk
+    @param directory where cached files are written.  Defaults to a new
+        temp directory
+    """
+
+    def __init__(self, max_bytes=1024 ** 3, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory or tempfile.mkdtemp(prefix="pygg-data-")
+        self._entries = collections.OrderedDict()   # key -> (GGData, nbytes)
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(df):
+        """Hex digest of a DataFrame's contents, column names and dtypes
+
+        @return None if the frame holds values pandas can't hash
+        """
+        h = hashlib.sha1()
+        h.update(repr([(str(c), str(t)) for c, t in df.dtypes.items()]).encode('utf-8'))
+        try:
+            h.update(pandas.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+        except TypeError:
+            return None
+        return h.hexdigest()
+
+    def key(self, df, transfer, args=(), kwargs=None):
+        """Cache key for writing df with transfer and loader arguments, or
+        None if df can't be fingerprinted"""
+        fingerprint = self.fingerprint(df)
+        if fingerprint is None:
+            return None
+        return "%s:%s:%r:%r" % (fingerprint, transfer.name, tuple(args),
+                                sorted((kwargs or {}).items()))
+
+    def new_fname(self, suffix='', directory=None):
+        """Name of a new file, pinned in the workspace so it outlives the
+        render that wrote it
+
+        @param directory where to create it, e.g. the directory of a
+            transfer format.  Defaults to the cache's directory
+        """
+        return get_workspace().new_file(suffix, directory or self.directory, pin=True)
+
+    def get(self, key):
+        """Return the GGData cached under key, or None"""
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if not os.path.exists(entry[0].fname):
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, ggdata):
+        """Cache ggdata, whose file must already be written, under key"""
+        if key is None:
+            return
+        nbytes = os.path.getsize(ggdata.fname)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (ggdata, nbytes)
+            self._nbytes += nbytes
+            # evict least recently used entries, but always keep the newest
+            while self._nbytes > self.max_bytes and len(self._entries) > 1:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        ggdata, nbytes = self._entries.pop(key)
+        self._nbytes -= nbytes
+        get_workspace().remove(ggdata.fname)
+
+    def clear(self):
+        """Drop every entry and delete its file"""
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+###################################################
+#
+#  Cache of rendered images, keyed by the R program that made them
+#
+###################################################
+
+_default_render_cache = None
+
+
+def set_render_cache(cache):
+    """Use cache for every ggsave call that doesn't name its own
+
+    @param cache a RenderCache, or None to always run R
+    @return the previous default cache
+    """
+    global _default_render_cache
+    prev, _default_render_cache = _default_render_cache, cache
+    return prev
+
+
+class _DirectoryCache(object):
+    """Files in a directory shared between processes, kept under max_bytes
+    by deleting the least recently modified ones.  Base of RenderCache and
+    QueryCache"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.max_bytes = max_bytes
+
+    def entries(self):
+        """List of (path, size, mtime) for every cached file"""
+        entries = []
+        for fname in os.listdir(self.directory):
+            path = os.path.join(self.directory, fname)
+            if fname.endswith(".tmp"):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, st.st_size, st.st_mtime))
+        return entries
+
+    def evict(self):
+        """Delete least recently used files until under max_bytes"""
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(e[1] for e in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Delete every cached file"""
+        for path, _, _ in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class RenderCache(_DirectoryCache):
+    """On-disk cache of images rendered by ggsave
+
+    The key is a hash of the final R program (with the output file name
+    factored out), the output format, and the contents of the data file the
+    program loads.  On a hit ggsave copies (or hard links) the cached image
+    to the requested name without starting R.
+
+    Data that is not loaded from a file, such as data_sql queries, is keyed by
+    its R code only, so a cached image is reused even if the database changed.
+
+      cache = RenderCache("/var/cache/pygg")
+      ggsave("out.png", p, data=df, render_cache=cache)
+
+    @param directory where images are stored.  Shared between processes
+    @param max_bytes total size of images to keep; least recently used
+        images are deleted first
+    @param link hard link cached images to their destination instead of
+        copying them.  Changes to the destination then show up in the cache
+    """
+
+    def __init__(self, directory=None, max_bytes=1024 ** 3, link=False):
+        _DirectoryCache.__init__(
+            self, directory or os.path.join(tempfile.gettempdir(), "pygg-render-cache"),
+            max_bytes)
+        self.link = link
+        self._digests = {}   # (fname, size, mtime) -> content digest
+        self._lock = threading.Lock()
+
+    def key(self, prog, name, ggdata=None, fingerprint=None):
+        """Cache key for rendering prog, which saves to name and loads ggdata
+
+        @param fingerprint identifies data handed to the backend in memory
+        """
+        text = prog.replace(esc(name), esc("pygg-output"))
+        h = hashlib.sha1()
+        if fingerprint is not None:
+            h.update(fingerprint.encode('utf-8'))
+        fname = getattr(ggdata, 'fname', None)
+        if fname and os.path.exists(fname):
+            text = text.replace(fname, "pygg-data")
+            h.update(self.file_digest(fname).encode('utf-8'))
+        h.update(text.encode('utf-8'))
+        return h.hexdigest() + os.path.splitext(name)[1].lower()
+
+    def file_digest(self, fname):
+        """Content hash of fname, memoized on its size and modification time"""
+        st = os.stat(fname)
+        stamp = (os.path.abspath(fname), st.st_size, st.st_mtime)
+        with self._lock:
+            digest = self._digests.get(stamp)
+        if digest is None:
+            h = hashlib.sha1()
+            with open(fname, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+            digest = h.hexdigest()
+            with self._lock:
+                if len(self._digests) > 1024:
+                    self._digests.clear()
+                self._digests[stamp] = digest
+        return digest
+
+    def fetch(self, key, name):
+        """Copy the image cached under key to name
+
+        @return True on a hit, False if there is no such image
+        """
+        path = os.path.join(self.directory, key)
+        if not os.path.exists(path):
+            return False
+        try:
+            os.utime(path, None)    # mark as recently used
+            if os.path.exists(name):
+                os.remove(name)
+            if self.link:
+                try:
+                    os.link(path, name)
+                    return True
+                except OSError:
+                    pass
+            shutil.copyfile(path, name)
+        except (IOError, OSError):
+            # evicted by another process in the meantime
+            return False
+        return True
+
+    def store(self, key, name):
+        """Add the image rendered to name to the cache under key"""
+        if not os.path.exists(name):
+            return
+        path = os.path.join(self.directory, key)
+        tmp = "%s.%s.tmp" % (path, uuid.uuid4().hex)
+        shutil.copyfile(name, tmp)
+        os.replace(tmp, path)
+        self.evict()
+
+_default_query_cache = None
+
+
+def set_query_cache(cache):
+    """Use cache for every data_sql call that doesn't name its own
+
+    @param cache a QueryCache, or None to always run the query
+    @return the previous default cache
+    """
+    global _default_query_cache
+    prev, _default_query_cache = _default_query_cache, cache
+    return prev
+
+
+# string literals and quoted identifiers, whose whitespace must be kept
+_SQL_QUOTED_RE = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+
+
+def normalize_sql(sql):
+    """sql with runs of whitespace outside quotes collapsed and trailing
+    semicolons removed, so formatting doesn't change the QueryCache key"""
+    parts = _SQL_QUOTED_RE.split(sql.strip().rstrip(";").strip())
+    return "".join(part if i % 2 else re.sub(r"\s+", " ", part)
+                   for i, part in enumerate(parts))
+
+
+class QueryCache(_DirectoryCache):
+    """On-disk cache of data_sql query results
+
+    R runs the query once and saves the resulting data.frame with saveRDS
+    under a key made of the driver, database name and normalized SQL text.
+    Later renders of the same query readRDS the file instead of connecting
+    to the database, until it is `ttl` seconds old.
+
+      cache = QueryCache(ttl=60)
+      data = data_sql('db', 'SELECT * FROM sales', cache=cache)
+
+    @param directory where results are stored.  Shared between processes
+    @param ttl seconds a result stays valid
+    @param max_bytes total size of results to keep; oldest are deleted first
+    """
+
+    def __init__(self, directory=None, ttl=300, max_bytes=1024 ** 3):
+        _DirectoryCache.__init__(
+            self, directory or os.path.join(tempfile.gettempdir(), "pygg-query-cache"),
+            max_bytes)
+        self.ttl = ttl
+
+    def path(self, db, sql, driver=None):
+        """File holding the result of sql on db"""
+        h = hashlib.sha1()
+        for part in (driver or DEFAULT_SQL_DRIVER, db, normalize_sql(sql)):
+            h.update(part.encode('utf-8') + b"\0")
+        return os.path.join(self.directory, h.hexdigest() + ".rds")
+
+    def load(self, path, query):
+        """R expression that reads path if it is fresh, otherwise evaluates
+        the R expression query and atomically saves its result to path"""
+        return """local({
+  path = %(path)s
+  cached = NULL
+  if (file.exists(path) &&
+      as.numeric(difftime(Sys.time(), file.mtime(path), units="secs")) < %(ttl)s)
+    cached = tryCatch(readRDS(path), error=function(e) NULL)
+  if (is.null(cached)) {
+    cached = %(query)s
+    tmp = paste0(path, ".", Sys.getpid(), ".tmp")
+    saveRDS(cached, tmp)
+    file.rename(tmp, path)
+  }
+  cached
+})""" % {'path': esc(path), 'ttl': self.ttl, 'query': query}
+
+    def evict(self):
+        """Delete expired results, then the oldest ones until under max_bytes"""
+        now = time.time()
+        for path, _, mtime in self.entries():
+            if now - mtime >= self.ttl:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        _DirectoryCache.evict(self)
+
+
+###################################################
+#
+#  Transfer formats used by data_py to ship DataFrames to R.
+#  dump() writes the frame to fname and returns an R expression
+#  that evaluates to the equivalent data.frame
+#
+###################################################
+
+class CSVTransfer(object):
+    """Plain CSV file loaded with read.csv.  Slow and loses dtypes, but
+    needs nothing beyond base R"""
+    name = 'csv'
+    suffix = '.csv'
+
+    def dump(self, df, fname, *args, **kwargs):
+        df.to_csv(fname, sep=',', encoding='utf-8', index=False)
+        kwargs["sep"] = esc(',')
+        return GGStatement("read.csv", esc(fname), *args, **kwargs).r
+
+
+    def dump_chunks(self, chunks, fname, *args, **kwargs):
+        """Write an iterator of DataFrames one batch at a time"""
+        columns = None
+        with open(fname, 'w', encoding='utf-8', newline='') as f:
+            for chunk in chunks:
+                if columns is None:
+                    columns = list(chunk.columns)
+                    chunk.to_csv(f, sep=',', index=False)
+                else:
+                    chunk.reindex(columns=columns).to_csv(f, sep=',', index=False, header=False)
+        kwargs["sep"] = esc(',')
+        return GGStatement("read.csv", esc(fname), *args, **kwargs).r
+
+
+class BinaryTransfer(object):
+    """Raw little-endian column blocks loaded with base R's readBin
+
+    Columns are written one after the other.  The R loader generated by
+    dump() knows each column's type and the row count, so the file carries
+    no header and R reads every column with a single readBin call:
+
+      float                 8 byte doubles
+      int (fits in 32 bit)  4 byte integers, otherwise doubles
+      bool                  4 byte integers, converted with as.logical
+      datetime64           doubles holding seconds since the epoch (POSIXct)
+      category              factor codes plus NUL terminated level strings
+      anything else         converted to strings, stored like a category
+    """
+    name = 'binary'
+    suffix = '.bin'
+
+    INT32_MIN = -2 ** 31    # R's NA_integer_
+
+    def dump(self, df, fname, *args, **kwargs):
+        if args or kwargs:
+            raise ValueError("read.csv arguments are only supported by the csv transfer")
+        stmts = []
+        with open(fname, 'wb') as f:
+            for colname, col in df.items():
+                stmts.append("cols[[%s]] = %s" % (esc(str(colname)), self.dump_column(col, f)))
+        return """local({
+  con = file(%s, "rb")
+  on.exit(close(con))
+  n = %dL
+  cols = list()
+  %s
+  data.frame(cols, stringsAsFactors=FALSE)
+})""" % (esc(fname), len(df), "\n  ".join(stmts))
+
+    def dump_column(self, col, f):
+        """Write pandas Series col to file f, returning the R expression that reads it"""
+        dtype = col.dtype
+        if isinstance(dtype, pandas.CategoricalDtype):
+            return self.dump_factor(col.cat.codes.to_numpy(), col.cat.categories,
+                                    f, ordered=dtype.ordered)
+        if dtype.kind == 'b':
+            col.to_numpy(dtype='<i4').tofile(f)
+            return 'as.logical(%s)' % self.read_int()
+        if dtype.kind in 'iu':
+            values = col.to_numpy()
+            if len(values) == 0 or (values.min() > self.INT32_MIN and values.max() < 2 ** 31):
+                values.astype('<i4').tofile(f)
+                return self.read_int()
+            values.astype('<f8').tofile(f)
+            return self.read_double()
+        if dtype.kind == 'f':
+            col.to_numpy(dtype='<f8').tofile(f)
+            return self.read_double()
+        if dtype.kind == 'M':
+            tz = getattr(dtype, 'tz', None)
+            seconds = col.to_numpy(dtype='datetime64[ns]').astype('<i8') / 1e9
+            seconds[col.isna().to_numpy()] = numpy.nan
+            seconds.astype('<f8').tofile(f)
+            return 'as.POSIXct(%s, origin="1970-01-01", tz=%s)' % (
+                self.read_double(), esc(str(tz) if tz is not None else "UTC"))
+        if pandas.api.types.is_numeric_dtype(dtype):
+            # nullable extension types such as Int64 and Float64
+            col.astype('float64').to_numpy(dtype='<f8', na_value=numpy.nan).tofile(f)
+            return self.read_double()
+
+        codes, uniques = pandas.factorize(col)
+        return self.dump_factor(codes, [str(v) for v in uniques], f, as_factor=False)
+
+    def dump_factor(self, codes, levels, f, ordered=False, as_factor=True):
+        """Write levels then 1-based codes.  Missing values (code -1) become NA_integer_"""
+        self.write_levels(levels, f)
+        self.write_codes(codes, f)
+        return self.read_coded(len(levels), ordered, as_factor)
+
+    def write_levels(self, levels, f):
+        f.write(b"".join(str(lv).encode('utf-8') + b"\0" for lv in levels))
+
+    def write_codes(self, codes, f):
+        codes = codes.astype('<i4') + 1
+        codes[codes == 0] = self.INT32_MIN
+        codes.tofile(f)
+
+    def read_coded(self, nlevels, ordered=False, as_factor=True):
+        read_levels = 'lv = readBin(con, "character", %dL); Encoding(lv) = "UTF-8"' % nlevels
+        if not as_factor:
+            return 'local({ %s; lv[%s] })' % (read_levels, self.read_int())
+        cls = 'c("ordered", "factor")' if ordered else '"factor"'
+        return 'local({ %s; structure(%s, levels=lv, class=%s) })' % (
+            read_levels, self.read_int(), cls)
+
+    def dump_chunks(self, chunks, fname, *args, **kwargs):
+        """Write an iterator of DataFrames with bounded memory
+
+        The layout is column major but the row count is only known at the
+        end, so each column is spilled to its own file first and the spills
+        are concatenated.  Column types come from the first batch: numbers
+        and booleans are stored as doubles, datetimes as POSIXct seconds, and
+        everything else as strings with a level table that grows as new
+        values appear.
+        """
+        if args or kwargs:
+            raise ValueError("read.csv arguments are only supported by the csv transfer")
+        spill_dir = tempfile.mkdtemp(prefix="pygg-spill-", dir=os.path.dirname(fname))
+        columns, kinds, spills, levels = [], {}, {}, {}
+        n = 0
+        try:
+            for chunk in chunks:
+                if not kinds:
+                    columns = list(chunk.columns)
+                    for i, colname in enumerate(columns):
+                        kinds[colname] = self.stream_kind(chunk[colname])
+                        spills[colname] = open(os.path.join(spill_dir, str(i)), 'wb')
+                        levels[colname] = {}
+                chunk = chunk.reindex(columns=columns)
+                for colname in columns:
+                    self.spill_column(chunk[colname], kinds[colname],
+                                      levels[colname], spills[colname])
+                n += len(chunk)
+            for spill in spills.values():
+                spill.close()
+
+            stmts = []
+            with open(fname, 'wb') as f:
+                for i, colname in enumerate(columns):
+                    kind, tz = kinds[colname]
+                    if kind == 'string':
+                        self.write_levels(levels[colname], f)
+                        expr = self.read_coded(len(levels[colname]), as_factor=False)
+                    elif kind == 'logical':
+                        expr = 'as.logical(%s)' % self.read_double()
+                    elif kind == 'time':
+                        expr = 'as.POSIXct(%s, origin="1970-01-01", tz=%s)' % (
+                            self.read_double(), esc(tz))
+                    else:
+                        expr = self.read_double()
+                    with open(os.path.join(spill_dir, str(i)), 'rb') as spill:
+                        shutil.copyfileobj(spill, f)
+                    stmts.append("cols[[%s]] = %s" % (esc(str(colname)), expr))
+        finally:
+            for spill in spills.values():
+                spill.close()
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+        return """local({
+  con = file(%s, "rb")
+  on.exit(close(con))
+  n = %dL
+  cols = list()
+  %s
+  data.frame(cols, stringsAsFactors=FALSE)
+})""" % (esc(fname), n, "\n  ".join(stmts))
+
+    def stream_kind(self, col):
+        """(kind, timezone) used for column col when streaming"""
+        dtype = col.dtype
+        if pandas.api.types.is_bool_dtype(dtype):
+            return 'logical', None
+        if pandas.api.types.is_datetime64_any_dtype(dtype):
+            tz = getattr(dtype, 'tz', None)
+            return 'time', str(tz) if tz is not None else "UTC"
+        if pandas.api.types.is_numeric_dtype(dtype) and \
+                not isinstance(dtype, pandas.CategoricalDtype):
+            return 'double', None
+        return 'string', None
+
+    def spill_column(self, col, kind, levels, f):
+        """Append one batch of a column to its spill file f
+
+        @param levels dict of string -> code shared by all batches of the column
+        """
+        kind = kind[0]
+        if kind == 'time':
+            seconds = col.to_numpy(dtype='datetime64[ns]').astype('<i8') / 1e9
+            seconds[col.isna().to_numpy()] = numpy.nan
+            seconds.astype('<f8').tofile(f)
+        elif kind in ('double', 'logical'):
+            pandas.to_numeric(col.astype(object), errors='coerce').to_numpy(dtype='<f8').tofile(f)
+        else:
+            missing = col.isna().to_numpy()
+            strs = col[~missing].astype(str)
+            for value in pandas.unique(strs):
+                if value not in levels:
+                    levels[value] = len(levels)
+            codes = numpy.full(len(col), -1, dtype='<i4')
+            codes[~missing] = strs.map(levels).to_numpy()
+            self.write_codes(codes, f)
+
+    def read_int(self):
+        return 'readBin(con, "integer", n, size=4, endian="little")'
+
+    def read_double(self):
+        return 'readBin(con, "double", n, size=8, endian="little")'
+
+
+class SharedMemoryTransfer(BinaryTransfer):
+    """BinaryTransfer layout placed in POSIX shared memory (/dev/shm)
+
+    Every column is preceded by a 24 byte header that the R loader checks
+    before reading it:
+
+      8 bytes   magic "PYGGCOL" plus a NUL
+      int32     type: 1 double, 2 integer, 3 logical, 4 other (see BinaryTransfer)
+      int32     bytes per value (0 for other)
+      double    number of values
+
+    Numeric columns whose dtype already matches are written straight from
+    their buffers, and R reads them from memory with readBin, so a large
+    frame is neither converted to text nor parsed.  Falls back to the temp
+    directory where /dev/shm doesn't exist.
+
+    This saves disk I/O, not memory: the file takes RAM until it is deleted
+    and R still copies the data in, so peak memory is at least that of
+    BinaryTransfer.  DataCache files for this format are kept in /dev/shm too.
+    """
+    name = 'shm'
+    suffix = '.shm'
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+    MAGIC = b"PYGGCOL\0"
+    DOUBLE, INTEGER, LOGICAL, OTHER = 1, 2, 3, 4
+
+    def dump(self, df, fname, *args, **kwargs):
+        if args or kwargs:
+            raise ValueError("read.csv arguments are only supported by the csv transfer")
+        stmts = []
+        with open(fname, 'wb') as f:
+            for colname, col in df.items():
+                stmts.append("cols[[%s]] = %s" % (esc(str(colname)), self.dump_block(col, f)))
+        magic = ", ".join("0x%02x" % c for c in bytearray(self.MAGIC))
+        return """local({
+  con = file(%s, "rb")
+  on.exit(close(con))
+  n = %dL
+  header = function(type) {
+    if (!identical(readBin(con, "raw", 8), as.raw(c(%s))))
+      stop("corrupt pygg column file")
+    h = readBin(con, "integer", 2, size=4, endian="little")
+    len = readBin(con, "double", 1, size=8, endian="little")
+    if (h[1] != type || len != n) stop("unexpected pygg column header")
+  }
+  cols = list()
+  %s
+  data.frame(cols, stringsAsFactors=FALSE)
+})""" % (esc(fname), len(df), magic, "\n  ".join(stmts))
+
+    def write_header(self, f, type, size, n):
+        f.write(self.MAGIC)
+        numpy.array([type, size], dtype='<i4').tofile(f)
+        numpy.array([n], dtype='<f8').tofile(f)
+
+    def dump_block(self, col, f):
+        """Write column col with its header, returning the R expression that reads it"""
+        dtype = col.dtype
+        kind = dtype.kind if isinstance(dtype, numpy.dtype) else None
+        if kind == 'f':
+            self.write_header(f, self.DOUBLE, 8, len(col))
+            col.to_numpy(dtype='<f8').tofile(f)
+            return '{ header(%dL); %s }' % (self.DOUBLE, self.read_double())
+        if kind == 'b':
+            self.write_header(f, self.LOGICAL, 4, len(col))
+            col.to_numpy(dtype='<i4').tofile(f)
+            return '{ header(%dL); as.logical(%s) }' % (self.LOGICAL, self.read_int())
+        if kind in ('i', 'u'):
+            values = col.to_numpy()
+            if len(values) == 0 or (values.min() > self.INT32_MIN and values.max() < 2 ** 31):
+                self.write_header(f, self.INTEGER, 4, len(col))
+                values.astype('<i4', copy=False).tofile(f)
+                return '{ header(%dL); %s }' % (self.INTEGER, self.read_int())
+            self.write_header(f, self.DOUBLE, 8, len(col))
+            values.astype('<f8').tofile(f)
+            return '{ header(%dL); %s }' % (self.DOUBLE, self.read_double())
+        self.write_header(f, self.OTHER, 0, len(col))
+        return '{ header(%dL); %s }' % (self.OTHER, self.dump_column(col, f))
+
+
+class FeatherTransfer(object):
+    """Arrow IPC (Feather v2) file.  Needs pyarrow in python and the arrow
+    package in R"""
+    name = 'feather'
+    suffix = '.feather'
+
+    def dump(self, df, fname, *args, **kwargs):
+        if args or kwargs:
+            raise ValueError("read.csv arguments are only supported by the csv transfer")
+        try:
+            df.reset_index(drop=True).to_feather(fname)
+        except ImportError:
+            raise ValueError("the feather transfer needs pyarrow installed")
+        return "as.data.frame(arrow::read_feather(%s))" % esc(fname)
+
+
+class InlineTransfer(object):
+    """CSV text embedded in the R program itself, so no data file is written.
+    Only sensible for small to moderately sized data"""
+    name = 'inline'
+    suffix = ''
+    inline = True
+
+    def dump(self, df, fname, *args, **kwargs):
+        text = df.to_csv(sep=',', index=False)
+        text = text.replace('\\', '\\\\').replace('"', '\\"')
+        kwargs["sep"] = esc(',')
+        kwargs["text"] = '"%s"' % text
+        return GGStatement("read.csv", *args, **kwargs).r
+
+
+TRANSFER_FORMATS = {
+    'csv': CSVTransfer(),
+    'binary': BinaryTransfer(),
+    'feather': FeatherTransfer(),
+    'inline': InlineTransfer(),
+    'shm': SharedMemoryTransfer()
+}
+DEFAULT_TRANSFER = 'csv'
+
+
+def set_default_transfer(transfer):
+    """Use transfer for every data_py and ggsave call that doesn't name its own
+
+    @param transfer name in TRANSFER_FORMATS, or an object with a dump()
+        method.  None restores 'csv'
+    @return the previous default
+    """
+    global DEFAULT_TRANSFER
+    if transfer is None:
+        transfer = 'csv'
+    get_transfer(transfer)   # raises ValueError for unknown names
+    prev, DEFAULT_TRANSFER = DEFAULT_TRANSFER, transfer
+    return prev
+
+
+def get_transfer(transfer=None):
+    """Look up a transfer format by name.  None means DEFAULT_TRANSFER, and
+    objects with a dump() method are returned as is"""
+    if transfer is None:
+        transfer = DEFAULT_TRANSFER
+    if hasattr(transfer, 'dump'):
+        return transfer
+    if transfer not in TRANSFER_FORMATS:
+        raise ValueError("unknown transfer format {}.  Expected one of {}".format(
+            transfer, sorted(TRANSFER_FORMATS)))
+    return TRANSFER_FORMATS[transfer]
+
+
+###################################################
+#
+#  Aggregation pushdown.  Histograms, bar counts, summaries and 2d bins
+#  only need a few hundred aggregated rows, so compute them where the
+#  data lives and rewrite the layer to plot the result as is
+#
+###################################################
+
+_IDENTIFIER_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_.]*$")
+_FORMULA_VAR_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_.]*")
+
+# aesthetics that split the data into groups for counting and binning
+_GROUP_AES = ['fill', 'colour', 'color', 'group', 'linetype', 'alpha', 'shape']
+
+# layer name -> (aggregation kind, replacement layer name)
+_AGGREGATING_LAYERS = {
+    'geom_histogram': ('bin', 'geom_histogram'),
+    'geom_freqpoly': ('bin', 'geom_freqpoly'),
+    'stat_bin': ('bin', 'stat_identity'),
+    'geom_bar': ('count', 'geom_bar'),
+    'stat_count': ('count', 'stat_identity'),
+    'stat_summary': ('summary', 'stat_identity'),
+    'geom_bin2d': ('bin2d', 'geom_tile'),
+    'geom_bin_2d': ('bin2d', 'geom_tile'),
+    'stat_bin2d': ('bin2d', 'geom_tile'),
+    'stat_bin_2d': ('bin2d', 'geom_tile'),
+}
+
+# stat_summary functions that have an SQL equivalent
+_SQL_SUMMARIES = {'mean': 'AVG', 'sum': 'SUM', 'min': 'MIN', 'max': 'MAX', 'length': 'COUNT'}
+
+# layer arguments consumed by the aggregation itself
+_AGGREGATION_ARGS = ['stat', 'bins', 'binwidth', 'fun', 'fun.y']
+
+
+def _aes_of(stmt):
+    """Mapping of aesthetic name to column for the aes() passed to stmt
+
+    @return dict, or None if the mapping isn't a plain aes() of column names
+    """
+    mapping = stmt.kwargs.get('mapping')
+    for arg in stmt.args:
+        if isinstance(arg, GGStatement) and arg.name == 'aes':
+            mapping = arg
+    if mapping is None:
+        return {}
+    if not isinstance(mapping, GGStatement) or mapping.name != 'aes':
+        return None
+    aes = dict(zip(['x', 'y'], mapping.args))
+    aes.update(mapping.kwargs)
+    for k, v in aes.items():
+        if not isinstance(v, str) or not _IDENTIFIER_RE.match(v):
+            return None
+    return aes
+
+
+def _facet_vars(stmt):
+    """Column names referenced by a facet_wrap/facet_grid statement, or None"""
+    formulas = list(stmt.args[:1]) + [stmt.kwargs[k] for k in ('facets', 'rows', 'cols')
+                                      if k in stmt.kwargs]
+    cols = []
+    for formula in formulas:
+        if not isinstance(formula, str):
+            return None
+        cols.extend(v for v in _FORMULA_VAR_RE.findall(formula) if v not in cols)
+    return cols
+
+
+# coordinate systems that map x and y linearly onto the panel
+_LINEAR_COORDS = frozenset(['coord_cartesian', 'coord_fixed', 'coord_equal'])
+
+
+def _rescales_position(plot):
+    """Does plot transform or limit its x or y scale?  ggplot2 then bins
+    and places the data on other values than its raw, linear range"""
+    for stmt in plot.stmts:
+        if not isinstance(stmt, GGStatement):
+            continue
+        name = stmt.name
+        if name in ('xlim', 'ylim', 'lims', 'expand_limits'):
+            return True
+        if name.startswith(('scale_x_', 'scale_y_')):
+            if name.rsplit('_', 1)[1] in ('log10', 'sqrt', 'reverse'):
+                return True
+            if any(stmt.kwargs.get(k) is not None for k in ('trans', 'transform', 'limits')):
+                return True
+        if name.startswith('coord_'):
+            if name not in _LINEAR_COORDS or stmt.args:
+                return True
+            if any(stmt.kwargs.get(k) is not None for k in ('xlim', 'ylim', 'limits')):
+                return True
+    return False
+
+
+def _free_facet_scales(plot):
+    """Do plot's facets give each panel its own x or y range?"""
+    for stmt in plot.stmts:
+        if isinstance(stmt, GGStatement) and stmt.name in ('facet_wrap', 'facet_grid'):
+            scales = stmt.kwargs.get('scales')
+            if scales is not None and str(scales).strip('"\'') != 'fixed':
+                return True
+    return False
+
+
+class _AggregationPlan(object):
+    """How to pre-aggregate the data for a plot whose only layer is an
+    aggregating one (see _AGGREGATING_LAYERS), and how to rewrite that layer
+    to plot the aggregated rows with stat="identity"
+
+    Built by _plan_aggregation(), which returns None for anything else.
+    """
+
+    def __init__(self, plot, index, kind, aes, groups, data_var):
+        self.plot = plot
+        self.index = index          # position of the layer in plot.stmts
+        self.layer = plot.stmts[index]
+        self.kind = kind
+        self.x = aes.get('x')
+        self.y = aes.get('y')
+        self.groups = groups
+        self.data_var = data_var
+        kwargs = self.layer.kwargs
+        self.fun = kwargs.get('fun', kwargs.get('fun.y'))
+        self.bins = kwargs.get('bins', 30)
+        self.binwidth = kwargs.get('binwidth')
+        # name of the column holding counts; avoid clashing with the data
+        self.count = 'count' if 'count' not in [self.x, self.y] + groups else 'pygg_count'
+
+    def bins_for(self, axis):
+        """(bins, binwidth) along axis 0 (x) or 1 (y)"""
+        def pick(v):
+            return v[axis] if isinstance(v, (list, tuple)) else v
+        return pick(self.bins), pick(self.binwidth)
+
+    @property
+    def columns(self):
+        """Columns of the aggregated data, in order"""
+        cols = [self.x]
+        if self.kind == 'bin2d' or self.kind == 'summary':
+            cols.append(self.y)
+        cols.extend(self.groups)
+        if self.kind != 'summary':
+            cols.append(self.count)
+        if self.kind == 'bin':
+            cols.append('pygg_width')
+        if self.kind == 'bin2d':
+            cols.extend(['pygg_width', 'pygg_height'])
+        return cols
+
+    def rewrite(self):
+        """Copy of the plot with the aggregating layer replaced"""
+        kind, name = _AGGREGATING_LAYERS[self.layer.name]
+        layer_aes = _aes_of(self.layer)
+        kwargs = {k: v for k, v in self.layer.kwargs.items()
+                  if k not in _AGGREGATION_ARGS + ['mapping']}
+        first = "%s$pygg_width[1]" % self.data_var
+        if kind == 'bin2d':
+            layer_aes['fill'] = self.count
+            kwargs['width'] = first
+            kwargs['height'] = "%s$pygg_height[1]" % self.data_var
+        else:
+            if kind != 'summary':
+                layer_aes['y'] = self.count
+            if name == 'stat_identity':
+                kwargs['geom'] = self.layer.kwargs.get(
+                    'geom', esc('point' if kind == 'summary' else 'bar'))
+            else:
+                kwargs['stat'] = esc('identity')
+            if kind == 'bin' and name != 'geom_freqpoly':
+                kwargs['width'] = first
+        args = [GGStatement('aes', **layer_aes)] if layer_aes else []
+        layer = GGStatement(name, *args, **kwargs)
+        stmts = list(self.plot.stmts)
+        stmts[self.index] = layer
+        return GGStatements(stmts)
+
+
+def _plan_aggregation(plot):
+    """Plan pre-aggregation for plot, or None if it can't be done safely
+
+    Requires a ggplot() call on `data` mapping plain column names, exactly
+    one layer (geom_* or stat_*), which must be an aggregating layer without
+    its own data or weights, facets given as formula strings, and position
+    scales that are neither transformed nor limited.  Bins set by count
+    also require facets that share their scales.
+    """
+    plot = plot.to_stmts()
+    base = [s for s in plot.stmts if isinstance(s, GGStatement) and s.name == 'ggplot']
+    layers = [i for i, s in enumerate(plot.stmts)
+              if isinstance(s, GGStatement) and s.name.split('_')[0] in ('geom', 'stat')]
+    if len(base) != 1 or len(layers) != 1:
+        return None
+    base = base[0]
+    index = layers[0]
+    layer = plot.stmts[index]
+    if layer.name not in _AGGREGATING_LAYERS or 'data' in layer.kwargs:
+        return None
+    if len(layer.args) > 1 or 'stat' in layer.kwargs:
+        return None
+    kind = _AGGREGATING_LAYERS[layer.name][0]
+
+    if not base.args or base.args[0] != 'data' or _rescales_position(plot):
+        return None
+    base_aes = _aes_of(base)
+    layer_aes = _aes_of(layer)
+    if base_aes is None or layer_aes is None:
+        return None
+    aes = {}
+    if layer.kwargs.get('inherit.aes') not in (False, 'FALSE', 'F'):
+        aes.update(base_aes)
+    aes.update(layer_aes)
+    if 'colour' in aes and 'color' in aes:
+        return None
+    if set(aes) - set(['x', 'y'] + _GROUP_AES):
+        # weight, size and other aesthetics we can't aggregate over
+        return None
+
+    if aes.get('x') is None:
+        return None
+    if kind in ('bin2d', 'summary') and aes.get('y') is None:
+        return None
+    if kind in ('bin', 'count') and 'y' in aes:
+        return None
+    if kind == 'summary':
+        fun = layer.kwargs.get('fun', layer.kwargs.get('fun.y'))
+        if fun not in _SQL_SUMMARIES or 'fun.data' in layer.kwargs:
+            return None
+    for param in ('bins', 'binwidth'):
+        values = layer.kwargs.get(param)
+        values = values if isinstance(values, (list, tuple)) else [values]
+        if not all(v is None or (isinstance(v, (int, float)) and not isinstance(v, bool))
+                   for v in values):
+            return None
+    if set(layer.kwargs) & set(['center', 'boundary', 'breaks', 'origin', 'drop']):
+        return None
+    if kind in ('bin', 'bin2d') and layer.kwargs.get('binwidth') is None and \
+            _free_facet_scales(plot):
+        # ggplot2 splits each panel's own range into the bins
+        return None
+
+    groups = []
+    for k in _GROUP_AES:
+        if aes.get(k) and aes[k] not in groups:
+            groups.append(aes[k])
+    for stmt in plot.stmts:
+        if isinstance(stmt, GGStatement) and stmt.name in ('facet_wrap', 'facet_grid'):
+            cols = _facet_vars(stmt)
+            if cols is None:
+                return None
+            groups.extend(c for c in cols if c not in groups)
+    for col in (aes.get('x'), aes.get('y')):
+        if col in groups:
+            return None
+
+    return _AggregationPlan(plot, index, kind, aes, groups, base.args[0])
+
+
+def _sql_bin_index(col, bins, binwidth, centered):
+    """SQL expressions (index, center, width) for binning col
+
+    With a binwidth, bins are aligned to multiples of it.  With a bin count,
+    the width comes from the column's range in `table`, aliased pygg_r<col>.
+    centered bins put the first bin's center on the minimum, like
+    geom_histogram; otherwise the minimum is the first bin's left edge, like
+    geom_bin2d.
+    """
+    shift = " + 0.5" if centered else ""
+    if binwidth:
+        w = repr(float(binwidth))
+        idx = "FLOOR(%s / %s%s)" % (col, w, shift)
+        offset = "" if centered else " + 0.5"
+        return idx, "(%s%s) * %s" % (idx, offset, w), w
+    r = "pygg_r%s" % col
+    w = "%s.w" % r
+    idx = "FLOOR((%s - %s.mn) / %s%s)" % (col, r, w, shift)
+    if not centered:
+        # the maximum goes into the last bin rather than a bin of its own
+        idx = "(CASE WHEN %s >= %d THEN %d ELSE %s END)" % (idx, bins, bins - 1, idx)
+    offset = "" if centered else " + 0.5"
+    return idx, "%s.mn + (%s%s) * %s" % (r, idx, offset, w), w
+
+
+def _sql_range(col, bins, sql, centered):
+    """FROM clause item with MIN and bin width of col over sql"""
+    denom = "%d.0" % (bins - 1 if centered else bins)
+    return ("(SELECT MIN(%(c)s) AS mn, "
+            "COALESCE(NULLIF((MAX(%(c)s) - MIN(%(c)s)) / %(d)s, 0), 1) AS w "
+            "FROM (%(sql)s) AS pygg_t) AS pygg_r%(c)s") % {'c': col, 'd': denom, 'sql': sql}
+
+
+def _aggregation_sql(plan, sql):
+    """Rewrite the query sql so it returns plan's aggregated rows"""
+    sql = sql.strip().rstrip(';')
+    groups = list(plan.groups)
+    tables = ["(%s) AS pygg_t" % sql]
+    where = []
+
+    if plan.kind == 'count':
+        select = [plan.x] + groups + ["COUNT(*) AS %s" % plan.count]
+    elif plan.kind == 'summary':
+        fun = _SQL_SUMMARIES[plan.fun]
+        select = [plan.x] + groups + ["%s(%s) AS %s" % (fun, plan.y, plan.y)]
+    else:
+        axes = [plan.x] if plan.kind == 'bin' else [plan.x, plan.y]
+        centered = plan.kind == 'bin'
+        select = []
+        widths = []
+        for axis, col in enumerate(axes):
+            bins, binwidth = plan.bins_for(axis)
+            if not binwidth:
+                tables.append(_sql_range(col, bins, sql, centered))
+            _, center, w = _sql_bin_index(col, bins, binwidth, centered)
+            select.append("%s AS %s" % (center, col))
+            widths.append(w)
+            where.append("%s IS NOT NULL" % col)
+        select.extend(groups)
+        select.append("COUNT(*) AS %s" % plan.count)
+        select.append("MAX(%s) AS pygg_width" % widths[0])
+        if plan.kind == 'bin2d':
+            select.append("MAX(%s) AS pygg_height" % widths[1])
+
+    nkeys = len(select) - (1 if plan.kind in ('count', 'summary') else
+                           2 if plan.kind == 'bin' else 3)
+    q = "SELECT %s FROM %s" % (", ".join(select), ", ".join(tables))
+    if where:
+        q += " WHERE %s" % " AND ".join(where)
+    q += " GROUP BY %s" % ", ".join(str(i + 1) for i in range(nkeys))
+    return q
+
+
+def aggregate_sql(plot, data):
+    """Push the aggregation of plot's layer into the data_sql query
+
+    If plot consists of a single histogram, bar count, stat_summary (with
+    fun='mean', 'sum', 'min', 'max' or 'length') or 2d bin layer, rewrite the
+    query of data (a data_sql result) into a GROUP BY query that returns
+    the aggregated rows, and the layer into an equivalent stat="identity"
+    layer.  Bins follow ggplot2's defaults closely but not exactly.
+
+      p = ggplot('data', aes(x='price')) + geom_histogram(binwidth=100)
+      ggsave("out.pdf", p, data=data_sql('db', 'SELECT * FROM sales'), aggregate=True)
+
+    @return (plot, data), rewritten, or unchanged if plot can't be aggregated
+    """
+    if not isinstance(data, GGData) or data.sql is None:
+        return plot, data
+    plan = _plan_aggregation(plot)
+    if plan is None:
+        return plot, data
+    return plan.rewrite(), data_sql(data.db, _aggregation_sql(plan, data.sql), data.driver,
+                                    data.query_cache)
+
+
+def _np_bins(values, bins, binwidth, centered):
+    """Bin centers for the float array values, and the bin width.  Same
+    binning as _sql_bin_index"""
+    if binwidth:
+        w = float(binwidth)
+        if centered:
+            return numpy.floor(values / w + 0.5) * w, w
+        return (numpy.floor(values / w) + 0.5) * w, w
+    mn, mx = values.min(), values.max()
+    w = (mx - mn) / float(bins - 1 if centered else bins) or 1.0
+    if centered:
+        return mn + numpy.floor((values - mn) / w + 0.5) * w, w
+    idx = numpy.minimum(numpy.floor((values - mn) / w), bins - 1)
+    return mn + (idx + 0.5) * w, w
+
+
+def aggregate_df(plot, df):
+    """Aggregate a python dataset for plot's layer before shipping it to R
+
+    The python counterpart of aggregate_sql: for the same kinds of layers,
+    bin, count or summarize df with vectorized pandas/NumPy operations and
+    rewrite the layer into an equivalent stat="identity" layer, so only the
+    aggregated rows are written out.
+
+      p = ggplot(df, aes(x='latency')) + geom_histogram(bins=100)
+      ggsave("out.pdf", p, aggregate=True)
+
+    @param df pandas DataFrame, or a dict/list data_py accepts
+    @return (plot, data), rewritten, or unchanged if plot can't be aggregated
+    """
+    plan = _plan_aggregation(plot)
+    if plan is None:
+        return plot, df
+    frame = df if is_pandas_df(df) else pandas.DataFrame(df)
+    needed = [c for c in [plan.x, plan.y] + plan.groups if c is not None]
+    if any(c not in frame.columns for c in needed):
+        return plot, df
+
+    if plan.kind == 'count':
+        agg = frame.groupby([plan.x] + plan.groups, dropna=False, sort=False).size()
+        agg = agg.reset_index(name=plan.count)
+    elif plan.kind == 'summary':
+        fun = 'count' if plan.fun == 'length' else plan.fun
+        agg = frame.groupby([plan.x] + plan.groups, dropna=False, sort=False)[plan.y].agg(fun)
+        agg = agg.reset_index()
+    else:
+        axes = [plan.x] if plan.kind == 'bin' else [plan.x, plan.y]
+        if not all(pandas.api.types.is_numeric_dtype(frame[c]) and
+                   not pandas.api.types.is_bool_dtype(frame[c]) for c in axes):
+            return plot, df
+        frame = frame.dropna(subset=axes)
+        if len(frame) == 0:
+            return plot, df
+        binned = frame[plan.groups].copy()
+        widths = []
+        for axis, col in enumerate(axes):
+            bins, binwidth = plan.bins_for(axis)
+            binned[col], w = _np_bins(frame[col].to_numpy(dtype=float), bins, binwidth,
+                                      plan.kind == 'bin')
+            widths.append(w)
+        agg = binned.groupby(axes + plan.groups, dropna=False, sort=False).size()
+        agg = agg.reset_index(name=plan.count)
+        agg['pygg_width'] = widths[0]
+        if plan.kind == 'bin2d':
+            agg['pygg_height'] = widths[1]
+
+    return plan.rewrite(), agg[plan.columns]
+
+
+###################################################
+#
+#  Downsampling of overplotted point and line layers.  Rows that land on
+#  the same output pixel are indistinguishable, so drop them in python
+#
+###################################################
+
+# layers downsample() knows how to thin out
+_DOWNSAMPLE_LAYERS = {'geom_point': 'point', 'geom_line': 'line'}
+
+
+def _output_pixels(kwargs):
+    """(width, height) in pixels of the image ggsave kwargs describe"""
+    units = str(kwargs.get('units', 'in')).strip('"\'')
+    dpi = kwargs.get('dpi', 300)
+    if not isinstance(dpi, (int, float)):
+        dpi = 300
+    per_unit = {'in': dpi, 'cm': dpi / 2.54, 'mm': dpi / 25.4, 'px': 1}.get(units, dpi)
+    scale = kwargs.get('scale', 1)
+    return (int(kwargs.get('width', 10) * scale * per_unit),
+            int(kwargs.get('height', 8) * scale * per_unit))
+
+
+def _pixel_index(values, npixels):
+    """Map a float array of finite values onto npixels equal buckets over
+    its range"""
+    if not len(values):
+        return numpy.zeros(0, dtype='int64')
+    mn, mx = values.min(), values.max()
+    if mx <= mn:
+        return numpy.zeros(len(values), dtype='int64')
+    return numpy.floor((values - mn) / (mx - mn) * (npixels - 1)).astype('int64')
+
+
+def _cell_codes(frame, keys, *pixels):
+    """Single int64 code per row identifying its keys and pixel coordinates"""
+    codes = numpy.zeros(len(frame), dtype='int64')
+    for col in keys:
+        col_codes, uniques = pandas.factorize(frame[col])
+        codes = codes * (len(uniques) + 1) + col_codes + 1
+    for px, npixels in pixels:
+        codes = codes * (npixels + 1) + px
+    return codes
+
+
+def _downsample_points(frame, x, y, keys, width, height):
+    """Index of the first row for every distinct (pixel, keys)"""
+    codes = _cell_codes(frame, keys,
+                        (_pixel_index(frame[x].to_numpy(dtype=float), width), width),
+                        (_pixel_index(frame[y].to_numpy(dtype=float), height), height))
+    _, first = numpy.unique(codes, return_index=True)
+    return frame.index[first]
+
+
+def _group_extremes(codes, values):
+    """Positions of the smallest and largest value for every distinct code"""
+    order = numpy.lexsort((values, codes))
+    sorted_codes = codes[order]
+    starts = numpy.flatnonzero(numpy.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    ends = numpy.r_[starts[1:] - 1, len(order) - 1]
+    return order[starts], order[ends]
+
+
+def _downsample_lines(frame, x, y, keys, width):
+    """Index of the first, last, lowest and highest point of every line
+    (keys) within every pixel column"""
+    xs = frame[x].to_numpy(dtype=float)
+    codes = _cell_codes(frame, keys, (_pixel_index(xs, width), width))
+    positions = numpy.concatenate(_group_extremes(codes, xs) +
+                                  _group_extremes(codes, frame[y].to_numpy(dtype=float)))
+    return frame.index[numpy.unique(positions)]
+
+
+def downsample(plot, df, width, height):
+    """Drop rows of df that can't be told apart in a width x height pixel image
+
+    Applies to plots whose layers are all geom_point or geom_line over
+    numeric x and y columns, with position scales that are neither
+    transformed nor limited and facets that share them.  Rows with a missing
+    or infinite x or y are kept as they are.  Points keep one row per output pixel, and lines
+    keep the first, last, minimum and maximum points per pixel column, so
+    their visible shape is preserved.  Rows are only merged if every other
+    mapped aesthetic (color, group, size, ...) and facet variable match.
+
+      p = ggplot(df, aes(x='time', y='value', color='host')) + geom_line()
+      ggsave("out.png", p, downsample=True)
+
+    @param df pandas DataFrame, or a dict/list data_py accepts
+    @param width, height size of the output in pixels
+    @return df with the redundant rows removed, or df itself if the plot
+        isn't supported
+    """
+    plot = plot.to_stmts()
+    base = [stmt for stmt in plot.stmts if isinstance(stmt, GGStatement) and stmt.name == 'ggplot']
+    layers = [stmt for stmt in plot.stmts
+              if isinstance(stmt, GGStatement) and stmt.name.split('_')[0] in ('geom', 'stat')]
+    if len(base) != 1 or not layers or _rescales_position(plot) or _free_facet_scales(plot):
+        return df
+    base_aes = _aes_of(base[0])
+    if base_aes is None:
+        return df
+
+    facets = []
+    for stmt in plot.stmts:
+        if isinstance(stmt, GGStatement) and stmt.name in ('facet_wrap', 'facet_grid'):
+            cols = _facet_vars(stmt)
+            if cols is None:
+                return df
+            facets.extend(cols)
+
+    frame = df if is_pandas_df(df) else pandas.DataFrame(df)
+    if not isinstance(frame.index, pandas.RangeIndex):
+        frame = frame.reset_index(drop=True)
+    keep = None
+    for layer in layers:
+        kind = _DOWNSAMPLE_LAYERS.get(layer.name)
+        layer_aes = _aes_of(layer)
+        if kind is None or layer_aes is None or 'data' in layer.kwargs or len(layer.args) > 1:
+            return df
+        aes = dict(base_aes)
+        if layer.kwargs.get('inherit.aes') in (False, 'FALSE', 'F'):
+            aes = {}
+        aes.update(layer_aes)
+        x, y = aes.get('x'), aes.get('y')
+        keys = sorted(set(v for k, v in aes.items() if k not in ('x', 'y')) | set(facets))
+        if any(c not in frame.columns for c in [x, y] + keys):
+            return df
+        if not all(pandas.api.types.is_numeric_dtype(frame[c]) for c in (x, y)):
+            return df
+
+        # rows without a finite position are left for ggplot2 to drop or to
+        # break lines at, and don't take part in binning
+        finite = numpy.isfinite(frame[x].to_numpy(dtype=float)) & \
+            numpy.isfinite(frame[y].to_numpy(dtype=float))
+        rows = frame[finite]
+        if kind == 'point':
+            idx = _downsample_points(rows, x, y, keys, width, height)
+        else:
+            idx = _downsample_lines(rows, x, y, keys, width)
+        idx = idx.union(frame.index[~finite])
+        keep = idx if keep is None else keep.union(idx)
+
+    if len(keep) == len(frame):
+        return df
+    return frame.loc[keep.sort_values()]
+
+
+###################################################
+#
+#  Column pruning.  Wide tables are mostly columns the plot never looks
+#  at, so only export the ones its R code can refer to
+#
+###################################################
+
+# backquoted names, string literals and bare R identifiers
+_R_NAME_RE = re.compile(r"""`([^`]+)`|"((?:[^"\\]|\\.)*)"|'((?:[^'\\]|\\.)*)'|([A-Za-z_.][A-Za-z0-9_.]*)""")
+
+
+def referenced_columns(plot, *r_code):
+    """Names that the plot, or the extra R code strings, may use as columns
+
+    Collects every identifier, backquoted name and string literal in the
+    plot's R expression -- the arguments of aes(), facet_*(), group and so
+    on -- so expressions like aes(x=log(a), y=b / c) and aes_string("d")
+    keep all of a, b, c and d.  Pass prefix/postfix/custom_stmts code as
+    r_code so the columns it uses are kept too.
+
+    Code that uses the `data` frame as a whole -- names(data) = ...,
+    data[[i]], ncol(data), transform(data, ...) -- may need every column, so
+    `data` is only allowed as ggplot()'s first argument, before $, or as the
+    target of an assignment or argument name.
+
+    @return set of names, or None if the code uses `data` as a whole
+    """
+    text = "\n".join([plot.r] + [code for code in r_code if code])
+    names = set()
+    for m in _R_NAME_RE.finditer(text):
+        name = next(g for g in m.groups() if g is not None)
+        if m.group(4) == 'data' and not _is_column_use_of_data(text, m.start(), m.end()):
+            return None
+        names.add(name)
+    return names
+
+
+def _is_column_use_of_data(text, start, end):
+    """Is the bare `data` at text[start:end] a use that needs no whole frame?"""
+    before, after = text[:start].rstrip(), text[end:]
+    return before.endswith("ggplot(") or re.match(r"\s*(\$|=(?!=))", after) is not None
+
+
+_R_RESERVED = frozenset([
+    "if", "else", "repeat", "while", "function", "for", "next", "break",
+    "TRUE", "FALSE", "NULL", "Inf", "NaN", "NA", "NA_integer_", "NA_real_",
+    "NA_character_", "NA_complex_", "in"])
+
+
+def r_make_name(name):
+    """The column name R uses for name after read.csv or data.frame, which
+    apply make.names(): "Sepal Length" becomes Sepal.Length and 0 becomes X0"""
+    name = re.sub(r"[^\w.]", ".", str(name))
+    if not re.match(r"[^\W\d_]|\.(?!\d)", name):
+        name = "X" + name
+    if name in _R_RESERVED:
+        name += "."
+    return name
+
+
+def prune_columns(data, names, keep=None):
+    """Drop the columns of data that aren't in names or keep
+
+    @param data pandas DataFrame, a dict/list data_py accepts, or an iterator
+        of rows or DataFrame chunks (see data_py)
+    @param names column names to export, e.g. from referenced_columns().  A
+        column is exported if names holds either its own name or the one R
+        gives it (see r_make_name).  None exports every column
+    @param keep list of extra columns to always export
+    @return data restricted to those columns.  data itself if nothing would
+        be dropped, or if no column is referenced at all
+    """
+    if names is None:
+        return data
+    names = set(names) | set(keep or [])
+
+    def select(frame):
+        cols = [c for c in frame.columns
+                if str(c) in names or r_make_name(c) in names]
+        if not cols or len(cols) == len(frame.columns):
+            return frame
+        return frame[cols]
+
+    if is_stream(data):
+        return (select(chunk) for chunk in _iter_chunks(data, STREAM_BATCH_ROWS))
+    frame = data if is_pandas_df(data) else pandas.DataFrame(data)
+    pruned = select(frame)
+    return data if pruned is frame else pruned
 
 
 ###################################################
@@ -242,6 +2318,16 @@ def facet_grid(formula, *args, **kwargs):
 ###################################################
 
 
+# keywords ggsave handles in python rather than passing on to R's ggsave
+_GGSAVE_OPTIONS = ["prefix", "quiet", "postfix", 'libs', 'backend', 'transfer',
+                   'data_cache', 'render_cache', 'aggregate', 'downsample', 'prune',
+                   'keep_columns', 'on_timing', 'on_result', 'custom_stmts']
+
+# ggsave options that don't apply to a program rendering several plots
+_GGSAVE_MANY_UNSUPPORTED = ['render_cache', 'aggregate', 'downsample',
+                            'on_timing', 'on_result']
+
+
 def ggsave(name, plot, data=None, *args, **kwargs):
     """Save a GGStatements object to destination name
 
@@ -256,6 +2342,32 @@ def ggsave(name, plot, data=None, *args, **kwargs):
       postfix: string containing R code to run after data is loaded (e.g., if you want to rename variable names)
       custom_stmts: a string containing R code to run after the ggplot object has been created, but before ggsave
       quiet:  if Truthy, don't print out R program string
+      transfer: format used to ship python data objects to R (see data_py)
+      data_cache: DataCache used to reuse files for unchanged python data
+      render_cache: RenderCache used to skip R when the same program was
+        already rendered.  Defaults to the cache set with set_render_cache()
+      aggregate: if Truthy, compute histograms, counts, summaries and 2d bins
+        in the data_sql query or in python instead of in R (see aggregate_sql
+        and aggregate_df).  Ignored with prefix, postfix or custom_stmts,
+        which may change the columns or scales
+      downsample: if Truthy, drop points and line vertices of python data
+        that would land on the same pixel of the output (see downsample).
+        Ignored with prefix, postfix or custom_stmts, like aggregate
+      prune: if True (the default), only export the columns of python data
+        that the plot, prefix, postfix or custom_stmts refer to (see
+        referenced_columns).  Every column is exported if that code uses
+        `data` as a whole, e.g. names(data) = ...
+      keep_columns: list of columns to export even if pruning would drop them
+      backend: object used to run the program (e.g., an RWorkerPool or
+        EmbeddedRBackend).  Defaults to the backend set with
+        set_default_backend(), else a new R subprocess per call
+      on_result: function called with the RenderResult of running R, with
+        the output file and its size filled in.  Not called when the image
+        comes from the render cache.  If R fails, ggsave raises an RError
+        that points at the failing statement instead
+      on_timing: function called with a RenderTiming of this call.  Hooks
+        added with add_timing_hook() receive it too.  Either one makes the
+        R program record when it finishes each stage
 
     """
     # constants
@@ -264,8 +2376,9 @@ def ggsave(name, plot, data=None, *args, **kwargs):
         'height': 8,
         'scale': 1
     }
-    keys_to_rm = ["prefix", "quiet", "postfix", 'libs']
+    keys_to_rm = _GGSAVE_OPTIONS
     varname = 'p'
+    timing = RenderTiming(name)
 
     # process arguments
     prefix = kwargs.get('prefix', '')
@@ -274,6 +2387,20 @@ def ggsave(name, plot, data=None, *args, **kwargs):
     libs = kwargs.get('libs', [])
     libs = '\n'.join(["library(%s)" % lib for lib in libs])
     quiet = kwargs.get("quiet", False)
+    backend = kwargs.get("backend")
+    transfer = kwargs.get("transfer")
+    data_cache = kwargs.get("data_cache")
+    aggregate = kwargs.get("aggregate")
+    do_downsample = kwargs.get("downsample")
+    prune = kwargs.get("prune", True)
+    keep_columns = kwargs.get("keep_columns")
+    render_cache = kwargs.get("render_cache")
+    if render_cache is None:
+        render_cache = _default_render_cache
+    on_result = kwargs.get("on_result")
+    hooks = list(_timing_hooks)
+    if kwargs.get("on_timing") is not None:
+        hooks.append(kwargs["on_timing"])
     kwargs = {k: v for k, v in kwargs.items()
               if v is not None and k not in keys_to_rm}
     kwdefaults.update(kwargs)
@@ -281,42 +2408,492 @@ def ggsave(name, plot, data=None, *args, **kwargs):
 
     # figure out how to load data in the R environment
     if data is None: data = plot.data
+    if aggregate and not (prefix or postfix or custom_stmts):
+        if isinstance(data, GGData):
+            plot, data = aggregate_sql(plot, data)
+        elif data is not None and not isinstance(data, str) and not is_stream(data):
+            plot, data = aggregate_df(plot, data)
+    if prune and data is not None and not isinstance(data, (str, GGData)):
+        names = referenced_columns(plot, prefix, postfix, custom_stmts)
+        data = prune_columns(data, names, keep_columns)
+    if do_downsample and not (prefix or postfix or custom_stmts) and \
+            data is not None and not isinstance(data, (str, GGData)) and not is_stream(data):
+        data = downsample(plot, data, *_output_pixels(kwargs))
+    timing.mark('prepare')
+
+    # backends such as EmbeddedRBackend take python data in memory
+    runner = backend if backend is not None else _default_backend
+    frame = None
+    if getattr(runner, 'accepts_data', False) and data is not None and \
+            not isinstance(data, (str, GGData)) and not is_stream(data):
+        frame = data if is_pandas_df(data) else pandas.DataFrame(data)
+        ggdata = None
+    else:
+        ggdata = _load_data(data, transfer, data_cache)
+    data_src = str(ggdata) if ggdata is not None else ''
+    timing.mark('data')
+
+    # statements grouped by the stage of RenderTiming they belong to
+    sections = [
+        ('r_libs', ["library(ggplot2)", libs]),
+        ('r_data', [data_src, prefix, postfix]),
+        ('r_plot', ["%s = %s" % (varname, plot.r), custom_stmts]),
+    ]
+    if name:
+        stmt = GGStatement("ggsave", esc(name), varname, *args, **kwargs)
+        sections.append(('r_save', [stmt.r]))
+    prog = "\n".join(code for _, codes in sections for code in codes if code)
+    timing.mark('program')
+
+    if not quiet:
+        print(prog)
+        print()
+
+    if name:
+        # the data file is pinned until R has read it, so files created
+        # meanwhile can't collect it.  Files written for this render are then
+        # deleted, unless a DataCache pinned them too.  Without a name the
+        # caller runs prog later, so they stay until the workspace collects them
+        workspace = get_workspace()
+        data_fname = ggdata.fname if ggdata is not None else None
+        if data_fname:
+            workspace.pin(data_fname)
+        try:
+            key = None
+            fingerprint = DataCache.fingerprint(frame) if frame is not None else None
+            if render_cache is not None and (frame is None or fingerprint is not None):
+                key = render_cache.key(prog, name, ggdata, fingerprint)
+                hit = render_cache.fetch(key, name)
+                timing.mark('cache')
+                if hit:
+                    timing.cached = True
+                    _report_timing(timing, hooks)
+                    return prog
+
+            markers = workspace.new_file('.tsv', pin=True) if hooks else None
+            run_prog = _with_timing_markers(sections, markers) if markers else prog
+            try:
+                if frame is not None:
+                    result = runner.execute(run_prog, quiet, data=frame)
+                else:
+                    result = execute_r(run_prog, quiet, backend=backend)
+                timing.mark('r')
+                if markers:
+                    timing.add_r_stages(markers)
+            except RError as e:
+                if run_prog is prog:
+                    raise
+                # locate the failing statement in prog, not the instrumented program
+                raise RError(prog, e.result) from None
+            finally:
+                if markers:
+                    workspace.unpin(markers)
+                    workspace.release(markers)
+            if key is not None:
+                render_cache.store(key, name)
+                timing.mark('cache')
+            if on_result is not None:
+                if result is None:
+                    # backends aren't required to return a RenderResult
+                    result = RenderResult(0, elapsed=timing.stages['r'])
+                result.output = name
+                result.output_size = os.path.getsize(name) if os.path.exists(name) else None
+                on_result(result)
+        finally:
+            if data_fname:
+                workspace.unpin(data_fname)
+                if not isinstance(data, (str, GGData)):
+                    workspace.release(data_fname)
+    _report_timing(timing, hooks)
+    return prog
+
+
+###################################################
+#
+#  Timing of the stages of a ggsave call
+#
+###################################################
+
+_timing_hooks = []
+
+
+def add_timing_hook(hook):
+    """Call hook with the RenderTiming of every ggsave call, e.g. to
+    forward them to a metrics system
+
+    @return hook
+    """
+    _timing_hooks.append(hook)
+    return hook
+
+
+def remove_timing_hook(hook):
+    _timing_hooks.remove(hook)
+
+
+def _report_timing(timing, hooks):
+    for hook in hooks:
+        hook(timing)
+
+
+class RenderTiming(object):
+    """Seconds spent in each stage of a ggsave call
+
+    @ivar name output file name
+    @ivar stages OrderedDict of stage name -> seconds, in the order they ran.
+        Stages that didn't run are missing
+      prepare: aggregation, column pruning and downsampling in python
+      data: exporting python data (data_py), or converting it for a backend
+        that takes it in memory
+      program: generating the R program
+      cache: render cache lookup and store
+      r: running the program, as seen from python.  Split by the times R
+        reaches the end of each group of statements (from proc.time()) into
+        r_libs: loading ggplot2 and libs
+        r_data: loading `data`, then prefix and postfix
+        r_plot: evaluating the plot expression and custom_stmts
+        r_save: ggsave, which builds the plot and writes the file
+        r_overhead: the rest of r, mostly starting R and parsing the program
+    @ivar cached True if the image came from the render cache
+    """
+
+    PYTHON_STAGES = ('prepare', 'data', 'program', 'cache', 'r')
+
+    def __init__(self, name=None):
+        self.name = name
+        self.stages = collections.OrderedDict()
+        self.cached = False
+        self._last = time.time()
+
+    def mark(self, stage):
+        """Charge the time since the previous mark to stage"""
+        now = time.time()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self._last
+        self._last = now
+
+    def add_r_stages(self, fname):
+        """Read the stage durations R wrote to fname, if R got as far as
+        writing it"""
+        measured = 0.0
+        if not os.path.exists(fname):
+            return
+        with open(fname) as f:
+            for line in f:
+                fields = line.split("\t")
+                if len(fields) >= 2:
+                    self.stages[fields[0]] = float(fields[1])
+                    measured += float(fields[1])
+        if 'r' in self.stages:
+            self.stages['r_overhead'] = max(self.stages['r'] - measured, 0.0)
 
+    @property
+    def total(self):
+        """Seconds spent in the ggsave call"""
+        return sum(v for k, v in self.stages.items() if k in self.PYTHON_STAGES)
+
+    def __repr__(self):
+        return "RenderTiming(%s)" % ", ".join(
+            "%s=%.3f" % item for item in self.stages.items())
+
+
+def _with_timing_markers(sections, fname):
+    """R program of the (stage, statements) sections that appends each
+    stage's duration to fname when it finishes"""
+    lines = [""".pygg_timing = local({
+  t = proc.time()[["elapsed"]]
+  function(stage) {
+    now = proc.time()[["elapsed"]]
+    cat(stage, now - t, "\\n", sep="\\t", file=%s, append=TRUE)
+    t <<- now
+  }
+})""" % esc(fname)]
+    for stage, codes in sections:
+        lines.extend(code for code in codes if code)
+        lines.append('.pygg_timing("%s")' % stage)
+    return "\n".join(lines)
+
+
+def _load_data(data, transfer=None, cache=None):
+    """Wrap data in a GGData that loads it into the `data` variable
+
+    @return None if data is None, i.e., the data source is already present in R
+    """
     if data is None:
-        # Don't load anything, the data source is already present in R
-        data_src = ''
+        return None
     elif isinstance(data, str) and 'RPostgreSQL' in data:
         # Hack to allow through data_sql results
-        data_src = data
+        return GGData(data)
     elif isinstance(data, GGData):
-        data_src = str(data)
+        return data
     else:
         # format the python data object
-        data_src = str(data_py(data))
-
-    stmts = [
-        "library(ggplot2)",
-        libs,
-        data_src,
-        prefix,
-        postfix,
-        "%s = %s" % (varname, plot.r),
-        custom_stmts
-    ]
-    stmts = filter(bool, stmts)
-    prog = "\n".join(stmts)
-
-    if name:
-        stmt = GGStatement("ggsave", esc(name), varname, *args, **kwargs)
-        prog = "%s\n%s" % (prog, stmt.r)
+        return data_py(data, transfer=transfer, cache=cache)
+
+
+def ggsave_many(plots, data=None, *args, **kwargs):
+    """Save several GGStatements objects using a single R program
+
+    Each distinct dataset is loaded once, and every plot is rendered inside
+    its own tryCatch() so one broken plot doesn't prevent the others from
+    being saved.
+
+      results = ggsave_many([
+          ("scatter.pdf", p + geom_point()),
+          ("smooth.png", p + geom_smooth(), dict(width=4, height=3)),
+      ], data=df)
+
+    @param plots list of (name, plot) or (name, plot, kwargs) tuples.  The
+        per-plot kwargs are passed to R's ggsave, except for `data` (overrides
+        the shared data) and `custom_stmts`
+    @param data python data object or GGData shared by plots that don't
+        carry their own data (see ggplot())
+    @param kwargs same as ggsave(), except for render_cache, aggregate,
+        downsample, on_timing and on_result.  prefix, libs and quiet apply to
+        the whole program, and the rest are defaults for every plot's ggsave
+        call
+    @return list of (name, error) tuples in input order.  error is None if
+        the plot was saved, otherwise R's error message
+    @raises ValueError if the shared part of the program (libraries, data
+        loading, prefix) fails, or if given an option it doesn't support
+    """
+    keys_to_rm = _GGSAVE_OPTIONS
+    varname = 'p'
 
+    prefix = kwargs.get('prefix', '')
+    postfix = kwargs.get('postfix', '')
+    custom_stmts = kwargs.get('custom_stmts')
+    libs = kwargs.get('libs', [])
+    libs = '\n'.join(["library(%s)" % lib for lib in libs])
+    quiet = kwargs.get("quiet", False)
+    backend = kwargs.get("backend")
+    defaults = {k: v for k, v in kwargs.items()
+                if v is not None and k not in keys_to_rm}
+
+    plots = [tuple(item) + ({},) * (3 - len(item)) for item in plots]
+    # per-plot kwargs only take R's ggsave arguments, data and custom_stmts
+    unsupported = [k for k in _GGSAVE_MANY_UNSUPPORTED if kwargs.get(k) is not None]
+    for _, _, plot_kwargs in plots:
+        unsupported.extend(k for k in plot_kwargs if k in keys_to_rm and k != 'custom_stmts')
+    if unsupported:
+        raise ValueError("ggsave_many doesn't support %s" % ", ".join(sorted(set(unsupported))))
+    workspace = get_workspace()
+    status_fname = workspace.new_file('.tsv', pin=True)
+
+    # load each distinct dataset once, keyed by the identity of its python object
+    datasets = {}
+    dataset_objs = []
+    dataset_names = []
+    plot_datasets = []
+    for _, plot, plot_kwargs in plots:
+        d = plot_kwargs.get('data', data)
+        if d is None: d = plot.data
+        if d is None:
+            plot_datasets.append(None)
+            continue
+        if id(d) not in datasets:
+            datasets[id(d)] = len(dataset_objs)
+            dataset_objs.append(d)
+            dataset_names.append(referenced_columns(GGStatements(), prefix, postfix))
+        idx = datasets[id(d)]
+        names = referenced_columns(plot, plot_kwargs.get('custom_stmts', custom_stmts))
+        if names is None or dataset_names[idx] is None:
+            dataset_names[idx] = None
+        else:
+            dataset_names[idx] |= names
+        plot_datasets.append(idx)
+
+    data_srcs = []
+    pinned = [status_fname]   # until R has run, see ggsave
+    owned = [status_fname]    # released once R has run
+    for d, names in zip(dataset_objs, dataset_names):
+        if kwargs.get('prune', True) and not isinstance(d, (str, GGData)):
+            d = prune_columns(d, names, kwargs.get('keep_columns'))
+        ggdata = _load_data(d, kwargs.get('transfer'), kwargs.get('data_cache'))
+        if ggdata is not None and ggdata.fname:
+            workspace.pin(ggdata.fname)
+            pinned.append(ggdata.fname)
+            if not isinstance(d, (str, GGData)):
+                owned.append(ggdata.fname)
+        data_srcs.append(str(ggdata))
+    # a plot without data must not see another plot's data
+    shared = len(data_srcs) == 1 and None not in plot_datasets
+
+    stmts = ["library(ggplot2)", libs]
+    if shared:
+        stmts.append(data_srcs[0])
+    else:
+        for i, data_src in enumerate(data_srcs):
+            stmts.append("%s\n.pygg_data_%d = data" % (data_src, i))
+    stmts.append(prefix)
+    if shared:
+        stmts.append(postfix)
+
+    for i, ((name, plot, plot_kwargs), data_idx) in enumerate(zip(plots, plot_datasets)):
+        save_kwargs = {'width': 10, 'height': 8, 'scale': 1}
+        save_kwargs.update(defaults)
+        save_kwargs.update({k: v for k, v in plot_kwargs.items()
+                            if v is not None and k not in ('data', 'custom_stmts')})
+        block = []
+        if not shared and data_idx is not None:
+            block.extend(["data = .pygg_data_%d" % data_idx, postfix])
+        elif not shared and data_srcs:
+            block.append('if (exists("data", inherits=FALSE)) rm(data)')
+        block.extend([
+            "%s = %s" % (varname, plot.r),
+            plot_kwargs.get('custom_stmts', custom_stmts),
+            GGStatement("ggsave", esc(name), varname, *args, **save_kwargs).r,
+            'cat(%d, "OK\\n", sep="\\t", file=%s, append=TRUE)' % (i, esc(status_fname))
+        ])
+        stmts.append("""tryCatch({
+%s
+}, error=function(e) {
+  cat(%d, "ERR", gsub("[\\t\\n]", " ", conditionMessage(e)), "\\n",
+      sep="\\t", file=%s, append=TRUE)
+})""" % ("\n".join(filter(bool, block)), i, esc(status_fname)))
+
+    prog = "\n".join(filter(bool, stmts))
     if not quiet:
         print(prog)
         print()
 
-    if name:
-        execute_r(prog, quiet)
-    return prog
+    try:
+        execute_r(prog, quiet, backend=backend)
+        errors = {}
+        if os.path.exists(status_fname):
+            with open(status_fname) as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    errors[int(fields[0])] = fields[2].strip() if fields[1] == "ERR" else None
+    finally:
+        for fname in pinned:
+            workspace.unpin(fname)
+        for fname in owned:
+            workspace.release(fname)
+
+    return [(name, errors.get(i, "plot was not rendered"))
+            for i, (name, _, _) in enumerate(plots)]
+
+
+###################################################
+#
+#  Concurrent rendering.  ggsave blocks until R exits, so run it on a
+#  bounded thread pool and hand out futures
+#
+###################################################
+
+RENDER_CONCURRENCY = os.cpu_count() or 4   # renders submit() runs at once
+_render_executor = None
+_render_executor_lock = threading.Lock()
+
+
+def set_render_concurrency(n):
+    """Limit submit() and ggsave_async() to n concurrent renders
+
+    Renders already submitted keep running on the previous thread pool.
+    """
+    global RENDER_CONCURRENCY, _render_executor
+    with _render_executor_lock:
+        RENDER_CONCURRENCY = n
+        executor, _render_executor = _render_executor, None
+    if executor is not None:
+        executor.shutdown(wait=False)
+
+
+def _get_render_executor():
+    global _render_executor
+    with _render_executor_lock:
+        if _render_executor is None:
+            _render_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=RENDER_CONCURRENCY, thread_name_prefix="pygg-render")
+        return _render_executor
+
+
+def submit(name, plot, data=None, *args, **kwargs):
+    """Run ggsave in the background
+
+    Takes the same arguments as ggsave.  At most RENDER_CONCURRENCY renders
+    run at once (see set_render_concurrency); combine with an RWorkerPool
+    backend to also skip R startup.
+
+      futures = [submit("%s.png" % k, p, data=df) for k, p in plots.items()]
+      for f in concurrent.futures.as_completed(futures):
+          f.result()  # raises ValueError if R failed
+
+    @return concurrent.futures.Future whose result is ggsave's return value
+    """
+    return _get_render_executor().submit(ggsave, name, plot, data, *args, **kwargs)
+
+
+async def ggsave_async(name, plot, data=None, *args, **kwargs):
+    """asyncio version of ggsave
+
+    Takes the same arguments as ggsave and runs it on the thread pool used by
+    submit(), so the event loop keeps running while R renders.
+
+      await asyncio.gather(ggsave_async("a.png", p1), ggsave_async("b.png", p2))
+
+    @raises ValueError if R fails
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _get_render_executor(),
+        functools.partial(ggsave, name, plot, data, *args, **kwargs))
+
+
+PartitionResult = collections.namedtuple('PartitionResult', ['key', 'name', 'seconds', 'error'])
+
+
+def ggsave_partitions(df, by, plot, name, processes=None, *args, **kwargs):
+    """Render one plot per partition of a DataFrame in parallel
+
+    Splits df with df.groupby(by), writes each partition's data once, and
+    renders the partitions concurrently on a pool of `processes` R workers.
+    Each partition goes through ggsave like any DataFrame, so it is pruned
+    to the columns the plot uses and its file is deleted after rendering.
+
+      p = ggplot('data', aes(x='day', y='revenue')) + geom_line()
+      results = ggsave_partitions(df, 'tenant', p, "reports/{key}.png", processes=32)
+      for r in results:
+          print(r.name, r.seconds, r.error)
+
+    @param by column name or list of column names to split on
+    @param plot GGStatements rendered for every partition, or a function
+        f(key, partition) that returns one.  The partition is loaded into the
+        `data` variable in R
+    @param name output file name format string; {key} is replaced by the
+        partition key.  Or a function f(key) that returns the file name
+    @param processes number of concurrent renders and R workers.  Defaults to
+        RENDER_CONCURRENCY
+    @param kwargs same as ggsave.  quiet defaults to True.  If backend is given
+        it is used instead of a new RWorkerPool
+    @return list of PartitionResult(key, name, seconds, error) in partition
+        order.  error is None on success, otherwise the error message
+    """
+    processes = processes or RENDER_CONCURRENCY
+    kwargs.setdefault('quiet', True)
+    pool = None
+    if kwargs.get('backend') is None:
+        pool = kwargs['backend'] = RWorkerPool(size=processes, libs=kwargs.get('libs'))
+
+    def render(key, partition):
+        start = time.time()
+        fname = name(key) if callable(name) else name.format(key=key)
+        try:
+            p = plot(key, partition) if callable(plot) else plot
+            ggsave(fname, p, partition, *args, **kwargs)
+            error = None
+        except Exception as e:
+            error = str(e)
+        return PartitionResult(key, fname, time.time() - start, error)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(render, key, partition)
+                       for key, partition in df.groupby(by, sort=False)]
+            return [f.result() for f in futures]
+    finally:
+        if pool is not None:
+            pool.close()
 
 
 def gg_ipython(plot, data, width=IPYTHON_IMAGE_SIZE, height=None,
@@ -346,7 +2923,8 @@ def gg_ipython(plot, data, width=IPYTHON_IMAGE_SIZE, height=None,
     """
     try:
         import IPython.display
-        tmp_image_filename = tempfile.NamedTemporaryFile(suffix='.jpg').name
+        workspace = get_workspace()
+        tmp_image_filename = workspace.new_file('.jpg', pin=True)
         # Quiet by default
         kwargs['quiet'] = kwargs.get('quiet', True)
 
@@ -354,11 +2932,16 @@ def gg_ipython(plot, data, width=IPYTHON_IMAGE_SIZE, height=None,
             raise ValueError("Width cannot be None")
         height = height or width
         w_in, h_in = size_r_img_inches(width, height)
-        ggsave(name=tmp_image_filename, plot=plot, data=data,
-               dpi=600, width=w_in, height=h_in, units=esc('in'),
-               *args, **kwargs)
-        return IPython.display.Image(filename=tmp_image_filename,
-                                     width=width, height=height)
+        try:
+            ggsave(name=tmp_image_filename, plot=plot, data=data,
+                   dpi=600, width=w_in, height=h_in, units=esc('in'),
+                   *args, **kwargs)
+            # Image reads the file when it is given a filename, so it can go
+            return IPython.display.Image(filename=tmp_image_filename,
+                                         width=width, height=height)
+        finally:
+            workspace.unpin(tmp_image_filename)
+            workspace.release(tmp_image_filename)
     except ImportError:
         print("Could't load IPython library; integration is disabled")
 
@@ -378,25 +2961,486 @@ def size_r_img_inches(width, height):
     return R_IMAGE_SIZE, round(aspect_ratio * R_IMAGE_SIZE, 2)
 
 
-def execute_r(prog, quiet):
+class RenderResult(object):
+    """Outcome of running an R program
+
+    @ivar status exit status of R (0 on success)
+    @ivar stdout, stderr text R printed.  Backends that can't separate the
+        two streams put everything in stdout
+    @ivar elapsed wall clock seconds spent running the program
+    @ivar warnings list of warning messages R printed
+    @ivar output file the program saved to, set by ggsave
+    @ivar output_size size in bytes of output, or None if it wasn't written
+    """
+
+    def __init__(self, status, stdout='', stderr='', elapsed=0.0, warnings=None,
+                 output=None, output_size=None):
+        self.status = status
+        self.stdout = stdout
+        self.stderr = stderr
+        self.elapsed = elapsed
+        self.warnings = warnings if warnings is not None else \
+            _parse_r_warnings(stderr) + _parse_r_warnings(stdout)
+        self.output = output
+        self.output_size = output_size
+
+    @property
+    def ok(self):
+        return self.status == 0
+
+    def __repr__(self):
+        return "RenderResult(status=%d, elapsed=%.3f, warnings=%d)" % (
+            self.status, self.elapsed, len(self.warnings))
+
+
+class RError(ValueError):
+    """An R program failed
+
+    @ivar message R's error message, e.g.
+        'Error in geom_pointt() : could not find function "geom_pointt"'
+    @ivar line 1-based line of the program with the failing statement, or
+        None if it couldn't be determined
+    @ivar statement text of that line
+    @ivar prog the program
+    @ivar result RenderResult with everything R printed
+    """
+
+    def __init__(self, prog, result):
+        self.prog = prog
+        self.result = result
+        self.message = _parse_r_error(result.stderr) or _parse_r_error(result.stdout)
+        self.line, self.statement = _locate_r_error(prog, result.stdout, self.message)
+        where = " at line %d: %s" % (self.line, self.statement) if self.line else ""
+        ValueError.__init__(self, "ggplot2 bridge failed%s\n%s" % (
+            where, self.message or "R exited with status %d" % result.status))
+
+
+_R_NUMBERED_RE = re.compile(r"^(\d+): (.*)$")
+_R_ERROR_RE = re.compile(r"^(Error(?: in .+?)?:[ \n].*?)(?=\n(?:In addition|Execution halted|Calls:)|\Z)",
+                         re.M | re.S)
+_R_ERROR_CALL_RE = re.compile(r"^Error in ([A-Za-z_.][A-Za-z0-9_.]*)\(")
+
+
+def _parse_r_warnings(text):
+    """Warning messages in R output, both the immediate kind
+    (Warning in f() : msg) and those summarized when a program ends
+    (Warning message(s): ...).  Indented continuation lines are joined"""
+    warnings = []
+    mode = None
+    for line in text.splitlines():
+        numbered = _R_NUMBERED_RE.match(line)
+        if line.startswith("Warning in ") or line.startswith("Warning: "):
+            warnings.append(line.strip())
+            mode = 'continue'
+        elif line.startswith("Warning message:"):
+            mode = 'one'
+        elif line.startswith("Warning messages:"):
+            mode = 'many'
+        elif mode == 'one' and line.strip():
+            warnings.append(line.strip())
+            mode = 'continue'
+        elif mode == 'many' and numbered:
+            warnings.append(numbered.group(2).strip())
+        elif mode in ('many', 'continue') and line[:1].isspace() and line.strip():
+            warnings[-1] += " " + line.strip()
+        else:
+            mode = None
+    return warnings
+
+
+def _parse_r_error(text):
+    """The first error message in R output, or None"""
+    m = _R_ERROR_RE.search(text)
+    return m.group(1).strip() if m else None
+
+
+def _locate_r_error(prog, stdout, message):
+    """(line, statement) of prog that raised message
+
+    R reading a program from stdin echoes each statement it runs to stdout
+    ("> stmt"), and stops at the first error, so the last echoed statement
+    is the failing one.  Otherwise fall back to the first line calling the
+    function named in "Error in f(...)".
+
+    @return (None, None) if the statement can't be found
+    """
+    lines = prog.split("\n")
+    echoed = [line[2:].strip() for line in stdout.splitlines() if line.startswith("> ")]
+    if echoed:
+        i, found = 0, None
+        for stmt in echoed:
+            for j in range(i, len(lines)):
+                if lines[j].strip() == stmt:
+                    found, i = j, j + 1
+                    break
+        if found is not None:
+            return found + 1, lines[found].strip()
+    m = _R_ERROR_CALL_RE.match(message or "")
+    if m:
+        call = re.compile(r"(?<![\w.])%s\(" % re.escape(m.group(1)))
+        for j, line in enumerate(lines):
+            if call.search(line):
+                return j + 1, line.strip()
+    return None, None
+
+
+def execute_r(prog, quiet, backend=None):
     """Run the R code prog an R subprocess
 
-    @raises ValueError if the subprocess exits with non-zero status
+    The program is written straight to R's stdin, so its size isn't limited
+    by the command line and no shell is involved.
+
+    @param backend object with an execute(prog, quiet) method to run prog
+        with instead of a fresh R subprocess.  Defaults to the backend set
+        with set_default_backend()
+    @return RenderResult with R's output and the elapsed time
+    @raises RError (a ValueError) if the subprocess exits with non-zero status
     """
-    FNULL = open(os.devnull, 'w') if quiet else None
-    try:
-        input_proc = subprocess.Popen(["echo", prog], stdout=subprocess.PIPE)
-        status = subprocess.call("R --no-save --quiet",
-                                 stdin=input_proc.stdout,
-                                 stdout=FNULL,
-                                 stderr=subprocess.STDOUT,
-                                 shell=True) # warning, this is a security problem
+    if backend is None:
+        backend = _default_backend
+    if backend is not None:
+        return backend.execute(prog, quiet)
+    return _execute_subprocess(prog, quiet)
+
+
+def _execute_subprocess(prog, quiet):
+    """Run prog in a new R process (the default backend of execute_r)"""
+    start = time.time()
+    proc = subprocess.Popen([R_COMMAND, "--no-save", "--quiet"],
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    stdout, stderr = proc.communicate(prog.encode('utf-8'))
+    result = RenderResult(proc.returncode,
+                          stdout.decode('utf-8', 'replace'),
+                          stderr.decode('utf-8', 'replace'),
+                          time.time() - start)
+    if not quiet:
+        print(result.stdout)
+        print(result.stderr)
+    if result.status != 0:
+        raise RError(prog, result)
+    return result
+
+
+###################################################
+#
+#  Embedded R.  Evaluates programs inside this python process with
+#  rpy2, which removes R startup and lets DataFrames be handed over
+#  in memory instead of through data_py files
+#
+###################################################
+
+class EmbeddedRBackend(object):
+    """Backend that runs programs in an R interpreter embedded with rpy2
+
+    ggsave hands python data to this backend as an in-memory data.frame
+    bound to `data`, skipping data_py entirely.  If rpy2 (or the R shared
+    library) isn't available, programs run in an R subprocess as usual.
+
+      set_default_backend(EmbeddedRBackend())
+
+    The embedded interpreter is shared by the whole process and isn't
+    thread-safe; R also checks that it is called from the thread that
+    started it.  So rpy2 is loaded, and every program evaluated, on one
+    dedicated thread, one program at a time, each in a fresh environment.
+    This makes the backend safe to use from submit() and ggsave_async().
+    Don't import rpy2 elsewhere before creating the first backend, or R
+    starts on the importing thread instead.
+    """
+
+    _lock = threading.Lock()
+    _executor = None
+
+    def __init__(self):
+        self._ro = self._call(self._load)
+
+    @staticmethod
+    def _load():
+        try:
+            import rpy2.robjects
+            return rpy2.robjects
+        except Exception:
+            # ImportError, or rpy2 failing to load libR
+            return None
+
+    @classmethod
+    def _call(cls, fn, *args):
+        """Run fn(*args) on the thread that owns the embedded interpreter"""
+        with cls._lock:
+            if cls._executor is None:
+                cls._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="pygg-embedded-r")
+        return cls._executor.submit(fn, *args).result()
+
+    @property
+    def available(self):
+        """Is rpy2 usable?  If not, programs run in an R subprocess"""
+        return self._ro is not None
+
+    @property
+    def accepts_data(self):
+        """Can execute() take python data directly?"""
+        return self.available
+
+    def to_r(self, df):
+        """Convert a pandas DataFrame to an R data.frame"""
+        return self._call(self._to_r, df)
+
+    def _to_r(self, df):
+        from rpy2.robjects import pandas2ri
+        from rpy2.robjects.conversion import localconverter
+        with localconverter(self._ro.default_converter + pandas2ri.converter):
+            return self._ro.conversion.py2rpy(df)
+
+    def execute(self, prog, quiet, data=None):
+        """Evaluate prog, with the DataFrame data bound to `data` if given
+
+        @return RenderResult
+        @raises ValueError if the program fails
+        """
+        if not self.available:
+            return _execute_subprocess(prog, quiet)
+
+        start = time.time()
+        status, stdout, stderr = self._call(self._evaluate, prog, data)
+        result = RenderResult(status, stdout, stderr, time.time() - start)
+        if not quiet:
+            print(result.stdout)
+            print(result.stderr)
         if status != 0:
-            raise ValueError("ggplot2 bridge failed for program: {}."
-                             " Check for an error".format(prog))
-    finally:
-        if FNULL is not None:
-            FNULL.close()
+            raise RError(prog, result)
+        return result
+
+    def _evaluate(self, prog, data):
+        """Run prog in the embedded interpreter; only called on its thread
+
+        @return (status, stdout, stderr)
+        """
+        from rpy2.rinterface_lib import callbacks
+        from rpy2.rinterface_lib.embedded import RRuntimeError
+        ro = self._ro
+        stdout, stderr = [], []
+        prev = callbacks.consolewrite_print, callbacks.consolewrite_warnerror
+        callbacks.consolewrite_print = stdout.append
+        callbacks.consolewrite_warnerror = stderr.append
+        try:
+            env = ro.r("new.env(parent=globalenv())")
+            if data is not None:
+                env['data'] = self._to_r(data)
+            ro.r['eval'](ro.r['parse'](text=prog), env)
+            status = 0
+        except RRuntimeError as e:
+            stderr.append(str(e))
+            status = 1
+        finally:
+            ro.r("while (dev.cur() > 1) dev.off()")
+            callbacks.consolewrite_print, callbacks.consolewrite_warnerror = prev
+        return status, "".join(stdout), "".join(stderr)
+
+
+###################################################
+#
+#  Long-lived R worker processes.  Avoids paying R startup and
+#  library(ggplot2) loading on every ggsave call
+#
+###################################################
+
+_default_backend = None
+
+
+def set_default_backend(backend):
+    """Use backend for every execute_r call that doesn't name its own
+
+    @param backend object with an execute(prog, quiet) method, e.g. an
+        RWorkerPool, or None to go back to one R subprocess per call
+    @return the previous default backend
+    """
+    global _default_backend
+    prev, _default_backend = _default_backend, backend
+    return prev
+
+
+class RWorker(object):
+    """A single R process that evaluates programs sent over its stdin
+
+    Each program is written to a temp file and source()d into a fresh
+    environment, so variables such as `data` and `p` don't leak between
+    renders while loaded packages stay loaded.  Statements are echoed like
+    in an R subprocess.  Completion is signalled by
+    a sentinel line on stdout carrying the program's exit status.
+    """
+
+    def __init__(self, libs=None, sql_pool_size=4, sql_idle_timeout=300):
+        self.proc = subprocess.Popen([R_COMMAND, "--no-save", "--quiet", "--slave"],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT,
+                                     universal_newlines=True)
+        libs = ["ggplot2"] + list(libs or [])
+        # print warnings as they happen so they are attributed to the right render
+        startup = ["options(warn=1)",
+                   # keep data_sql connections open across renders
+                   "options(pygg.persistent=TRUE, pygg.pool.size=%d, pygg.idle.timeout=%s)" % (
+                       sql_pool_size, sql_idle_timeout)]
+        startup.extend("suppressPackageStartupMessages(library(%s))" % lib
+                       for lib in libs)
+        self._run("\n".join(startup))
+
+    @property
+    def alive(self):
+        return self.proc.poll() is None
+
+    def _run(self, code):
+        """Evaluate code in the worker, returning (status, output)"""
+        sentinel = "__PYGG_DONE_%s__" % uuid.uuid4().hex
+        wrapped = """
+local({
+  .status = tryCatch({ %s; 0L },
+                     error=function(e) {
+                       call = conditionCall(e)
+                       message("Error", if (!is.null(call)) paste0(" in ", deparse(call)[1], " "),
+                               ": ", conditionMessage(e))
+                       1L
+                     })
+  while (dev.cur() > 1) dev.off()
+  cat("\\n%s", .status, "\\n")
+  flush(stdout())
+})
+""" % (code, sentinel)
+        try:
+            self.proc.stdin.write(wrapped)
+            self.proc.stdin.flush()
+        except (IOError, OSError):
+            raise ValueError("R worker exited unexpectedly")
+
+        output = []
+        for line in iter(self.proc.stdout.readline, ''):
+            if line.startswith(sentinel):
+                return int(line.split()[1]), "".join(output)
+            output.append(line)
+        raise ValueError("R worker exited unexpectedly:\n{}".format("".join(output)))
+
+    def execute(self, prog, quiet):
+        """Run prog in this worker
+
+        @return RenderResult with the worker's combined output in stdout
+        @raises ValueError if the program fails
+        """
+        start = time.time()
+        workspace = get_workspace()
+        fname = workspace.new_file(".R", pin=True)
+        with open(fname, "w") as f:
+            f.write(prog)
+        try:
+            # echo each statement as R reads it, so RError can find the
+            # failing one (see _locate_r_error)
+            status, output = self._run(
+                "source(%s, local=new.env(parent=globalenv()), echo=TRUE, "
+                "keep.source=TRUE, spaced=FALSE, max.deparse.length=Inf)" % esc(fname))
+        finally:
+            workspace.unpin(fname)
+            workspace.release(fname)
+        if not quiet and output:
+            print(output)
+        result = RenderResult(status, output, '', time.time() - start)
+        if status != 0:
+            raise RError(prog, result)
+        return result
+
+    def close(self):
+        if self.alive:
+            try:
+                self._run('if (exists(".pygg_disconnect")) .pygg_disconnect()')
+                self.proc.stdin.write('q("no")\n')
+                self.proc.stdin.close()
+                self.proc.wait(timeout=5)
+            except Exception:
+                self.proc.kill()
+
+
+class RWorkerPool(object):
+    """Pool of long-lived R workers with ggplot2 already loaded
+
+    Workers are started lazily, at most `size` at a time, and reused across
+    ggsave calls.  A worker that dies is replaced on next use.
+
+      pool = RWorkerPool(size=4, libs=['grid'])
+      ggsave("out.pdf", p, backend=pool)
+
+      # or for every render in this process
+      set_default_backend(pool)
+
+    Each worker keeps up to `sql_pool_size` data_sql connections open
+    between renders, closing those idle for `sql_idle_timeout` seconds, and
+    all of them when the pool is closed.
+
+    @param size maximum number of concurrent R processes
+    @param libs list of library names each worker loads at startup
+    @param sql_pool_size data_sql connections kept open per worker
+    @param sql_idle_timeout seconds before an unused connection is closed
+    """
+
+    def __init__(self, size=1, libs=None, sql_pool_size=4, sql_idle_timeout=300):
+        self.size = size
+        self.libs = list(libs or [])
+        self.sql_pool_size = sql_pool_size
+        self.sql_idle_timeout = sql_idle_timeout
+        self._workers = set()
+        self._lock = threading.Lock()
+        self._closed = False
+        # None marks a free slot that doesn't have a running worker yet
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(None)
+
+    def _acquire(self):
+        if self._closed:
+            raise ValueError("RWorkerPool is closed")
+        worker = self._idle.get()
+        if worker is None or not worker.alive:
+            try:
+                worker = RWorker(self.libs, self.sql_pool_size, self.sql_idle_timeout)
+            except Exception:
+                self._idle.put(None)
+                raise
+            with self._lock:
+                self._workers.add(worker)
+        return worker
+
+    def _release(self, worker):
+        if worker.alive and not self._closed:
+            self._idle.put(worker)
+            return
+        with self._lock:
+            self._workers.discard(worker)
+        worker.close()
+        self._idle.put(None)
+
+    def execute(self, prog, quiet):
+        """Run prog on an idle worker, blocking until one is available
+
+        @raises ValueError if the program fails
+        """
+        worker = self._acquire()
+        try:
+            return worker.execute(prog, quiet)
+        finally:
+            self._release(worker)
+
+    def close(self):
+        """Shut down all worker processes"""
+        self._closed = True
+        with self._lock:
+            workers, self._workers = self._workers, set()
+        for worker in workers:
+            worker.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 ###################################################
@@ -432,27 +3476,11 @@ def axis_labels(xtitle,
                        xkwargs=dict(breaks=[0, 10, 100, 5000]))
 
   """
-  xlookup = dict(
-      continuous = scale_x_continuous,
-      date = scale_x_date,
-      datetime = scale_x_datetime,
-      discrete = scale_x_discrete,
-      log10 = scale_x_log10,
-      reverse = scale_x_reverse,
-      sqrt = scale_x_sqrt
-  )
-  ylookup = dict(
-      continuous = scale_y_continuous,
-      date = scale_y_date,
-      datetime = scale_y_datetime,
-      discrete = scale_y_discrete,
-      log10 = scale_y_log10,
-      reverse = scale_y_reverse,
-      sqrt = scale_y_sqrt
-  )
-
-  xfunc = xlookup.get(xsuffix, scale_x_continuous)
-  yfunc = ylookup.get(ysuffix, scale_y_continuous)
+  suffixes = ["continuous", "date", "datetime", "discrete", "log10", "reverse", "sqrt"]
+  if xsuffix not in suffixes: xsuffix = "continuous"
+  if ysuffix not in suffixes: ysuffix = "continuous"
+  xfunc = make_ggplot2_binding("scale_x_%s" % xsuffix)
+  yfunc = make_ggplot2_binding("scale_y_%s" % ysuffix)
   return (
     xfunc(name=esc(xtitle), **xkwargs) + 
     yfunc(name=esc(ytitle), **ykwargs)
@@ -493,389 +3521,29 @@ def make_ggplot2_binding(fname):
 ggplot = make_master_binding()
 
 
-# generated by make_ggplot2_binding
-# ggplot2 library version: 3.3.5
-# date: Mon Jul 19 10:35:38 2021
-aes = make_ggplot2_binding("aes")
-aes_ = make_ggplot2_binding("aes_")
-aes_all = make_ggplot2_binding("aes_all")
-aes_auto = make_ggplot2_binding("aes_auto")
-aes_string = make_ggplot2_binding("aes_string")
-after_scale = make_ggplot2_binding("after_scale")
-after_stat = make_ggplot2_binding("after_stat")
-alpha = make_ggplot2_binding("alpha")
-annotate = make_ggplot2_binding("annotate")
-annotation_custom = make_ggplot2_binding("annotation_custom")
-annotation_logticks = make_ggplot2_binding("annotation_logticks")
-annotation_map = make_ggplot2_binding("annotation_map")
-annotation_raster = make_ggplot2_binding("annotation_raster")
-arrow = make_ggplot2_binding("arrow")
-as_label = make_ggplot2_binding("as_label")
-as_labeller = make_ggplot2_binding("as_labeller")
-autolayer = make_ggplot2_binding("autolayer")
-autoplot = make_ggplot2_binding("autoplot")
-binned_scale = make_ggplot2_binding("binned_scale")
-borders = make_ggplot2_binding("borders")
-calc_element = make_ggplot2_binding("calc_element")
-combine_vars = make_ggplot2_binding("combine_vars")
-continuous_scale = make_ggplot2_binding("continuous_scale")
-coord_cartesian = make_ggplot2_binding("coord_cartesian")
-coord_equal = make_ggplot2_binding("coord_equal")
-coord_fixed = make_ggplot2_binding("coord_fixed")
-coord_flip = make_ggplot2_binding("coord_flip")
-coord_map = make_ggplot2_binding("coord_map")
-coord_munch = make_ggplot2_binding("coord_munch")
-coord_polar = make_ggplot2_binding("coord_polar")
-coord_quickmap = make_ggplot2_binding("coord_quickmap")
-coord_sf = make_ggplot2_binding("coord_sf")
-coord_trans = make_ggplot2_binding("coord_trans")
-cut_interval = make_ggplot2_binding("cut_interval")
-cut_number = make_ggplot2_binding("cut_number")
-cut_width = make_ggplot2_binding("cut_width")
-derive = make_ggplot2_binding("derive")
-discrete_scale = make_ggplot2_binding("discrete_scale")
-draw_key_abline = make_ggplot2_binding("draw_key_abline")
-draw_key_blank = make_ggplot2_binding("draw_key_blank")
-draw_key_boxplot = make_ggplot2_binding("draw_key_boxplot")
-draw_key_crossbar = make_ggplot2_binding("draw_key_crossbar")
-draw_key_dotplot = make_ggplot2_binding("draw_key_dotplot")
-draw_key_label = make_ggplot2_binding("draw_key_label")
-draw_key_path = make_ggplot2_binding("draw_key_path")
-draw_key_point = make_ggplot2_binding("draw_key_point")
-draw_key_pointrange = make_ggplot2_binding("draw_key_pointrange")
-draw_key_polygon = make_ggplot2_binding("draw_key_polygon")
-draw_key_rect = make_ggplot2_binding("draw_key_rect")
-draw_key_smooth = make_ggplot2_binding("draw_key_smooth")
-draw_key_text = make_ggplot2_binding("draw_key_text")
-draw_key_timeseries = make_ggplot2_binding("draw_key_timeseries")
-draw_key_vline = make_ggplot2_binding("draw_key_vline")
-draw_key_vpath = make_ggplot2_binding("draw_key_vpath")
-dup_axis = make_ggplot2_binding("dup_axis")
-el_def = make_ggplot2_binding("el_def")
-element_blank = make_ggplot2_binding("element_blank")
-element_grob = make_ggplot2_binding("element_grob")
-element_line = make_ggplot2_binding("element_line")
-element_rect = make_ggplot2_binding("element_rect")
-element_render = make_ggplot2_binding("element_render")
-element_text = make_ggplot2_binding("element_text")
-enexpr = make_ggplot2_binding("enexpr")
-enexprs = make_ggplot2_binding("enexprs")
-enquo = make_ggplot2_binding("enquo")
-enquos = make_ggplot2_binding("enquos")
-ensym = make_ggplot2_binding("ensym")
-ensyms = make_ggplot2_binding("ensyms")
-expand_limits = make_ggplot2_binding("expand_limits")
-expand_scale = make_ggplot2_binding("expand_scale")
-expansion = make_ggplot2_binding("expansion")
-expr = make_ggplot2_binding("expr")
-facet_null = make_ggplot2_binding("facet_null")
-find_panel = make_ggplot2_binding("find_panel")
-flip_data = make_ggplot2_binding("flip_data")
-flipped_names = make_ggplot2_binding("flipped_names")
-geom_abline = make_ggplot2_binding("geom_abline")
-geom_area = make_ggplot2_binding("geom_area")
-geom_bar = make_ggplot2_binding("geom_bar")
-geom_bin_2d = make_ggplot2_binding("geom_bin_2d")
-geom_bin2d = make_ggplot2_binding("geom_bin2d")
-geom_blank = make_ggplot2_binding("geom_blank")
-geom_boxplot = make_ggplot2_binding("geom_boxplot")
-geom_col = make_ggplot2_binding("geom_col")
-geom_contour = make_ggplot2_binding("geom_contour")
-geom_contour_filled = make_ggplot2_binding("geom_contour_filled")
-geom_count = make_ggplot2_binding("geom_count")
-geom_crossbar = make_ggplot2_binding("geom_crossbar")
-geom_curve = make_ggplot2_binding("geom_curve")
-geom_density = make_ggplot2_binding("geom_density")
-geom_density_2d = make_ggplot2_binding("geom_density_2d")
-geom_density_2d_filled = make_ggplot2_binding("geom_density_2d_filled")
-geom_density2d = make_ggplot2_binding("geom_density2d")
-geom_density2d_filled = make_ggplot2_binding("geom_density2d_filled")
-geom_dotplot = make_ggplot2_binding("geom_dotplot")
-geom_errorbar = make_ggplot2_binding("geom_errorbar")
-geom_errorbarh = make_ggplot2_binding("geom_errorbarh")
-geom_freqpoly = make_ggplot2_binding("geom_freqpoly")
-geom_function = make_ggplot2_binding("geom_function")
-geom_hex = make_ggplot2_binding("geom_hex")
-geom_histogram = make_ggplot2_binding("geom_histogram")
-geom_hline = make_ggplot2_binding("geom_hline")
-geom_jitter = make_ggplot2_binding("geom_jitter")
-geom_label = make_ggplot2_binding("geom_label")
-geom_line = make_ggplot2_binding("geom_line")
-geom_linerange = make_ggplot2_binding("geom_linerange")
-geom_map = make_ggplot2_binding("geom_map")
-geom_path = make_ggplot2_binding("geom_path")
-geom_point = make_ggplot2_binding("geom_point")
-geom_pointrange = make_ggplot2_binding("geom_pointrange")
-geom_polygon = make_ggplot2_binding("geom_polygon")
-geom_qq = make_ggplot2_binding("geom_qq")
-geom_qq_line = make_ggplot2_binding("geom_qq_line")
-geom_quantile = make_ggplot2_binding("geom_quantile")
-geom_raster = make_ggplot2_binding("geom_raster")
-geom_rect = make_ggplot2_binding("geom_rect")
-geom_ribbon = make_ggplot2_binding("geom_ribbon")
-geom_rug = make_ggplot2_binding("geom_rug")
-geom_segment = make_ggplot2_binding("geom_segment")
-geom_sf = make_ggplot2_binding("geom_sf")
-geom_sf_label = make_ggplot2_binding("geom_sf_label")
-geom_sf_text = make_ggplot2_binding("geom_sf_text")
-geom_smooth = make_ggplot2_binding("geom_smooth")
-geom_spoke = make_ggplot2_binding("geom_spoke")
-geom_step = make_ggplot2_binding("geom_step")
-geom_text = make_ggplot2_binding("geom_text")
-geom_tile = make_ggplot2_binding("geom_tile")
-geom_violin = make_ggplot2_binding("geom_violin")
-geom_vline = make_ggplot2_binding("geom_vline")
-get_alt_text = make_ggplot2_binding("get_alt_text")
-get_element_tree = make_ggplot2_binding("get_element_tree")
-ggplot_add = make_ggplot2_binding("ggplot_add")
-ggproto = make_ggplot2_binding("ggproto")
-ggproto_parent = make_ggplot2_binding("ggproto_parent")
-ggtitle = make_ggplot2_binding("ggtitle")
-guide_axis = make_ggplot2_binding("guide_axis")
-guide_bins = make_ggplot2_binding("guide_bins")
-guide_colorbar = make_ggplot2_binding("guide_colorbar")
-guide_colorsteps = make_ggplot2_binding("guide_colorsteps")
-guide_colourbar = make_ggplot2_binding("guide_colourbar")
-guide_coloursteps = make_ggplot2_binding("guide_coloursteps")
-guide_gengrob = make_ggplot2_binding("guide_gengrob")
-guide_geom = make_ggplot2_binding("guide_geom")
-guide_legend = make_ggplot2_binding("guide_legend")
-guide_merge = make_ggplot2_binding("guide_merge")
-guide_none = make_ggplot2_binding("guide_none")
-guide_train = make_ggplot2_binding("guide_train")
-guide_transform = make_ggplot2_binding("guide_transform")
-guides = make_ggplot2_binding("guides")
-has_flipped_aes = make_ggplot2_binding("has_flipped_aes")
-label_both = make_ggplot2_binding("label_both")
-label_bquote = make_ggplot2_binding("label_bquote")
-label_context = make_ggplot2_binding("label_context")
-label_parsed = make_ggplot2_binding("label_parsed")
-label_value = make_ggplot2_binding("label_value")
-label_wrap_gen = make_ggplot2_binding("label_wrap_gen")
-labeller = make_ggplot2_binding("labeller")
-labs = make_ggplot2_binding("labs")
-layer = make_ggplot2_binding("layer")
-layer_data = make_ggplot2_binding("layer_data")
-layer_grob = make_ggplot2_binding("layer_grob")
-layer_scales = make_ggplot2_binding("layer_scales")
-layer_sf = make_ggplot2_binding("layer_sf")
-lims = make_ggplot2_binding("lims")
-margin = make_ggplot2_binding("margin")
-max_height = make_ggplot2_binding("max_height")
-max_width = make_ggplot2_binding("max_width")
-merge_element = make_ggplot2_binding("merge_element")
-panel_cols = make_ggplot2_binding("panel_cols")
-panel_rows = make_ggplot2_binding("panel_rows")
-position_dodge = make_ggplot2_binding("position_dodge")
-position_dodge2 = make_ggplot2_binding("position_dodge2")
-position_fill = make_ggplot2_binding("position_fill")
-position_identity = make_ggplot2_binding("position_identity")
-position_jitter = make_ggplot2_binding("position_jitter")
-position_jitterdodge = make_ggplot2_binding("position_jitterdodge")
-position_nudge = make_ggplot2_binding("position_nudge")
-position_stack = make_ggplot2_binding("position_stack")
-qplot = make_ggplot2_binding("qplot")
-quickplot = make_ggplot2_binding("quickplot")
-quo = make_ggplot2_binding("quo")
-quo_name = make_ggplot2_binding("quo_name")
-quos = make_ggplot2_binding("quos")
-register_theme_elements = make_ggplot2_binding("register_theme_elements")
-rel = make_ggplot2_binding("rel")
-remove_missing = make_ggplot2_binding("remove_missing")
-render_axes = make_ggplot2_binding("render_axes")
-render_strips = make_ggplot2_binding("render_strips")
-reset_theme_settings = make_ggplot2_binding("reset_theme_settings")
-resolution = make_ggplot2_binding("resolution")
-scale_alpha = make_ggplot2_binding("scale_alpha")
-scale_alpha_binned = make_ggplot2_binding("scale_alpha_binned")
-scale_alpha_continuous = make_ggplot2_binding("scale_alpha_continuous")
-scale_alpha_date = make_ggplot2_binding("scale_alpha_date")
-scale_alpha_datetime = make_ggplot2_binding("scale_alpha_datetime")
-scale_alpha_discrete = make_ggplot2_binding("scale_alpha_discrete")
-scale_alpha_identity = make_ggplot2_binding("scale_alpha_identity")
-scale_alpha_manual = make_ggplot2_binding("scale_alpha_manual")
-scale_alpha_ordinal = make_ggplot2_binding("scale_alpha_ordinal")
-scale_color_binned = make_ggplot2_binding("scale_color_binned")
-scale_color_brewer = make_ggplot2_binding("scale_color_brewer")
-scale_color_continuous = make_ggplot2_binding("scale_color_continuous")
-scale_color_date = make_ggplot2_binding("scale_color_date")
-scale_color_datetime = make_ggplot2_binding("scale_color_datetime")
-scale_color_discrete = make_ggplot2_binding("scale_color_discrete")
-scale_color_distiller = make_ggplot2_binding("scale_color_distiller")
-scale_color_fermenter = make_ggplot2_binding("scale_color_fermenter")
-scale_color_gradient = make_ggplot2_binding("scale_color_gradient")
-scale_color_gradient2 = make_ggplot2_binding("scale_color_gradient2")
-scale_color_gradientn = make_ggplot2_binding("scale_color_gradientn")
-scale_color_grey = make_ggplot2_binding("scale_color_grey")
-scale_color_hue = make_ggplot2_binding("scale_color_hue")
-scale_color_identity = make_ggplot2_binding("scale_color_identity")
-scale_color_manual = make_ggplot2_binding("scale_color_manual")
-scale_color_ordinal = make_ggplot2_binding("scale_color_ordinal")
-scale_color_steps = make_ggplot2_binding("scale_color_steps")
-scale_color_steps2 = make_ggplot2_binding("scale_color_steps2")
-scale_color_stepsn = make_ggplot2_binding("scale_color_stepsn")
-scale_color_viridis_b = make_ggplot2_binding("scale_color_viridis_b")
-scale_color_viridis_c = make_ggplot2_binding("scale_color_viridis_c")
-scale_color_viridis_d = make_ggplot2_binding("scale_color_viridis_d")
-scale_colour_binned = make_ggplot2_binding("scale_colour_binned")
-scale_colour_brewer = make_ggplot2_binding("scale_colour_brewer")
-scale_colour_continuous = make_ggplot2_binding("scale_colour_continuous")
-scale_colour_date = make_ggplot2_binding("scale_colour_date")
-scale_colour_datetime = make_ggplot2_binding("scale_colour_datetime")
-scale_colour_discrete = make_ggplot2_binding("scale_colour_discrete")
-scale_colour_distiller = make_ggplot2_binding("scale_colour_distiller")
-scale_colour_fermenter = make_ggplot2_binding("scale_colour_fermenter")
-scale_colour_gradient = make_ggplot2_binding("scale_colour_gradient")
-scale_colour_gradient2 = make_ggplot2_binding("scale_colour_gradient2")
-scale_colour_gradientn = make_ggplot2_binding("scale_colour_gradientn")
-scale_colour_grey = make_ggplot2_binding("scale_colour_grey")
-scale_colour_hue = make_ggplot2_binding("scale_colour_hue")
-scale_colour_identity = make_ggplot2_binding("scale_colour_identity")
-scale_colour_manual = make_ggplot2_binding("scale_colour_manual")
-scale_colour_ordinal = make_ggplot2_binding("scale_colour_ordinal")
-scale_colour_steps = make_ggplot2_binding("scale_colour_steps")
-scale_colour_steps2 = make_ggplot2_binding("scale_colour_steps2")
-scale_colour_stepsn = make_ggplot2_binding("scale_colour_stepsn")
-scale_colour_viridis_b = make_ggplot2_binding("scale_colour_viridis_b")
-scale_colour_viridis_c = make_ggplot2_binding("scale_colour_viridis_c")
-scale_colour_viridis_d = make_ggplot2_binding("scale_colour_viridis_d")
-scale_continuous_identity = make_ggplot2_binding("scale_continuous_identity")
-scale_discrete_identity = make_ggplot2_binding("scale_discrete_identity")
-scale_discrete_manual = make_ggplot2_binding("scale_discrete_manual")
-scale_fill_binned = make_ggplot2_binding("scale_fill_binned")
-scale_fill_brewer = make_ggplot2_binding("scale_fill_brewer")
-scale_fill_continuous = make_ggplot2_binding("scale_fill_continuous")
-scale_fill_date = make_ggplot2_binding("scale_fill_date")
-scale_fill_datetime = make_ggplot2_binding("scale_fill_datetime")
-scale_fill_discrete = make_ggplot2_binding("scale_fill_discrete")
-scale_fill_distiller = make_ggplot2_binding("scale_fill_distiller")
-scale_fill_fermenter = make_ggplot2_binding("scale_fill_fermenter")
-scale_fill_gradient = make_ggplot2_binding("scale_fill_gradient")
-scale_fill_gradient2 = make_ggplot2_binding("scale_fill_gradient2")
-scale_fill_gradientn = make_ggplot2_binding("scale_fill_gradientn")
-scale_fill_grey = make_ggplot2_binding("scale_fill_grey")
-scale_fill_hue = make_ggplot2_binding("scale_fill_hue")
-scale_fill_identity = make_ggplot2_binding("scale_fill_identity")
-scale_fill_manual = make_ggplot2_binding("scale_fill_manual")
-scale_fill_ordinal = make_ggplot2_binding("scale_fill_ordinal")
-scale_fill_steps = make_ggplot2_binding("scale_fill_steps")
-scale_fill_steps2 = make_ggplot2_binding("scale_fill_steps2")
-scale_fill_stepsn = make_ggplot2_binding("scale_fill_stepsn")
-scale_fill_viridis_b = make_ggplot2_binding("scale_fill_viridis_b")
-scale_fill_viridis_c = make_ggplot2_binding("scale_fill_viridis_c")
-scale_fill_viridis_d = make_ggplot2_binding("scale_fill_viridis_d")
-scale_linetype = make_ggplot2_binding("scale_linetype")
-scale_linetype_binned = make_ggplot2_binding("scale_linetype_binned")
-scale_linetype_continuous = make_ggplot2_binding("scale_linetype_continuous")
-scale_linetype_discrete = make_ggplot2_binding("scale_linetype_discrete")
-scale_linetype_identity = make_ggplot2_binding("scale_linetype_identity")
-scale_linetype_manual = make_ggplot2_binding("scale_linetype_manual")
-scale_radius = make_ggplot2_binding("scale_radius")
-scale_shape = make_ggplot2_binding("scale_shape")
-scale_shape_binned = make_ggplot2_binding("scale_shape_binned")
-scale_shape_continuous = make_ggplot2_binding("scale_shape_continuous")
-scale_shape_discrete = make_ggplot2_binding("scale_shape_discrete")
-scale_shape_identity = make_ggplot2_binding("scale_shape_identity")
-scale_shape_manual = make_ggplot2_binding("scale_shape_manual")
-scale_shape_ordinal = make_ggplot2_binding("scale_shape_ordinal")
-scale_size = make_ggplot2_binding("scale_size")
-scale_size_area = make_ggplot2_binding("scale_size_area")
-scale_size_binned = make_ggplot2_binding("scale_size_binned")
-scale_size_binned_area = make_ggplot2_binding("scale_size_binned_area")
-scale_size_continuous = make_ggplot2_binding("scale_size_continuous")
-scale_size_date = make_ggplot2_binding("scale_size_date")
-scale_size_datetime = make_ggplot2_binding("scale_size_datetime")
-scale_size_discrete = make_ggplot2_binding("scale_size_discrete")
-scale_size_identity = make_ggplot2_binding("scale_size_identity")
-scale_size_manual = make_ggplot2_binding("scale_size_manual")
-scale_size_ordinal = make_ggplot2_binding("scale_size_ordinal")
-scale_type = make_ggplot2_binding("scale_type")
-scale_x_binned = make_ggplot2_binding("scale_x_binned")
-scale_x_continuous = make_ggplot2_binding("scale_x_continuous")
-scale_x_date = make_ggplot2_binding("scale_x_date")
-scale_x_datetime = make_ggplot2_binding("scale_x_datetime")
-scale_x_discrete = make_ggplot2_binding("scale_x_discrete")
-scale_x_log10 = make_ggplot2_binding("scale_x_log10")
-scale_x_reverse = make_ggplot2_binding("scale_x_reverse")
-scale_x_sqrt = make_ggplot2_binding("scale_x_sqrt")
-scale_x_time = make_ggplot2_binding("scale_x_time")
-scale_y_binned = make_ggplot2_binding("scale_y_binned")
-scale_y_continuous = make_ggplot2_binding("scale_y_continuous")
-scale_y_date = make_ggplot2_binding("scale_y_date")
-scale_y_datetime = make_ggplot2_binding("scale_y_datetime")
-scale_y_discrete = make_ggplot2_binding("scale_y_discrete")
-scale_y_log10 = make_ggplot2_binding("scale_y_log10")
-scale_y_reverse = make_ggplot2_binding("scale_y_reverse")
-scale_y_sqrt = make_ggplot2_binding("scale_y_sqrt")
-scale_y_time = make_ggplot2_binding("scale_y_time")
-sec_axis = make_ggplot2_binding("sec_axis")
-set_last_plot = make_ggplot2_binding("set_last_plot")
-sf_transform_xy = make_ggplot2_binding("sf_transform_xy")
-stage = make_ggplot2_binding("stage")
-standardise_aes_names = make_ggplot2_binding("standardise_aes_names")
-stat = make_ggplot2_binding("stat")
-stat_bin = make_ggplot2_binding("stat_bin")
-stat_bin_2d = make_ggplot2_binding("stat_bin_2d")
-stat_bin_hex = make_ggplot2_binding("stat_bin_hex")
-stat_bin2d = make_ggplot2_binding("stat_bin2d")
-stat_binhex = make_ggplot2_binding("stat_binhex")
-stat_boxplot = make_ggplot2_binding("stat_boxplot")
-stat_contour = make_ggplot2_binding("stat_contour")
-stat_contour_filled = make_ggplot2_binding("stat_contour_filled")
-stat_count = make_ggplot2_binding("stat_count")
-stat_density = make_ggplot2_binding("stat_density")
-stat_density_2d = make_ggplot2_binding("stat_density_2d")
-stat_density_2d_filled = make_ggplot2_binding("stat_density_2d_filled")
-stat_density2d = make_ggplot2_binding("stat_density2d")
-stat_density2d_filled = make_ggplot2_binding("stat_density2d_filled")
-stat_ecdf = make_ggplot2_binding("stat_ecdf")
-stat_ellipse = make_ggplot2_binding("stat_ellipse")
-stat_function = make_ggplot2_binding("stat_function")
-stat_identity = make_ggplot2_binding("stat_identity")
-stat_qq = make_ggplot2_binding("stat_qq")
-stat_qq_line = make_ggplot2_binding("stat_qq_line")
-stat_quantile = make_ggplot2_binding("stat_quantile")
-stat_sf = make_ggplot2_binding("stat_sf")
-stat_sf_coordinates = make_ggplot2_binding("stat_sf_coordinates")
-stat_smooth = make_ggplot2_binding("stat_smooth")
-stat_spoke = make_ggplot2_binding("stat_spoke")
-stat_sum = make_ggplot2_binding("stat_sum")
-stat_summary = make_ggplot2_binding("stat_summary")
-stat_summary_2d = make_ggplot2_binding("stat_summary_2d")
-stat_summary_bin = make_ggplot2_binding("stat_summary_bin")
-stat_summary_hex = make_ggplot2_binding("stat_summary_hex")
-stat_summary2d = make_ggplot2_binding("stat_summary2d")
-stat_unique = make_ggplot2_binding("stat_unique")
-stat_ydensity = make_ggplot2_binding("stat_ydensity")
-summarise_coord = make_ggplot2_binding("summarise_coord")
-summarise_layers = make_ggplot2_binding("summarise_layers")
-summarise_layout = make_ggplot2_binding("summarise_layout")
-sym = make_ggplot2_binding("sym")
-syms = make_ggplot2_binding("syms")
-theme = make_ggplot2_binding("theme")
-theme_bw = make_ggplot2_binding("theme_bw")
-theme_classic = make_ggplot2_binding("theme_classic")
-theme_dark = make_ggplot2_binding("theme_dark")
-theme_get = make_ggplot2_binding("theme_get")
-theme_gray = make_ggplot2_binding("theme_gray")
-theme_grey = make_ggplot2_binding("theme_grey")
-theme_light = make_ggplot2_binding("theme_light")
-theme_linedraw = make_ggplot2_binding("theme_linedraw")
-theme_minimal = make_ggplot2_binding("theme_minimal")
-theme_replace = make_ggplot2_binding("theme_replace")
-theme_set = make_ggplot2_binding("theme_set")
-theme_test = make_ggplot2_binding("theme_test")
-theme_update = make_ggplot2_binding("theme_update")
-theme_void = make_ggplot2_binding("theme_void")
-transform_position = make_ggplot2_binding("transform_position")
-unit = make_ggplot2_binding("unit")
-update_geom_defaults = make_ggplot2_binding("update_geom_defaults")
-update_labels = make_ggplot2_binding("update_labels")
-update_stat_defaults = make_ggplot2_binding("update_stat_defaults")
-vars = make_ggplot2_binding("vars")
-wrap_dims = make_ggplot2_binding("wrap_dims")
-xlab = make_ggplot2_binding("xlab")
-xlim = make_ggplot2_binding("xlim")
-ylab = make_ggplot2_binding("ylab")
-ylim = make_ggplot2_binding("ylim")
-zeroGrob = make_ggplot2_binding("zeroGrob")
+###################################################
+#
+#  The plain ggplot2 bindings are made on first use.  Their names are
+#  generated into ggplot2_functions.py by bin/make_ggplot2_functions.R
+#
+###################################################
+
+_GGPLOT2_NAMES = frozenset(ggplot2_functions.FUNCTIONS)
+
+
+def __getattr__(name):
+    """Create the binding for ggplot2 function `name` on first use"""
+    if name in _GGPLOT2_NAMES:
+        binding = globals()[name] = make_ggplot2_binding(name)
+        return binding
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | _GGPLOT2_NAMES)
+
+
+__all__ = sorted(set(
+    name for name, value in globals().items()
+    if not name.startswith('_') and not isinstance(value, (types.ModuleType, _LazyModule))
+) | _GGPLOT2_NAMES)
@@ -1,7 +1,12 @@
 import unittest
+import concurrent.futures
+import asyncio
 import io
+import re
+import numpy
 import pandas
 import tempfile
+import threading
 import os.path
 
 import pygg
@@ -61,6 +66,27 @@ class TestUnits(unittest.TestCase):
         self.assertFalse(pygg.is_pandas_df({}))
         self.assertFalse(pygg.is_pandas_df({'a': 1}))
 
+    def testLazyImport(self):
+        """pandas isn't imported and bindings aren't created until used"""
+        import subprocess
+        import sys
+        code = ("import sys, pygg; assert 'pandas' not in sys.modules; "
+                "assert 'geom_point' not in vars(pygg.pygg); pygg.geom_point(); "
+                "assert 'geom_point' in vars(pygg.pygg)")
+        subprocess.check_call([sys.executable, "-c", code],
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    def testBindings(self):
+        self.assertIn('geom_point', pygg.__all__)
+        self.assertIn('ggsave', pygg.__all__)
+        self.assertIn('geom_point', dir(pygg))
+        self.assertEqual(pygg.geom_point.__name__, 'geom_point')
+        with self.assertRaises(AttributeError):
+            pygg.geom_nope
+        namespace = {}
+        exec("from pygg import *", namespace)
+        self.assertEqual(namespace['scale_x_log10']().r, "scale_x_log10()")
+
     def check_me(self, stmt, expectation):
         self.assertEqual(stmt.r.replace(" ", ""), expectation)
 
@@ -107,6 +133,90 @@ class TestUnits(unittest.TestCase):
         self.assertEqual(dffile, src)
         self.assertEqual(expr, 'data = read.csv("{}",sep=",")'.format(src))
 
+    def testDataPyBinary(self):
+        df = pandas.DataFrame({'a': [1.5, 2.5], 'b': [3, 4], 'c': ['x', None]})
+        datao = pygg.data_py(df, transfer='binary')
+        expr = str(datao)
+        self.assertTrue(expr.startswith('data = local({'))
+        self.assertIn('con = file("{}", "rb")'.format(datao.fname), expr)
+        self.assertIn('n = 2L', expr)
+        with open(datao.fname, 'rb') as f:
+            self.assertEqual(list(numpy.frombuffer(f.read(16), '<f8')), [1.5, 2.5])
+            self.assertEqual(list(numpy.frombuffer(f.read(8), '<i4')), [3, 4])
+            self.assertEqual(f.read(2), b'x\0')
+            self.assertEqual(list(numpy.frombuffer(f.read(8), '<i4')), [1, -2 ** 31])
+
+    def testDataPySharedMemory(self):
+        df = pandas.DataFrame({'a': [1.5, 2.5], 'b': [3, 4], 'c': ['x', 'x']})
+        datao = pygg.data_py(df, transfer='shm')
+        self.addCleanup(os.remove, datao.fname)
+        if os.path.isdir('/dev/shm'):
+            self.assertTrue(datao.fname.startswith('/dev/shm/'))
+        self.assertEqual(str(datao).count("{ header("), 3)
+        with open(datao.fname, 'rb') as f:
+            self.assertEqual(f.read(8), b'PYGGCOL\0')
+            self.assertEqual(list(numpy.frombuffer(f.read(8), '<i4')), [1, 8])
+            self.assertEqual(list(numpy.frombuffer(f.read(8), '<f8')), [2])
+            self.assertEqual(list(numpy.frombuffer(f.read(16), '<f8')), [1.5, 2.5])
+            self.assertEqual(f.read(8), b'PYGGCOL\0')
+            self.assertEqual(list(numpy.frombuffer(f.read(8), '<i4')), [2, 4])
+
+    def testDataPyInline(self):
+        datao = pygg.data_py({'a': ['x"y', 'b\\c'], 'b': [1, 2]}, transfer='inline')
+        self.assertIsNone(datao.fname)
+        self.assertEqual(str(datao),
+                         'data = read.csv(sep=",",text="a,b\n\\"x\\"\\"y\\",1\nb\\\\c,2\n")')
+
+    def testDataPyStreamCSV(self):
+        rows = (dict(a=i, b=i * 2) for i in range(25))
+        datao = pygg.data_py(rows, batch_rows=10)
+        self.assertEqual(str(datao), 'data = read.csv("{}",sep=",")'.format(datao.fname))
+        pdt.assert_frame_equal(pandas.DataFrame({'a': range(25), 'b': range(0, 50, 2)}),
+                               pandas.read_csv(datao.fname))
+
+    def testDataPyStreamBinary(self):
+        chunks = iter([pandas.DataFrame({'a': [1, 2], 'c': ['x', None]}),
+                       pandas.DataFrame({'a': [3], 'c': ['y']})])
+        datao = pygg.data_py(chunks, transfer='binary')
+        self.assertIn('n = 3L', str(datao))
+        with open(datao.fname, 'rb') as f:
+            self.assertEqual(list(numpy.frombuffer(f.read(24), '<f8')), [1, 2, 3])
+            self.assertEqual(f.read(4), b'x\0y\0')
+            self.assertEqual(list(numpy.frombuffer(f.read(12), '<i4')), [1, -2 ** 31, 2])
+
+    def testDataPyStreamFallback(self):
+        chunks = (pandas.DataFrame({'a': [i]}) for i in range(3))
+        datao = pygg.data_py(chunks, transfer='inline')
+        self.assertEqual(str(datao), 'data = read.csv(sep=",",text="a\n0\n1\n2\n")')
+
+    def testDataPyTransferErrors(self):
+        df = pandas.DataFrame({'a': [1, 2]})
+        with self.assertRaises(ValueError):
+            pygg.data_py(df, transfer='nope')
+        with self.assertRaises(ValueError):
+            pygg.data_py(df, 1, transfer='binary')
+
+    def testDefaultTransfer(self):
+        prev = pygg.set_default_transfer('inline')
+        try:
+            self.assertIn('text=', str(pygg.data_py({'a': [1]})))
+            with self.assertRaises(ValueError):
+                pygg.set_default_transfer('nope')
+        finally:
+            self.assertEqual(pygg.set_default_transfer(prev), 'inline')
+        self.assertIn('read.csv("', str(pygg.data_py({'a': [1]})))
+
+    def testDataSQL(self):
+        datao = pygg.data_sql("my.db", 'SELECT "a" FROM t', driver='SQLite')
+        self.assertEqual((datao.db, datao.sql, datao.driver), ("my.db", 'SELECT "a" FROM t', 'SQLite'))
+        self.assertIn('library(RSQLite)', str(datao))
+        self.assertIn('data = .pygg_query("SQLite:my.db", '
+                      'function() DBI::dbConnect(RSQLite::SQLite(), dbname="my.db"), '
+                      '"SELECT \\"a\\" FROM t")', str(datao))
+        self.assertIn('library(RPostgreSQL)', str(pygg.data_sql("db", "SELECT 1")))
+        with self.assertRaises(ValueError):
+            pygg.data_sql("db", "SELECT 1", driver='nope')
+
     def testGGStatementToR(self):
         """Test that GGStatement converts to R properly"""
         self.check_me(pygg.geom_point(), "geom_point()")
@@ -123,6 +233,84 @@ class TestUnits(unittest.TestCase):
         self.check_me(pygg.geom_bar() + pygg.geom_point(),
                       "geom_bar()+geom_point()")
 
+    def testGGStatementsImmutable(self):
+        """Adding to a GGStatements leaves it unchanged, even when shared"""
+        base = pygg.geom_point() + pygg.geom_line()
+        p1 = base + pygg.geom_bar()
+        p2 = base + pygg.geom_area()
+        p2 += [pygg.geom_text(), pygg.geom_rug()]
+        self.check_me(base, "geom_point()+geom_line()")
+        self.check_me(p1, "geom_point()+geom_line()+geom_bar()")
+        self.check_me(p2, "geom_point()+geom_line()+geom_area()+geom_text()+geom_rug()")
+        with self.assertRaises(AttributeError):
+            p1.stmts.append(pygg.geom_tile())
+        with self.assertRaises(TypeError):
+            p1.stmts[0] = pygg.geom_tile()
+        p1.stmts = p1.stmts + (pygg.geom_tile(),)
+        self.check_me(p1, "geom_point()+geom_line()+geom_bar()+geom_tile()")
+        self.check_me(p2, "geom_point()+geom_line()+geom_area()+geom_text()+geom_rug()")
+
+    def testCachedRInvalidated(self):
+        """R code is regenerated after a statement changes"""
+        aes = pygg.aes(x='a')
+        layer = pygg.geom_point(size=1)
+        p = pygg.ggplot('data', aes) + layer
+        self.check_me(p, "ggplot(data,aes(x=a))+geom_point(size=1)")
+        layer.kwargs['size'] = 2
+        aes.kwargs.update(y='b')
+        self.check_me(p, "ggplot(data,aes(x=a,y=b))+geom_point(size=2)")
+        layer.name = 'geom_line'
+        layer.args = ('c',)
+        self.check_me(p, "ggplot(data,aes(x=a,y=b))+geom_line(c,size=2)")
+        with self.assertRaises(AttributeError):
+            layer.color = 'red'
+
+        kwargs = layer.kwargs
+        kwargs |= {'alpha': 0.5}
+        self.check_me(p, "ggplot(data,aes(x=a,y=b))+geom_line(c,alpha=0.5,size=2)")
+
+    def testCachedRPerStatement(self):
+        """Changing a statement keeps the code cached by unrelated ones"""
+        p1 = pygg.ggplot('data', pygg.aes(x='a')) + pygg.geom_point()
+        layer = pygg.geom_line(size=1)
+        p2 = pygg.ggplot('data', pygg.aes(x='b')) + layer
+        r1, _ = p1.r, p2.r
+        layer.kwargs['size'] = 2
+        self.assertIs(p1.r, r1)
+        self.check_me(p2, "ggplot(data,aes(x=b))+geom_line(size=2)")
+
+    def testCachedRSettings(self):
+        """Cached code follows R_VECTOR_FILE_THRESHOLD"""
+        stmt = pygg.annotate(pygg.esc("point"), x=[1.5, 2.5, 3.5])
+        self.assertIn("c(1.5,2.5,3.5)", stmt.r)
+        prev, pygg.pygg.R_VECTOR_FILE_THRESHOLD = pygg.pygg.R_VECTOR_FILE_THRESHOLD, 2
+        try:
+            self.assertIn("readBin(", stmt.r)
+        finally:
+            pygg.pygg.R_VECTOR_FILE_THRESHOLD = prev
+        self.assertIn("c(1.5,2.5,3.5)", stmt.r)
+
+    def testGGStatementsPickle(self):
+        """Plots can be pickled and deep-copied, e.g. for multiprocessing"""
+        import copy
+        import pickle
+        df = pandas.DataFrame({'a': [1, 2]})
+        p = pygg.ggplot(df, pygg.aes(x='a')) + pygg.geom_point(size=1)
+        for q in (pickle.loads(pickle.dumps(p)), copy.deepcopy(p)):
+            self.check_me(q, "ggplot(data,aes(x=a))+geom_point(size=1)")
+            self.assertTrue(q.data.equals(df))
+            q.stmts[-1].kwargs['size'] = 2
+            self.check_me(q + pygg.geom_line(),
+                          "ggplot(data,aes(x=a))+geom_point(size=2)+geom_line()")
+            self.check_me(p, "ggplot(data,aes(x=a))+geom_point(size=1)")
+
+    def testGGStatementsManyLayers(self):
+        p = pygg.ggplot('data', pygg.aes(x='x'))
+        for i in range(10000):
+            p += pygg.geom_vline(xintercept=i)
+        self.assertEqual(len(p.stmts), 10001)
+        self.assertTrue(p.r.endswith("geom_vline(xintercept=9999)"))
+
     def testPython2RTypes(self):
         """Test GGStatement converts many python types properly"""
         self.check_me(pygg.geom_point(a=1), "geom_point(a=1)")
@@ -140,6 +328,28 @@ class TestUnits(unittest.TestCase):
                                       c={'list1': pygg.esc('s1'), 'list2': 2}),
                       'geom_point(1,a=2.0,b=c(3,4),c=list(list1="s1",list2=2))')
 
+    def testPython2RVectors(self):
+        """numpy arrays, Series and homogeneous lists become R vectors"""
+        self.check_me(pygg.geom_point(a=[1.5, float('nan'), float('inf'), -float('inf')]),
+                      'geom_point(a=c(1.5,NA,Inf,-Inf))')
+        self.check_me(pygg.geom_point(a=numpy.arange(3), b=numpy.array([0.5, numpy.nan])),
+                      'geom_point(a=c(0,1,2),b=c(0.5,NA))')
+        self.check_me(pygg.geom_point(a=pandas.Series([True, False]), b=[1, 2.5]),
+                      'geom_point(a=c(TRUE,FALSE),b=c(1,2.5))')
+        self.check_me(pygg.geom_point(a=numpy.array(['x', 'y'])), 'geom_point(a=c(x,y))')
+        self.check_me(pygg.geom_point(a=float('nan')), 'geom_point(a=NA)')
+
+    def testPython2RVectorFile(self):
+        prev, pygg.pygg.R_VECTOR_FILE_THRESHOLD = pygg.pygg.R_VECTOR_FILE_THRESHOLD, 3
+        self.addCleanup(setattr, pygg.pygg, 'R_VECTOR_FILE_THRESHOLD', prev)
+        r = pygg.annotate(x=numpy.arange(4), y=[0.5, 1.5, 2.5], z=[1, 2]).r
+        fnames = re.findall(r'readBin\("([^"]+)"', r)
+        self.assertEqual(len(fnames), 2)
+        self.assertIn('"integer", 4L, size=4', r)
+        self.assertIn('z=c(1,2)', r)
+        self.assertEqual(list(numpy.fromfile(fnames[0], '<i4')), [0, 1, 2, 3])
+        self.assertEqual(list(numpy.fromfile(fnames[1], '<f8')), [0.5, 1.5, 2.5])
+
     def testPython2RStringEsc(self):
         """Test GGStatement escapes strings properly"""
         self.check_me(pygg.geom_point(a="b"), 'geom_point(a=b)')
@@ -152,6 +362,831 @@ class TestUnits(unittest.TestCase):
                                       'geom_point(a=c("a","b"))')
 
 
+class RecordingBackend(object):
+    """Backend that records programs instead of running R"""
+    def __init__(self):
+        self.progs = []
+
+    def execute(self, prog, quiet):
+        self.progs.append(prog)
+
+
+class CSVRecordingBackend(RecordingBackend):
+    """Also reads the CSV files a program loads, as R would, before ggsave
+    deletes them"""
+    def __init__(self):
+        RecordingBackend.__init__(self)
+        self.frames = []
+
+    def execute(self, prog, quiet):
+        RecordingBackend.execute(self, prog, quiet)
+        for fname in re.findall(r'read.csv\("([^"]+)"', prog):
+            self.frames.append(pandas.read_csv(fname))
+
+
+class TestBackends(unittest.TestCase):
+    """ggsave and execute_r dispatch to pluggable backends"""
+    def testExplicitBackend(self):
+        backend = RecordingBackend()
+        p = pygg.ggplot('diamonds', pygg.aes(x='carat', y='price')) + pygg.geom_point()
+        prog = pygg.ggsave("out.pdf", p, data=None, quiet=True, backend=backend)
+        self.assertEqual(backend.progs, [prog])
+        self.assertNotIn("backend", prog)
+
+    def testDefaultBackend(self):
+        backend = RecordingBackend()
+        prev = pygg.set_default_backend(backend)
+        try:
+            pygg.execute_r("1 + 1", True)
+        finally:
+            pygg.set_default_backend(prev)
+        self.assertEqual(backend.progs, ["1 + 1"])
+
+    def fake_r(self, script):
+        """Point R_COMMAND at a shell script for the duration of the test"""
+        fname = tempfile.NamedTemporaryFile(suffix=".sh", delete=False).name
+        with open(fname, "w") as f:
+            f.write("#!/bin/sh\n" + script)
+        os.chmod(fname, 0o755)
+        prev, pygg.pygg.R_COMMAND = pygg.pygg.R_COMMAND, fname
+        self.addCleanup(setattr, pygg.pygg, "R_COMMAND", prev)
+        self.addCleanup(os.remove, fname)
+
+    def testSubprocessStreamsStdin(self):
+        self.fake_r("cat; echo oops >&2")
+        prog = "x = 1\n" * 200000     # larger than a single command line argument
+        result = pygg.execute_r(prog, True)
+        self.assertEqual(result.status, 0)
+        self.assertEqual(result.stdout, prog)
+        self.assertEqual(result.stderr, "oops\n")
+        self.assertTrue(result.elapsed >= 0)
+
+    def testSubprocessFailure(self):
+        self.fake_r("cat > /dev/null; exit 3")
+        with self.assertRaises(ValueError):
+            pygg.execute_r("stop()", True)
+
+    def testSubprocessError(self):
+        self.fake_r("cat > /dev/null\n"
+                    "printf '> library(ggplot2)\\n> p = geom_pointt()\\n'\n"
+                    "printf 'Warning message:\\nIn f() : careful\\n' >&2\n"
+                    "printf 'Error in geom_pointt() : could not find function\\n"
+                    "Execution halted\\n' >&2\n"
+                    "exit 1")
+        prog = "library(ggplot2)\np = geom_pointt()\nggsave('a.png', p)"
+        with self.assertRaises(pygg.RError) as cm:
+            pygg.execute_r(prog, True)
+        e = cm.exception
+        self.assertIsInstance(e, ValueError)
+        self.assertEqual((e.line, e.statement), (2, "p = geom_pointt()"))
+        self.assertEqual(e.message, "Error in geom_pointt() : could not find function")
+        self.assertEqual(e.result.warnings, ["In f() : careful"])
+        self.assertIn("line 2", str(e))
+
+    def testErrorWithoutEcho(self):
+        result = pygg.RenderResult(1, "Warning in g() : a\nError in aes(y=1) : oops\n")
+        e = pygg.RError("p = ggplot(data, aes(x=1))\nq = 1", result)
+        self.assertEqual((e.line, e.message), (1, "Error in aes(y=1) : oops"))
+        self.assertEqual(result.warnings, ["Warning in g() : a"])
+
+    def testErrorLineWithTiming(self):
+        class FailingBackend(object):
+            def execute(self, prog, quiet):
+                lines = prog.split("\n")
+                failing = next(i for i, line in enumerate(lines) if line.startswith("p = "))
+                echo = "".join("> %s\n" % line for line in lines[:failing + 1])
+                raise pygg.RError(prog, pygg.RenderResult(
+                    1, echo, "Error in geom_point() : boom\n"))
+
+        p = pygg.ggplot('diamonds', pygg.aes(x='carat')) + pygg.geom_point()
+        lines = pygg.ggsave("out.pdf", p, quiet=True, backend=RecordingBackend()).split("\n")
+        with self.assertRaises(pygg.RError) as cm:
+            pygg.ggsave("out.pdf", p, quiet=True, backend=FailingBackend(),
+                        on_timing=lambda timing: None)
+        e = cm.exception
+        self.assertEqual(e.line, lines.index(e.statement) + 1)
+        self.assertTrue(e.statement.startswith("p = ggplot(diamonds"))
+        self.assertNotIn(".pygg_timing", e.prog)
+
+    def testOnResult(self):
+        results = []
+        fname = tempfile.NamedTemporaryFile(suffix=".png", delete=False).name
+        self.addCleanup(os.remove, fname)
+        with open(fname, "w") as f:
+            f.write("12345")
+        pygg.ggsave(fname, pygg.geom_point(), quiet=True, backend=RecordingBackend(),
+                    on_result=results.append)
+        self.assertEqual(len(results), 1)
+        self.assertTrue(results[0].ok)
+        self.assertEqual((results[0].output, results[0].output_size), (fname, 5))
+
+    def testEmbeddedFallsBackToSubprocess(self):
+        backend = pygg.EmbeddedRBackend()
+        if backend.available:
+            self.skipTest("rpy2 is installed")
+        self.assertFalse(backend.accepts_data)
+        self.fake_r("cat")
+        self.assertEqual(backend.execute("1 + 1", True).stdout, "1 + 1")
+
+    def testEmbeddedRunsOnOneThread(self):
+        def name():
+            return threading.current_thread().name
+        call = pygg.EmbeddedRBackend._call
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            names = set(executor.map(lambda _: call(name), range(8)))
+        self.assertEqual(len(names), 1)
+        self.assertNotEqual(names, {name()})
+
+    def testInMemoryData(self):
+        class InMemoryBackend(RecordingBackend):
+            accepts_data = True
+
+            def execute(self, prog, quiet, data=None):
+                RecordingBackend.execute(self, prog, quiet)
+                self.data = data
+
+        backend = InMemoryBackend()
+        p = pygg.ggplot({'a': [1, 2]}, pygg.aes(x='a')) + pygg.geom_bar()
+        prog = pygg.ggsave("out.pdf", p, quiet=True, backend=backend)
+        self.assertNotIn("read.csv", prog)
+        self.assertEqual(list(backend.data.a), [1, 2])
+
+    def testTiming(self):
+        class TimingBackend(RecordingBackend):
+            def execute(self, prog, quiet):
+                RecordingBackend.execute(self, prog, quiet)
+                fname = re.search(r'file="([^"]+)"', prog).group(1)
+                with open(fname, "w") as f:
+                    f.write("r_libs\t0.5\t\nr_save\t0.25\t\n")
+
+        backend = TimingBackend()
+        timings = []
+        hook = pygg.add_timing_hook(timings.append)
+        self.addCleanup(pygg.remove_timing_hook, hook)
+        p = pygg.ggplot('diamonds', pygg.aes(x='carat')) + pygg.geom_bar()
+        prog = pygg.ggsave("out.pdf", p, quiet=True, backend=backend,
+                           on_timing=timings.append)
+        self.assertNotIn(".pygg_timing", prog)
+        self.assertIn('.pygg_timing("r_plot")', backend.progs[0])
+        self.assertEqual(len(timings), 2)
+        stages = timings[0].stages
+        self.assertEqual(list(stages), ['prepare', 'data', 'program', 'r',
+                                        'r_libs', 'r_save', 'r_overhead'])
+        self.assertEqual((stages['r_libs'], stages['r_save']), (0.5, 0.25))
+        self.assertFalse(timings[0].cached)
+        self.assertTrue(timings[0].total >= stages['r'])
+
+    def testClosedPoolFails(self):
+        pool = pygg.RWorkerPool(size=1)
+        pool.close()
+        with self.assertRaises(ValueError):
+            pool.execute("1 + 1", True)
+
+
+class TestDataCache(unittest.TestCase):
+    """DataCache reuses files written for identical data"""
+    def setUp(self):
+        self.cache = pygg.DataCache()
+
+    def tearDown(self):
+        self.cache.clear()
+        os.rmdir(self.cache.directory)
+
+    def testReuse(self):
+        df = pandas.DataFrame({'a': [1, 2], 'b': [3, 4]})
+        d1 = pygg.data_py(df, cache=self.cache)
+        d2 = pygg.data_py(df.copy(), cache=self.cache)
+        self.assertEqual(d1.fname, d2.fname)
+        self.assertEqual(len(self.cache), 1)
+
+        d3 = pygg.data_py(df, transfer='binary', cache=self.cache)
+        d4 = pygg.data_py(pandas.DataFrame({'a': [1, 2], 'b': [3, 5]}), cache=self.cache)
+        self.assertEqual(len({d1.fname, d3.fname, d4.fname}), 3)
+
+    def testTransferDirectory(self):
+        datao = pygg.data_py({'a': [1.5]}, transfer='shm', cache=self.cache)
+        directory = pygg.SharedMemoryTransfer.directory or self.cache.directory
+        self.assertEqual(os.path.dirname(datao.fname), directory)
+        self.assertEqual(len(self.cache), 1)
+
+    def testEvictionAndClear(self):
+        self.cache.max_bytes = 1
+        d1 = pygg.data_py({'a': [1]}, cache=self.cache)
+        d2 = pygg.data_py({'a': [2]}, cache=self.cache)
+        self.assertEqual(len(self.cache), 1)
+        self.assertFalse(os.path.exists(d1.fname))
+        self.assertTrue(os.path.exists(d2.fname))
+
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.nbytes, 0)
+        self.assertFalse(os.path.exists(d2.fname))
+
+    def testDefaultCache(self):
+        prev = pygg.set_data_cache(self.cache)
+        try:
+            d1 = pygg.data_py({'a': [1]})
+            d2 = pygg.data_py({'a': [1]})
+        finally:
+            pygg.set_data_cache(prev)
+        self.assertEqual(d1.fname, d2.fname)
+
+
+class ImageBackend(RecordingBackend):
+    """Backend that writes the program to the ggsave output file"""
+    def execute(self, prog, quiet):
+        RecordingBackend.execute(self, prog, quiet)
+        fname = re.search(r'ggsave\("([^"]+)"', prog).group(1)
+        with open(fname, "w") as f:
+            f.write(prog)
+
+
+class TestRenderCache(unittest.TestCase):
+    """RenderCache skips R for programs that were already rendered"""
+    def setUp(self):
+        self.cache = pygg.RenderCache(tempfile.mkdtemp())
+        self.outdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.cache.directory)
+        shutil.rmtree(self.outdir)
+
+    def save(self, backend, name, data, **kwargs):
+        p = pygg.ggplot(data, pygg.aes(x='a')) + pygg.geom_bar()
+        name = os.path.join(self.outdir, name)
+        pygg.ggsave(name, p, quiet=True, backend=backend,
+                    render_cache=self.cache, **kwargs)
+        return name
+
+    def testHitsAndMisses(self):
+        backend = ImageBackend()
+        first = self.save(backend, "a.png", {'a': [1, 2]})
+        second = self.save(backend, "b.png", {'a': [1, 2]})
+        self.assertEqual(len(backend.progs), 1)
+        with open(first) as f1, open(second) as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+        self.save(backend, "c.pdf", {'a': [1, 2]})
+        self.save(backend, "d.png", {'a': [1, 3]})
+        self.save(backend, "e.png", {'a': [1, 2]}, width=3)
+        self.assertEqual(len(backend.progs), 4)
+
+    def testEviction(self):
+        self.cache.max_bytes = 1
+        backend = ImageBackend()
+        self.save(backend, "a.png", {'a': [1]})
+        self.save(backend, "b.png", {'a': [2]})
+        self.assertEqual(len(self.cache.entries()), 0)
+        self.save(backend, "c.png", {'a': [1]})
+        self.assertEqual(len(backend.progs), 3)
+
+
+class TestQueryCache(unittest.TestCase):
+    """QueryCache lets R reuse saved data_sql results"""
+    def setUp(self):
+        self.cache = pygg.QueryCache(tempfile.mkdtemp(), ttl=60)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.cache.directory)
+
+    def testKey(self):
+        path = self.cache.path("db", "SELECT a\n  FROM t;")
+        self.assertEqual(path, self.cache.path("db", " SELECT a FROM t"))
+        self.assertNotEqual(path, self.cache.path("db", "SELECT a FROM t", driver='SQLite'))
+        self.assertNotEqual(path, self.cache.path("db2", "SELECT a FROM t"))
+        self.assertNotEqual(self.cache.path("db", "SELECT 'a  b'"),
+                            self.cache.path("db", "SELECT 'a b'"))
+
+    def testDataSQL(self):
+        datao = pygg.data_sql("db", "SELECT a FROM t", cache=self.cache)
+        self.assertIn('path = "%s"' % self.cache.path("db", "SELECT a FROM t"), str(datao))
+        self.assertIn('readRDS(path)', str(datao))
+        self.assertIn('< 60)', str(datao))
+        p = pygg.ggplot('data', pygg.aes(x='a')) + pygg.geom_bar()
+        _, newdata = pygg.aggregate_sql(p, datao)
+        self.assertIs(newdata.query_cache, self.cache)
+        self.assertNotIn("readRDS", str(pygg.data_sql("db", "SELECT a FROM t")))
+
+    def testEviction(self):
+        fresh = os.path.join(self.cache.directory, "fresh.rds")
+        old = os.path.join(self.cache.directory, "old.rds")
+        for fname in (fresh, old):
+            with open(fname, "w") as f:
+                f.write("x")
+        os.utime(old, (0, 0))
+        self.cache.evict()
+        self.assertEqual([e[0] for e in self.cache.entries()], [fresh])
+        self.assertNotIsInstance(self.cache, pygg.RenderCache)
+
+
+class TestTempWorkspace(unittest.TestCase):
+    """TempWorkspace owns the temporary files pygg writes"""
+    def setUp(self):
+        self.workspace = pygg.TempWorkspace()
+
+    def tearDown(self):
+        self.workspace.cleanup()
+
+    def touch(self, nbytes=1, **kwargs):
+        fname = self.workspace.new_file('.csv', **kwargs)
+        with open(fname, "w") as f:
+            f.write("x" * nbytes)
+        return fname
+
+    def testReleaseAndPin(self):
+        fname = self.touch()
+        pinned = self.touch(pin=True)
+        self.workspace.release(fname)
+        self.workspace.release(pinned)
+        self.assertFalse(os.path.exists(fname))
+        self.assertTrue(os.path.exists(pinned))
+        self.workspace.unpin(pinned)
+        self.workspace.release(pinned)
+        self.assertFalse(os.path.exists(pinned))
+
+        # files it doesn't own are left alone
+        with tempfile.NamedTemporaryFile() as f:
+            self.workspace.release(f.name)
+            self.assertTrue(os.path.exists(f.name))
+
+    def testGC(self):
+        old, pinned = self.touch(), self.touch(pin=True)
+        big, small = self.touch(10), self.touch(10)
+        self.workspace._files[old] = self.workspace._files[pinned] = 0
+        self.workspace.max_bytes = 15
+        self.assertEqual(self.workspace.gc(), 2)
+        self.assertEqual([f for f in (old, pinned, big, small) if os.path.exists(f)],
+                         [pinned, small])
+
+    def testContextManager(self):
+        with pygg.TempWorkspace() as workspace:
+            self.assertIs(pygg.get_workspace(), workspace)
+            datao = pygg.data_py({'a': [1, 2]})
+            self.assertIn(datao.fname, workspace)
+            self.assertTrue(os.path.exists(datao.fname))
+        self.assertIsNot(pygg.get_workspace(), workspace)
+        self.assertFalse(os.path.exists(datao.fname))
+        self.assertFalse(os.path.exists(workspace.directory))
+
+    def testGGSaveReleasesData(self):
+        backend = CSVRecordingBackend()
+        cache = pygg.DataCache()
+        p = pygg.ggplot('data', pygg.aes(x='a')) + pygg.geom_bar()
+        with self.workspace:
+            pygg.ggsave("out.pdf", p, data={'a': [1, 2]}, quiet=True, backend=backend)
+            pygg.ggsave("out.pdf", p, data={'a': [3, 4]}, quiet=True, backend=backend,
+                        data_cache=cache)
+            self.assertEqual([len(df) for df in backend.frames], [2, 2])
+            fnames = [re.search(r'read.csv\("([^"]+)"', prog).group(1)
+                      for prog in backend.progs]
+            self.assertFalse(os.path.exists(fnames[0]))
+            self.assertTrue(os.path.exists(fnames[1]))
+            cache.clear()
+            self.assertEqual(len(self.workspace), 0)
+        os.rmdir(cache.directory)
+
+    def testDataKeptDuringRender(self):
+        # creating the timing marker file collects files over max_bytes
+        self.workspace.max_bytes = 1
+        backend = CSVRecordingBackend()
+        timings = []
+        p = pygg.ggplot('data', pygg.aes(x='a')) + pygg.geom_bar()
+        with self.workspace:
+            pygg.ggsave("out.pdf", p, data={'a': list(range(100))}, quiet=True,
+                        backend=backend, on_timing=timings.append)
+            pygg.ggsave_many([("out.pdf", p)], data={'a': list(range(100))},
+                             quiet=True, backend=backend)
+            self.assertEqual([len(df) for df in backend.frames], [100, 100])
+            self.assertEqual(len(timings), 1)
+            self.assertEqual(len(self.workspace), 0)
+
+
+class AggregationTestCase(unittest.TestCase):
+    """Loads the same rows into sqlite and data_sql"""
+    def setUp(self):
+        import sqlite3
+        self.db = sqlite3.connect(":memory:")
+        self.db.execute("CREATE TABLE t (price REAL, cut TEXT, carat REAL)")
+        self.rows = [(float(i * 7 % 1000), "abc"[i % 3], (i % 50) / 10.0)
+                     for i in range(1000)]
+        self.db.executemany("INSERT INTO t VALUES (?, ?, ?)", self.rows)
+        self.data = pygg.data_sql("db", "SELECT * FROM t;")
+
+    def aggregate(self, plot):
+        newplot, newdata = pygg.aggregate_sql(plot, self.data)
+        self.assertIsNot(newdata, self.data)
+        return newplot, self.db.execute(newdata.sql).fetchall()
+
+
+class TestAggregateSQL(AggregationTestCase):
+    """aggregate_sql rewrites data_sql queries; checked against sqlite"""
+
+    def testHistogram(self):
+        p = pygg.ggplot('data', pygg.aes(x='price')) + pygg.geom_histogram(binwidth=100)
+        newplot, rows = self.aggregate(p)
+        self.assertIn('geom_histogram(aes(y=count),stat="identity"', newplot.r)
+        self.assertEqual(sum(r[1] for r in rows), len(self.rows))
+        self.assertEqual(sorted(r[0] for r in rows), [i * 100.0 for i in range(11)])
+
+    def testHistogramBinsWithFacets(self):
+        p = pygg.ggplot('data', pygg.aes(x='price', fill='cut'))
+        p += pygg.geom_histogram(bins=10) + pygg.facet_wrap("~cut")
+        newplot, rows = self.aggregate(p)
+        self.assertIn('facet_wrap(~cut)', newplot.r)
+        self.assertEqual(len(set(r[0] for r in rows)), 10)
+        self.assertEqual(sum(r[2] for r in rows if r[1] == 'a'), 334)
+
+    def testCount(self):
+        p = pygg.ggplot('data', pygg.aes(x='cut')) + pygg.geom_bar()
+        newplot, rows = self.aggregate(p)
+        self.assertEqual(sorted(rows), [('a', 334), ('b', 333), ('c', 333)])
+
+    def testSummary(self):
+        p = pygg.ggplot('data', pygg.aes(x='cut', y='carat'))
+        p += pygg.stat_summary(fun='max', geom=pygg.esc('line'))
+        newplot, rows = self.aggregate(p)
+        self.assertIn('stat_identity(geom="line")', newplot.r)
+        self.assertEqual(sorted(rows), [('a', 4.9), ('b', 4.9), ('c', 4.9)])
+
+    def testBin2d(self):
+        p = pygg.ggplot('data', pygg.aes(x='price', y='carat'))
+        p += pygg.geom_bin2d(bins=[10, 5])
+        newplot, rows = self.aggregate(p)
+        self.assertIn('geom_tile(aes(fill=count)', newplot.r)
+        self.assertEqual(len(rows), 50)
+        self.assertEqual(sum(r[2] for r in rows), len(self.rows))
+
+    def testUnsupportedPlotsUnchanged(self):
+        plots = [
+            pygg.ggplot('data', pygg.aes(x='price', y='carat')) + pygg.geom_point(),
+            pygg.ggplot('data', pygg.aes(x='price')) + pygg.geom_histogram() + pygg.geom_rug(),
+            pygg.ggplot('data', pygg.aes(x='log(price)')) + pygg.geom_histogram(),
+            pygg.ggplot('data', pygg.aes(x='cut', weight='carat')) + pygg.geom_bar(),
+            pygg.ggplot('data', pygg.aes(x='cut', y='price')) + pygg.stat_summary(),
+            pygg.ggplot('diamonds', pygg.aes(x='price')) + pygg.geom_histogram(),
+        ]
+        hist = pygg.ggplot('data', pygg.aes(x='price')) + pygg.geom_histogram(bins=30)
+        # bins are computed on the transformed or limited scale
+        for scale in [pygg.scale_x_log10(), pygg.scale_x_continuous(trans='sqrt'),
+                      pygg.scale_x_continuous(limits=[0, 100]), pygg.xlim(0, 100),
+                      pygg.coord_cartesian(xlim=[0, 100]), pygg.coord_trans(x='log10')]:
+            plots.append(hist + scale)
+        free = pygg.facet_wrap('~cut', scales=pygg.esc('free_x'))
+        plots += [hist + free, pygg.ggplot('data', pygg.aes(x='price')) + pygg.geom_histogram() + free]
+        newplot, _ = pygg.aggregate_sql(
+            pygg.ggplot('data', pygg.aes(x='price')) + pygg.geom_histogram(binwidth=100) + free,
+            self.data)
+        self.assertIn('stat="identity"', newplot.r)
+        for p in plots:
+            newplot, newdata = pygg.aggregate_sql(p, self.data)
+            self.assertIs(newplot, p)
+            self.assertIs(newdata, self.data)
+
+
+class TestAggregateDF(AggregationTestCase):
+    """aggregate_df bins and counts in pandas the same way as aggregate_sql"""
+    def check_same(self, plot):
+        df = pandas.DataFrame(self.rows, columns=['price', 'cut', 'carat'])
+        sqlplot, sqlrows = self.aggregate(plot)
+        dfplot, agg = pygg.aggregate_df(plot, df)
+        self.assertEqual(dfplot.r, sqlplot.r)
+        self.assertEqual(sorted(agg.itertuples(index=False, name=None)), sorted(sqlrows))
+        return agg
+
+    def testSameAsSQL(self):
+        base = pygg.ggplot('data', pygg.aes(x='price', fill='cut'))
+        self.check_same(base + pygg.geom_histogram(binwidth=100))
+        self.check_same(base + pygg.geom_histogram(bins=7) + pygg.facet_grid("cut~."))
+        self.check_same(pygg.ggplot('data', pygg.aes(x='cut')) + pygg.geom_bar())
+        self.check_same(pygg.ggplot('data', pygg.aes(x='cut', y='carat')) +
+                        pygg.stat_summary(fun='length'))
+        agg = self.check_same(pygg.ggplot('data', pygg.aes(x='carat', y='price')) +
+                              pygg.stat_bin_2d(binwidth=[1, 250]))
+        self.assertEqual(list(agg.columns),
+                         ['carat', 'price', 'count', 'pygg_width', 'pygg_height'])
+
+    def testGGSaveAggregates(self):
+        backend = CSVRecordingBackend()
+        df = pandas.DataFrame(self.rows, columns=['price', 'cut', 'carat'])
+        p = pygg.ggplot(df, pygg.aes(x='price')) + pygg.geom_histogram(binwidth=100)
+        prog = pygg.ggsave("out.pdf", p, quiet=True, aggregate=True, backend=backend)
+        self.assertIn('stat="identity"', prog)
+        self.assertEqual(len(backend.frames[0]), 11)
+
+        # the postfix may change the columns the layer bins
+        prog = pygg.ggsave("out.pdf", p, quiet=True, aggregate=True, backend=backend,
+                           postfix="data$price = data$price * 2")
+        self.assertNotIn('stat="identity"', prog)
+        self.assertEqual(len(backend.frames[1]), len(self.rows))
+
+    def testMissingColumnUnchanged(self):
+        p = pygg.ggplot('data', pygg.aes(x='nope')) + pygg.geom_histogram()
+        df = pandas.DataFrame({'a': [1, 2]})
+        newplot, newdata = pygg.aggregate_df(p, df)
+        self.assertIs(newplot, p)
+        self.assertIs(newdata, df)
+
+
+class TestDownsample(unittest.TestCase):
+    """downsample drops rows that map onto the same output pixel"""
+    def setUp(self):
+        n = 10000
+        self.df = pandas.DataFrame({'x': numpy.arange(n) % 100,
+                                    'y': numpy.arange(n) // 100})
+
+    def testPoints(self):
+        p = pygg.ggplot(self.df, pygg.aes(x='x', y='y')) + pygg.geom_point()
+        self.assertEqual(len(pygg.downsample(p, self.df, 10, 10)), 100)
+        self.assertIs(pygg.downsample(p, self.df, 1000, 1000), self.df)
+
+        df = pandas.concat([self.df.assign(c=0), self.df.assign(c=1)])
+        p = pygg.ggplot(df, pygg.aes(x='x', y='y', color='c')) + pygg.geom_point()
+        self.assertEqual(len(pygg.downsample(p, df, 10, 10)), 200)
+
+    def testLines(self):
+        df = pandas.DataFrame({'x': range(1000), 'y': [i % 7 for i in range(1000)]})
+        p = pygg.ggplot(df, pygg.aes(x='x', y='y')) + pygg.geom_line()
+        small = pygg.downsample(p, df, 10, 10)
+        self.assertTrue(len(small) <= 40)
+        self.assertEqual(small.x.min(), 0)
+        self.assertEqual(small.x.max(), 999)
+        self.assertEqual(set(small.y), set(range(7)))
+
+    def testUnsupported(self):
+        p = pygg.ggplot(self.df, pygg.aes(x='x', y='y')) + pygg.geom_point() + pygg.geom_smooth()
+        self.assertIs(pygg.downsample(p, self.df, 10, 10), self.df)
+        p = pygg.ggplot(self.df, pygg.aes(x='x', y='y')) + pygg.geom_point(pygg.aes(size='nope'))
+        self.assertIs(pygg.downsample(p, self.df, 10, 10), self.df)
+        # pixels aren't linear in the data, or only part of it is visible
+        points = pygg.ggplot(self.df, pygg.aes(x='x', y='y')) + pygg.geom_point()
+        for scale in [pygg.scale_x_log10(), pygg.scale_y_sqrt(), pygg.ylim(0, 10),
+                      pygg.scale_x_continuous(limits=[0, 10]),
+                      pygg.coord_cartesian(xlim=[0, 10]), pygg.coord_polar()]:
+            self.assertIs(pygg.downsample(points + scale, self.df, 10, 10), self.df)
+
+    def testFreeFacetScales(self):
+        df = pandas.DataFrame({'x': numpy.arange(2000) % 1000,
+                               'y': numpy.r_[numpy.linspace(-1, 1, 1000), numpy.arange(1000.0)],
+                               'g': [0] * 1000 + [1] * 1000})
+        p = pygg.ggplot(df, pygg.aes(x='x', y='y')) + pygg.geom_point()
+        self.assertLess(len(pygg.downsample(p + pygg.facet_wrap('~g'), df, 200, 200)), 1000)
+        free = p + pygg.facet_wrap('~g', scales=pygg.esc('free_y'))
+        self.assertIs(pygg.downsample(free, df, 200, 200), df)
+
+    def testMissingValues(self):
+        import warnings
+        df = self.df.astype(float)
+        df.loc[[3, 5], 'y'] = numpy.nan
+        df.loc[7, 'x'] = numpy.inf
+        for layer in (pygg.geom_point(), pygg.geom_line()):
+            p = pygg.ggplot(df, pygg.aes(x='x', y='y')) + layer
+            with warnings.catch_warnings():
+                warnings.simplefilter("error")
+                small = pygg.downsample(p, df, 10, 10)
+            self.assertTrue({3, 5, 7} <= set(small.index))
+            self.assertLess(len(small), 200)
+
+    def testOutputPixels(self):
+        self.assertEqual(pygg.pygg._output_pixels(dict(width=10, height=8)), (3000, 2400))
+        self.assertEqual(pygg.pygg._output_pixels(dict(width=2.54, height=1, units=pygg.esc('cm'),
+                                                  dpi=100, scale=2)), (200, 78))
+
+    def testGGSaveDownsamples(self):
+        backend = CSVRecordingBackend()
+        p = pygg.ggplot(self.df, pygg.aes(x='x', y='y')) + pygg.geom_point()
+        pygg.ggsave("out.png", p, quiet=True, backend=backend, downsample=True,
+                    width=10, height=10, units=pygg.esc('px'))
+        self.assertEqual(len(backend.frames[0]), 100)
+        pygg.ggsave("out.png", p, quiet=True, backend=backend, downsample=True,
+                    width=10, height=10, units=pygg.esc('px'),
+                    custom_stmts="p = p + scale_x_log10()")
+        self.assertEqual(len(backend.frames[1]), len(self.df))
+
+
+class TestPruneColumns(unittest.TestCase):
+    """Only the columns a plot refers to are exported"""
+    def setUp(self):
+        self.df = pandas.DataFrame({'a': [1, 2], 'b': [3, 4], 'c': [5, 6],
+                                    'd': [7, 8], 'e': [9, 10]})
+        self.caches = []
+
+    def testReferencedColumns(self):
+        p = pygg.ggplot(self.df, pygg.aes(x='log(a)', y='`b`')) + pygg.facet_wrap('~c')
+        names = pygg.referenced_columns(p, 'data$d = 1')
+        self.assertTrue({'a', 'b', 'c', 'd'} <= names)
+        self.assertNotIn('e', names)
+
+    def testPrune(self):
+        self.assertEqual(list(pygg.prune_columns(self.df, {'a', 'c'}, ['e']).columns),
+                         ['a', 'c', 'e'])
+        self.assertIs(pygg.prune_columns(self.df, {'x'}), self.df)
+        chunks = pygg.prune_columns(iter([self.df, self.df]), {'b'})
+        self.assertEqual([list(chunk.columns) for chunk in chunks], [['b'], ['b']])
+
+    def tearDown(self):
+        import shutil
+        for cache in self.caches:
+            shutil.rmtree(cache.directory)
+
+    def testGGSave(self):
+        p = pygg.ggplot(self.df, pygg.aes(x='a', y='b')) + pygg.geom_point()
+        for kwargs, columns in [({}, ['a', 'b']),
+                                ({'postfix': 'data$c = data$c * 2'}, ['a', 'b', 'c']),
+                                ({'keep_columns': ['e']}, ['a', 'b', 'e']),
+                                ({'prune': False}, list('abcde'))]:
+            self.caches.append(pygg.DataCache())
+            prog = pygg.ggsave(None, p, quiet=True, data_cache=self.caches[-1], **kwargs)
+            fname = re.search(r'read\.csv\("([^"]+)"', prog).group(1)
+            self.assertEqual(list(pandas.read_csv(fname).columns), columns)
+
+    def testWholeDataUse(self):
+        df = pandas.DataFrame({'a': [1, 2], 'b': [3, 4], 'c': [5, 6]})
+        p = pygg.ggplot(df, pygg.aes(x='x', y='y')) + pygg.geom_point()
+        for postfix in ["names(data) = c('x', 'y', 'z')", "data = data[data$a > 1, ]",
+                        "data$x = data[[1]]", "n = ncol(data)"]:
+            self.assertIsNone(pygg.referenced_columns(p, postfix))
+            self.assertIs(pygg.prune_columns(df, pygg.referenced_columns(p, postfix)), df)
+        self.assertEqual(pygg.referenced_columns(p, "data$x = data$a"),
+                         pygg.referenced_columns(p) | {'a'})
+
+        backend = CSVRecordingBackend()
+        pygg.ggsave("out.pdf", p, quiet=True, backend=backend,
+                    postfix="names(data) = c('x', 'y', 'z')")
+        self.assertEqual(list(backend.frames[0].columns), ['a', 'b', 'c'])
+
+    def testRNames(self):
+        # read.csv rewrites the names, and plots use R's version
+        df = pandas.DataFrame({'Sepal Length': [1, 2], 0: [3, 4], 'x': [5, 6], 'e': [7, 8]})
+        self.assertEqual(pygg.r_make_name('Sepal Length'), 'Sepal.Length')
+        self.assertEqual(pygg.r_make_name(0), 'X0')
+        p = pygg.ggplot(df, pygg.aes(x='Sepal.Length', y='X0')) + pygg.geom_point()
+        pruned = pygg.prune_columns(df, pygg.referenced_columns(p))
+        self.assertEqual(list(pruned.columns), ['Sepal Length', 0, 'x'])
+
+
+class TestConcurrentRendering(unittest.TestCase):
+    """submit and ggsave_async run renders on a bounded thread pool"""
+    def setUp(self):
+        self.plot = pygg.ggplot('diamonds', pygg.aes(x='carat')) + pygg.geom_bar()
+        self.concurrency = pygg.pygg.RENDER_CONCURRENCY
+
+    def tearDown(self):
+        pygg.set_render_concurrency(self.concurrency)
+
+    def testConcurrencyLimit(self):
+        import threading
+        import time
+
+        class SlowBackend(object):
+            def __init__(self):
+                self.lock = threading.Lock()
+                self.running = self.peak = 0
+
+            def execute(self, prog, quiet):
+                with self.lock:
+                    self.running += 1
+                    self.peak = max(self.peak, self.running)
+                time.sleep(0.05)
+                with self.lock:
+                    self.running -= 1
+
+        pygg.set_render_concurrency(2)
+        backend = SlowBackend()
+        futures = [pygg.submit("%d.pdf" % i, self.plot, quiet=True, backend=backend)
+                   for i in range(6)]
+        for future in futures:
+            self.assertIn('ggsave("', future.result())
+        self.assertEqual(backend.peak, 2)
+
+    def testErrorsPropagate(self):
+        class FailingBackend(object):
+            def execute(self, prog, quiet):
+                raise ValueError("boom")
+
+        future = pygg.submit("a.pdf", self.plot, quiet=True, backend=FailingBackend())
+        self.assertIsInstance(future.exception(), ValueError)
+
+        with self.assertRaises(ValueError):
+            asyncio.run(pygg.ggsave_async("a.pdf", self.plot, quiet=True,
+                                          backend=FailingBackend()))
+
+    def testAsync(self):
+        backend = RecordingBackend()
+
+        async def render():
+            return await asyncio.gather(
+                pygg.ggsave_async("a.pdf", self.plot, quiet=True, backend=backend),
+                pygg.ggsave_async("b.pdf", self.plot, quiet=True, backend=backend))
+
+        progs = asyncio.run(render())
+        self.assertEqual(sorted(progs), sorted(backend.progs))
+
+
+class TestPartitions(unittest.TestCase):
+    """ggsave_partitions renders one plot per group"""
+    def setUp(self):
+        self.df = pandas.DataFrame({'k': ['a', 'b', 'a', 'c'], 'x': [1, 2, 3, 4]})
+
+    def testTemplate(self):
+        backend = CSVRecordingBackend()
+        p = pygg.ggplot('data', pygg.aes(x='x')) + pygg.geom_bar()
+        with pygg.TempWorkspace() as workspace:
+            results = pygg.ggsave_partitions(self.df, 'k', p, "{key}.pdf", processes=2,
+                                             backend=backend)
+            self.assertEqual(len(workspace), 0)
+        self.assertEqual([(r.key, r.name, r.error) for r in results],
+                         [('a', 'a.pdf', None), ('b', 'b.pdf', None), ('c', 'c.pdf', None)])
+        self.assertTrue(all(r.seconds >= 0 for r in results))
+        self.assertEqual(len(backend.progs), 3)
+        # only the column the plot uses is exported
+        self.assertEqual([list(frame.columns) for frame in backend.frames], [['x']] * 3)
+        self.assertEqual(sorted(list(frame.x) for frame in backend.frames), [[1, 3], [2], [4]])
+
+    def testCallables(self):
+        class FailOnB(RecordingBackend):
+            def execute(self, prog, quiet):
+                if '"b.png"' in prog:
+                    raise ValueError("bad partition")
+
+        def make_plot(key, partition):
+            return pygg.ggplot('data', pygg.aes(x='x')) + pygg.ggtitle(pygg.esc(key))
+
+        results = pygg.ggsave_partitions(self.df, 'k', make_plot, lambda k: "%s.png" % k,
+                                         backend=FailOnB())
+        self.assertEqual([r.error for r in results], [None, "bad partition", None])
+
+
+class TestGGSaveMany(unittest.TestCase):
+    """ggsave_many builds one R program for many plots"""
+    def testSharedDataLoadedOnce(self):
+        backend = RecordingBackend()
+        df = pandas.DataFrame({'a': [1, 2], 'b': [3, 4]})
+        p = pygg.ggplot(df, pygg.aes(x='a', y='b'))
+        results = pygg.ggsave_many([("a.pdf", p + pygg.geom_point()),
+                                    ("b.png", p + pygg.geom_line(), dict(width=3))],
+                                   quiet=True, backend=backend)
+        prog, = backend.progs
+        self.assertEqual(prog.count("read.csv"), 1)
+        self.assertEqual(prog.count("tryCatch"), 2)
+        self.assertIn('ggsave("b.png",p,height=8,scale=1,width=3)', prog)
+        self.assertEqual([name for name, _ in results], ["a.pdf", "b.png"])
+
+    def testDistinctData(self):
+        backend = RecordingBackend()
+        p1 = pygg.ggplot({'a': [1]}, pygg.aes(x='a')) + pygg.geom_bar()
+        p2 = pygg.ggplot({'a': [2]}, pygg.aes(x='a')) + pygg.geom_bar()
+        pygg.ggsave_many([("a.pdf", p1), ("b.pdf", p2), ("c.pdf", p1)],
+                         quiet=True, backend=backend)
+        prog, = backend.progs
+        self.assertEqual(prog.count("read.csv"), 2)
+        self.assertEqual(prog.count("data = .pygg_data_0"), 2)
+        self.assertEqual(prog.count("data = .pygg_data_1"), 1)
+
+    def testPlotWithoutData(self):
+        backend = RecordingBackend()
+        p1 = pygg.ggplot({'a': [1]}, pygg.aes(x='a')) + pygg.geom_bar()
+        p2 = pygg.ggplot(None, pygg.aes(x=1)) + pygg.geom_bar()
+        pygg.ggsave_many([("a.pdf", p1), ("b.pdf", p2), ("c.pdf", p1)],
+                         quiet=True, backend=backend)
+        prog, = backend.progs
+        self.assertEqual(prog.count("read.csv"), 1)
+        blocks = prog.split("tryCatch(")[1:]
+        self.assertIn("data = .pygg_data_0", blocks[0])
+        self.assertIn('rm(data)', blocks[1])
+        self.assertNotIn(".pygg_data_0", blocks[1])
+        self.assertIn("data = .pygg_data_0", blocks[2])
+
+    def testPerPlotErrors(self):
+        class StatusBackend(object):
+            def execute(self, prog, quiet):
+                fname = re.search(r'file="([^"]+)"', prog).group(1)
+                with open(fname, "w") as f:
+                    f.write("0\tOK\n1\tERR\tobject 'MISSING' not found\t\n")
+
+        p = pygg.ggplot('diamonds', pygg.aes(x='carat')) + pygg.geom_histogram()
+        results = pygg.ggsave_many([("a.pdf", p), ("b.pdf", p), ("c.pdf", p)],
+                                   quiet=True, backend=StatusBackend())
+        self.assertEqual(results, [("a.pdf", None),
+                                   ("b.pdf", "object 'MISSING' not found"),
+                                   ("c.pdf", "plot was not rendered")])
+
+    def testOptions(self):
+        backend = RecordingBackend()
+        p = pygg.ggplot('diamonds', pygg.aes(x='carat')) + pygg.geom_histogram()
+        pygg.ggsave_many([("a.pdf", p)], quiet=True, backend=backend,
+                         custom_stmts="p = p + theme_bw()", prune=False)
+        self.assertIn('ggsave("a.pdf",p,height=8,scale=1,width=10)', backend.progs[0])
+        cache = pygg.RenderCache(tempfile.mkdtemp())
+        self.addCleanup(os.rmdir, cache.directory)
+        for kwargs in [{'render_cache': cache}, {'aggregate': True}, {'on_timing': print}]:
+            with self.assertRaises(ValueError):
+                pygg.ggsave_many([("a.pdf", p)], quiet=True, backend=backend, **kwargs)
+        with self.assertRaises(ValueError):
+            pygg.ggsave_many([("a.pdf", p, dict(quiet=True))], quiet=True, backend=backend)
+
+
 class TestIntegration(unittest.TestCase):
     """Basic unit testing for pygg"""
     def testE2E(self):
@@ -237,6 +1272,50 @@ class TestIntegration(unittest.TestCase):
         self.assertTrue(os.path.exists(tmpfile))
         self.assertTrue(os.path.getsize(tmpfile) > 0)
 
+    def testWorkerPool(self):
+        p = pygg.ggplot('diamonds', pygg.aes(x='carat', y='price')) + pygg.geom_point()
+        with pygg.RWorkerPool(size=1, libs=['grid']) as pool:
+            for ext in ['.pdf', '.png']:
+                tmpfile = tempfile.NamedTemporaryFile(suffix=ext).name
+                pygg.ggsave(tmpfile, p, data=None, quiet=True, backend=pool)
+                self.assertTrue(os.path.getsize(tmpfile) > 0)
+
+            bad = pygg.ggplot('diamonds', pygg.aes(x='MISSING')) + pygg.geom_point()
+            with self.assertRaises(ValueError):
+                tmpfile = tempfile.NamedTemporaryFile(suffix=".png").name
+                pygg.ggsave(tmpfile, bad, data=None, quiet=True, backend=pool)
+
+    def testGGSaveMany(self):
+        data = pandas.read_csv(io.StringIO(IRIS_DATA_CSV))
+        p = pygg.ggplot(data, pygg.aes(x='SepalLength', y='PetalLength'))
+        good = tempfile.NamedTemporaryFile(suffix=".pdf").name
+        bad = tempfile.NamedTemporaryFile(suffix=".pdf").name
+        results = pygg.ggsave_many([(good, p + pygg.geom_point()),
+                                    (bad, p + pygg.geom_point(pygg.aes(color='MISSING')))],
+                                   quiet=True)
+        self.assertIsNone(results[0][1])
+        self.assertIsNotNone(results[1][1])
+        self.assertTrue(os.path.getsize(good) > 0)
+
+    def testBinaryTransfer(self):
+        data = pandas.read_csv(io.StringIO(IRIS_DATA_CSV))
+        data['Name'] = data['Name'].astype('category')
+        p = pygg.ggplot(data, pygg.aes(x='SepalLength', y='PetalLength', color='Name'))
+        p += pygg.geom_point()
+        tmpfile = tempfile.NamedTemporaryFile(suffix=".pdf").name
+        pygg.ggsave(tmpfile, p, quiet=True, transfer='binary')
+        self.assertTrue(os.path.getsize(tmpfile) > 0)
+
+    def testEmbeddedR(self):
+        backend = pygg.EmbeddedRBackend()
+        if not backend.available:
+            self.skipTest("rpy2 is not installed")
+        data = pandas.read_csv(io.StringIO(IRIS_DATA_CSV))
+        p = pygg.ggplot(data, pygg.aes(x='SepalLength', y='PetalLength')) + pygg.geom_point()
+        tmpfile = tempfile.NamedTemporaryFile(suffix=".png").name
+        pygg.ggsave(tmpfile, p, quiet=True, backend=backend)
+        self.assertTrue(os.path.getsize(tmpfile) > 0)
+
     def testBadGGPlotFails(self):
         p = pygg.ggplot('diamonds', pygg.aes(x='MISSING')) + pygg.geom_point()
         with self.assertRaises(ValueError):